@@ -3,7 +3,7 @@ import warnings
 import torch
 from torch import nn, einsum
 import torch.nn.functional as F
-from einops import rearrange, reduce
+import math
 from math import ceil
 
 from typing import Optional
@@ -15,14 +15,31 @@ from torch.nn.parameter import Parameter
 from torch.nn.modules.linear import NonDynamicallyQuantizableLinear as _LinearWithBias
 from torch import Tensor
 from torch.overrides import has_torch_function, handle_torch_function
-from MLIF_fusion import BilinearFusion
+from concurrent.futures import ThreadPoolExecutor
 
 ################
 # Network Utils
 ################
-def define_net(args):
+def define_net(args, state_dict=None):
+    r"""
+    Build the network for args.mode
+
+    args:
+        state_dict (dict or str): weights (or a torch.save'd file) to load. When given, the network is
+            constructed on the meta device so no memory is allocated and no initializer runs for
+            weights that are about to be overwritten, then the tensors are assigned directly.
+    """
+    if state_dict is not None:
+        if isinstance(state_dict, str):
+            state_dict = torch.load(state_dict, map_location="cpu", mmap=True, weights_only=True)
+        with torch.device("meta"):
+            net = _build_net(args)
+        net.load_state_dict(state_dict, assign=True)
+        return net
+    return _build_net(args)
+
+def _build_net(args):
     net = None
-    act = define_act_layer(act_type=args.act_type)
 
     if args.mode == "path":
         # net = PATHNet(args)
@@ -41,8 +58,100 @@ def define_net(args):
         net = TrCross(args)
     elif args.mode == "pathomic":
         net = PathomicNet(args)
+    if net is not None and getattr(args, "fused_snn", 0):
+        fuse_snn_blocks(net)
     return net
 
+_BRANCH_POOL = None
+
+def run_branches(*calls):
+    r"""
+    Run independent (fn, *args) calls concurrently and return their results in order.
+
+    The first call runs on the calling thread, the others on a small pool sized by the inter-op
+    thread count. Torch ops release the GIL, so on a many-core CPU the branches overlap; grad mode
+    is thread-local and is forwarded to the workers.
+    """
+    global _BRANCH_POOL
+    if _BRANCH_POOL is None:
+        _BRANCH_POOL = ThreadPoolExecutor(max_workers=max(1, torch.get_num_interop_threads()))
+    grad_enabled = torch.is_grad_enabled()
+
+    def run(fn, *args):
+        with torch.set_grad_enabled(grad_enabled):
+            return fn(*args)
+
+    futures = [_BRANCH_POOL.submit(run, *call) for call in calls[1:]]
+    first = calls[0][0](*calls[0][1:])
+    return [first] + [f.result() for f in futures]
+
+def embed_present(fc, x, present, placeholder):
+    r"""
+    fc(x) computed only for the rows where present is True, the other rows get the placeholder.
+
+    args:
+        fc (nn.Module): embedding network, applied to the last dimension
+        x (Tensor): [*present.shape, D_in], may be None when nothing is present
+        present (BoolTensor): [B] or [B, T] presence mask
+        placeholder (Tensor): [D_out] learned stand-in for absent rows
+
+    Under torch.compile every row is embedded and the placeholder is selected with torch.where, so
+    the graph has static shapes and no branch on the mask's data.
+    """
+    out = placeholder.expand(*present.shape, placeholder.size(-1))
+    if x is None:
+        return out
+    if torch.compiler.is_compiling():
+        return torch.where(present[..., None], fc(x).to(out.dtype), out)
+    if bool(present.all()):
+        return fc(x)
+    idx = present.nonzero(as_tuple=True)
+    if idx[0].numel() == 0:
+        return out
+    return out.index_put(idx, fc(x[idx]).to(out.dtype))
+
+def key_padding_mask(present):
+    # True = ignored key; a patient without any token of a modality attends to its placeholders
+    if present is None:
+        return None
+    return ~(present | ~present.any(dim=1, keepdim=True))
+
+def exact_attention(q, k, v, keep=None, dropout_p=0.0):
+    # softmax attention through SDPA, q/k/v [B, h, n, d], keep [B, n_k] True = attend
+    attn_mask = None if keep is None else keep[:, None, None, :]
+    return F.scaled_dot_product_attention(q, k, v, attn_mask=attn_mask, dropout_p=dropout_p)
+
+def chunked_attention(q, k, v, keep=None, dropout_p=0.0, chunk_size=1024):
+    # exact softmax attention with the queries processed in chunks, scores never exceed chunk_size x n_k
+    if q.size(-2) <= chunk_size:
+        return exact_attention(q, k, v, keep, dropout_p)
+    return torch.cat([exact_attention(q[..., i:i + chunk_size, :], k, v, keep, dropout_p)
+                      for i in range(0, q.size(-2), chunk_size)], dim=-2)
+
+def linear_attention(q, k, v, keep=None, dropout_p=0.0, eps=1e-6):
+    # kernelized attention with phi(x) = elu(x) + 1, O(n) in the sequence length (no attention dropout)
+    q, k = F.elu(q) + 1, F.elu(k) + 1
+    if keep is not None:
+        k = k * keep[:, None, :, None]
+    kv = k.transpose(-2, -1) @ v  # [B, h, d, d_v]
+    z = q @ k.sum(dim=-2).unsqueeze(-1)  # [B, h, n, 1]
+    return (q @ kv) / (z + eps)
+
+ATTENTION_BACKENDS = {
+    "exact": exact_attention,
+    "chunked": chunked_attention,
+    "linear": linear_attention,
+}
+
+def define_attention(backend):
+    r"""
+    Attention kernel fn(q, k, v, keep=None, dropout_p=0.0) for a backend name. The Transformers also
+    accept "nystrom", their original landmark approximation.
+    """
+    if backend not in ATTENTION_BACKENDS:
+        raise NotImplementedError('attention backend [%s] is not found' % backend)
+    return ATTENTION_BACKENDS[backend]
+
 def define_act_layer(act_type='Tanh'):
     if act_type == 'Tanh':
         act_layer = nn.Tanh()
@@ -61,6 +170,8 @@ def define_act_layer(act_type='Tanh'):
 def define_bifusion(fusion_type, skip=1, use_bilinear=1, gate1=1, gate2=1, dim1=32, dim2=32, scale_dim1=1, scale_dim2=1, mmhid=64, dropout_rate=0.25):
     fusion = None
     if fusion_type == 'pofusion':
+        from MLIF_fusion import BilinearFusion
+
         fusion = BilinearFusion(skip=skip, use_bilinear=use_bilinear, gate1=gate1, gate2=gate2, dim1=dim1, dim2=dim2, scale_dim1=scale_dim1, scale_dim2=scale_dim2, mmhid=mmhid, dropout_rate=dropout_rate)
     else:
         raise NotImplementedError('fusion type [%s] is not found' % fusion_type)
@@ -398,6 +509,8 @@ class MultiheadAttention(Module):
 
         Note: if kdim and vdim are None, they will be set to embed_dim such that
         query, key, and value have the same number of features.
+        backend: define_attention backend ("exact", "chunked", "linear"), None for the reference
+            implementation. Backends return no attention weights.
 
     Examples::
 
@@ -408,10 +521,13 @@ class MultiheadAttention(Module):
     bias_v: Optional[torch.Tensor]
 
     def __init__(
-        self, embed_dim, num_heads, dropout=0.0, bias=True, add_bias_kv=False, add_zero_attn=False, kdim=None, vdim=None
+        self, embed_dim, num_heads, dropout=0.0, bias=True, add_bias_kv=False, add_zero_attn=False, kdim=None, vdim=None,
+        backend=None,
     ):
         super(MultiheadAttention, self).__init__()
         self.embed_dim = embed_dim
+        # None: the reference multi_head_attention_forward, otherwise a define_attention backend
+        self.backend = backend
         self.kdim = kdim if kdim is not None else embed_dim
         self.vdim = vdim if vdim is not None else embed_dim
         self._qkv_same_embed_dim = self.kdim == embed_dim and self.vdim == embed_dim
@@ -422,9 +538,9 @@ class MultiheadAttention(Module):
         assert self.head_dim * num_heads == self.embed_dim, "embed_dim must be divisible by num_heads"
 
         if self._qkv_same_embed_dim is False:
-            self.q_proj_weight = Parameter(torch.Tensor(embed_dim, embed_dim))
-            self.k_proj_weight = Parameter(torch.Tensor(embed_dim, self.kdim))
-            self.v_proj_weight = Parameter(torch.Tensor(embed_dim, self.vdim))
+            self.q_proj_weight = Parameter(torch.empty(embed_dim, embed_dim))
+            self.k_proj_weight = Parameter(torch.empty(embed_dim, self.kdim))
+            self.v_proj_weight = Parameter(torch.empty(embed_dim, self.vdim))
             self.register_parameter("in_proj_weight", None)
         else:
             self.in_proj_weight = Parameter(torch.empty(3 * embed_dim, embed_dim))
@@ -511,6 +627,8 @@ class MultiheadAttention(Module):
             - attn_output_weights: :math:`(N, L, S)` where N is the batch size,
               L is the target sequence length, S is the source sequence length.
         """
+        if self.backend is not None:
+            return self._backend_forward(query, key, value, key_padding_mask, attn_mask)
         if not self._qkv_same_embed_dim:
             return multi_head_attention_forward(
                 query,
@@ -557,34 +675,210 @@ class MultiheadAttention(Module):
                 need_raw=need_raw,
                 attn_mask=attn_mask,
             )
+
+    def _backend_forward(self, query, key, value, key_padding_mask=None, attn_mask=None):
+        if attn_mask is not None or self.bias_k is not None or self.add_zero_attn or not self._qkv_same_embed_dim:
+            raise NotImplementedError("attention backends only support key_padding_mask")
+        E, h = self.embed_dim, self.num_heads
+        L, N, S = query.size(0), query.size(1), key.size(0)
+        w_q, w_k, w_v = self.in_proj_weight.chunk(3)
+        b_q = b_k = b_v = None
+        if self.in_proj_bias is not None:
+            b_q, b_k, b_v = self.in_proj_bias.chunk(3)
+        # seq-first [T, N, E] -> [N, h, T, d]
+        q = F.linear(query, w_q, b_q).view(L, N, h, -1).permute(1, 2, 0, 3)
+        k = F.linear(key, w_k, b_k).view(S, N, h, -1).permute(1, 2, 0, 3)
+        v = F.linear(value, w_v, b_v).view(S, N, h, -1).permute(1, 2, 0, 3)
+        keep = None if key_padding_mask is None else ~key_padding_mask.bool()
+        out = define_attention(self.backend)(q, k, v, keep, self.dropout if self.training else 0.0)
+        out = out.permute(2, 0, 1, 3).reshape(L, N, E)
+        return self.out_proj(out), None
+
+
+class CoAttention(Module):
+    r"""
+    Bidirectional cross-attention: radiology tokens attend to pathomics tokens (R_In_P) and
+    pathomics tokens attend to radiology tokens (P_In_R) in a single batched attention call.
+
+    Each token set goes through one input projection (its own query rows plus the key/value rows of
+    the opposite direction), both directions are padded to a common length and stacked along the
+    batch, and the two output projections run as one bmm. Works batch-first, so the encoder outputs
+    need no transposes. Parameters live in ``R_In_P`` / ``P_In_R`` MultiheadAttention submodules, so
+    existing weights load unchanged.
+
+    Args:
+        embed_dim: total dimension of the model.
+        num_heads: parallel attention heads.
+        dropout: dropout on the attention weights. Default: 0.0.
+        backend: define_attention backend. Default: "exact".
+
+    Shape:
+        - x_ra: :math:`(N, L, E)`, x_pa: :math:`(N, S, E)`
+        - Outputs: ra_in_pa :math:`(N, L, E)`, pa_in_ra :math:`(N, S, E)`
+    """
+
+    def __init__(self, embed_dim, num_heads=1, dropout=0.0, backend="exact"):
+        super(CoAttention, self).__init__()
+        self.embed_dim = embed_dim
+        self.num_heads = num_heads
+        self.dropout = dropout
+        self.backend = backend
+        self.R_In_P = MultiheadAttention(embed_dim=embed_dim, num_heads=num_heads, dropout=dropout)
+        self.P_In_R = MultiheadAttention(embed_dim=embed_dim, num_heads=num_heads, dropout=dropout)
+
+    def forward(self, x_ra, x_pa, ra_padding_mask=None, pa_padding_mask=None):
+        E, h = self.embed_dim, self.num_heads
+        d = E // h
+        B, L, S = x_ra.size(0), x_ra.size(1), x_pa.size(1)
+        T = max(L, S)
+        r, p = self.R_In_P, self.P_In_R
+
+        # ra provides R_In_P's queries and P_In_R's keys/values, pa the other way round
+        w_ra = torch.cat([r.in_proj_weight[:E], p.in_proj_weight[E:]])
+        w_pa = torch.cat([p.in_proj_weight[:E], r.in_proj_weight[E:]])
+        b_ra = b_pa = None
+        if r.in_proj_bias is not None:
+            b_ra = torch.cat([r.in_proj_bias[:E], p.in_proj_bias[E:]])
+            b_pa = torch.cat([p.in_proj_bias[:E], r.in_proj_bias[E:]])
+        q_ra, k_ra, v_ra = F.linear(x_ra, w_ra, b_ra).chunk(3, dim=-1)
+        q_pa, k_pa, v_pa = F.linear(x_pa, w_pa, b_pa).chunk(3, dim=-1)
+
+        def pack(a, b):
+            # [B, L, E], [B, S, E] -> [2B, h, T, d], direction R_In_P first
+            a = F.pad(a, (0, 0, 0, T - a.size(1)))
+            b = F.pad(b, (0, 0, 0, T - b.size(1)))
+            return torch.cat([a, b]).view(2 * B, T, h, d).transpose(1, 2)
+
+        q = pack(q_ra, q_pa)
+        k = pack(k_pa, k_ra)
+        v = pack(v_pa, v_ra)
+
+        # True = attend, keys of R_In_P are pathomics tokens, keys of P_In_R are radiology tokens
+        keep = torch.zeros(2, B, T, dtype=torch.bool, device=x_ra.device)
+        keep[0, :, :S] = True
+        keep[1, :, :L] = True
+        if pa_padding_mask is not None:
+            keep[0, :, :S] &= ~pa_padding_mask
+        if ra_padding_mask is not None:
+            keep[1, :, :L] &= ~ra_padding_mask
+        out = define_attention(self.backend)(
+            q, k, v, keep.view(2 * B, T), dropout_p=self.dropout if self.training else 0.0
+        )
+        out = out.transpose(1, 2).reshape(2, B * T, E)
+        w_out = torch.stack([r.out_proj.weight, p.out_proj.weight])
+        b_out = torch.stack([r.out_proj.bias, p.out_proj.bias])
+        out = torch.baddbmm(b_out.unsqueeze(1), out, w_out.transpose(1, 2)).view(2, B, T, E)
+        return out[0, :, :L], out[1, :, :S]
+
+
+def _co_attention_pre_hook(state_dict, prefix, local_metadata, strict, missing_keys, unexpected_keys, error_msgs):
+    # checkpoints of the two-module layout keep loading when co-attention is enabled
+    for name in ("R_In_P", "P_In_R"):
+        old = prefix + name + "."
+        for key in [k for k in state_dict if k.startswith(old)]:
+            state_dict[prefix + "co_attention." + key[len(prefix):]] = state_dict.pop(key)
+
+
+def _placeholder_pre_hook(module, state_dict, prefix, local_metadata, strict, missing_keys, unexpected_keys, error_msgs):
+    # checkpoints trained without missing-modality support start from zero placeholders
+    for name in ("ra_placeholder", "pa_placeholder"):
+        if prefix + name not in state_dict:
+            state_dict[prefix + name] = torch.zeros(getattr(module, name).shape)
+
+
 class Transformer(nn.Module):
-    def __init__(self, feature_dim=512):
+    def __init__(self, feature_dim=512, backend="nystrom"):
         super(Transformer, self).__init__()
         # Encoder
         self.cls_token = nn.Parameter(torch.randn(1, 1, feature_dim))
         nn.init.normal_(self.cls_token, std=1e-6)
         # self.layer1 = TransLayer(dim=feature_dim)
-        self.layer2 = TransLayer(dim=feature_dim)
+        self.layer2 = TransLayer(dim=feature_dim, backend=backend)
         self.norm = nn.LayerNorm(feature_dim)
         # Decoder
 
-    def forward(self, features):
+    def forward(self, features, mask=None, embedding=None):
         # ---->token
         cls_tokens = self.cls_token.expand(features.shape[0], -1, -1)
         h = torch.cat((cls_tokens, features), dim=1)
+        # ---->modality embedding of a shared Transformer, added to every token
+        if embedding is not None:
+            h = h + embedding
+        # ---->mask, True = present token, the cls token always is
+        if mask is not None:
+            mask = F.pad(mask, (1, 0), value=True)
         # ---->Translayer x1
         # h = self.layer1(h)  # [B, N, 512]
         # ---->Translayer x2
-        h = self.layer2(h)  # [B, N, 512]
+        h = self.layer2(h, mask=mask)  # [B, N, 512]
         # ---->cls_token
         h = self.norm(h)
         return h[:, 0], h[:, 1:]
 
+# parameter sharing between the radiology / pathomics encoders and decoders:
+# role -> key of the Transformer it uses, roles with the same key share one
+SHARE_MODES = {
+    "none": lambda modality, stage: modality + "_" + stage,
+    "modality": lambda modality, stage: modality,  # encoder and decoder tied within a modality
+    "stage": lambda modality, stage: stage,  # one encoder and one decoder for both modalities
+    "all": lambda modality, stage: "all",
+}
+
+
+class SharedTransformer(nn.Module):
+    r"""
+    One role (e.g. the radiology decoder) of a Transformer shared with other roles, with its own
+    learned embedding when the Transformer is shared across modalities
+    """
+
+    def __init__(self, transformer, feature_dim, embedding=False):
+        super(SharedTransformer, self).__init__()
+        self.transformer = transformer
+        self.embedding = nn.Parameter(torch.zeros(feature_dim)) if embedding else None
+
+    def forward(self, features, mask=None):
+        return self.transformer(features, mask, embedding=self.embedding)
+
+
+def define_transformer(pool, role, feature_dim, share="none", backend="nystrom"):
+    r"""
+    Transformer for role ("radiology_encoder", ..., "pathomics_decoder") under args.share_transformer
+
+    args:
+        pool (dict): Transformers built so far for this network, roles that map to the same
+            SHARE_MODES key reuse them
+        share (str): "none" (one Transformer per role), "modality", "stage" or "all"
+    """
+    if share not in SHARE_MODES:
+        raise NotImplementedError("share_transformer [%s] is not found" % share)
+    modality, stage = role.split("_")
+    key = SHARE_MODES[share](modality, stage)
+    if key not in pool:
+        pool[key] = Transformer(feature_dim, backend=backend)
+    if share == "none":
+        return pool[key]
+    return SharedTransformer(pool[key], feature_dim, embedding=share in ("stage", "all"))
+
+
 # helper functions
 def exists(val):
     return val is not None
 
+_EINOPS = None
+
+def _einops():
+    # einops is only needed by the nystrom attention, import it on first use and keep it, so
+    # neither module import nor the forward pays for it
+    global _EINOPS
+    if _EINOPS is None:
+        import einops
+
+        _EINOPS = einops
+    return _EINOPS
+
 def moore_penrose_iter_pinv(x, iters=6):
+    rearrange = _einops().rearrange
+
     device = x.device
 
     abs_x = torch.abs(x)
@@ -612,10 +906,15 @@ class NystromAttention(nn.Module):
         residual_conv_kernel=33,
         eps=1e-8,
         dropout=0.0,
+        backend="nystrom",
     ):
         super().__init__()
         self.eps = eps
         inner_dim = heads * dim_head
+        # "nystrom" or a define_attention backend, all of them use the same weights
+        self.backend = backend
+        if backend != "nystrom":
+            define_attention(backend)
 
         self.num_landmarks = num_landmarks
         self.pinv_iterations = pinv_iterations
@@ -633,6 +932,14 @@ class NystromAttention(nn.Module):
             self.res_conv = nn.Conv2d(heads, heads, (kernel_size, 1), padding=(padding, 0), groups=heads, bias=False)
 
     def forward(self, x, mask=None, return_attn=False):
+        if self.backend != "nystrom":
+            if return_attn:
+                raise NotImplementedError("return_attn needs the nystrom backend")
+            return self._backend_forward(x, mask)
+
+        einops = _einops()
+        rearrange, reduce = einops.rearrange, einops.reduce
+
         b, n, _, h, m, iters, eps = *x.shape, self.heads, self.num_landmarks, self.pinv_iterations, self.eps
 
         # pad so that sequence can be evenly divided into m landmarks
@@ -716,11 +1023,24 @@ class NystromAttention(nn.Module):
             return out, attn
 
         return out
+
+    def _backend_forward(self, x, mask=None):
+        b, n, _ = x.shape
+        q, k, v = self.to_qkv(x).chunk(3, dim=-1)
+        q, k, v = map(lambda t: t.view(b, n, self.heads, -1).transpose(1, 2), (q, k, v))
+        if exists(mask):
+            v = v * mask[:, None, :, None]  # masked values are zeroed like in the nystrom path
+        out = define_attention(self.backend)(q, k, v, mask)
+        if self.residual:
+            out = out + self.res_conv(v)
+        out = out.transpose(1, 2).reshape(b, n, -1)
+        return self.to_out(out)
 class TransLayer(nn.Module):
-    def __init__(self, norm_layer=nn.LayerNorm, dim=512):
+    def __init__(self, norm_layer=nn.LayerNorm, dim=512, backend="nystrom"):
         super().__init__()
         self.norm = norm_layer(dim)
         self.attn = NystromAttention(
+            backend=backend,
             dim=dim,
             dim_head=dim // 4, # dim//8
             heads=4,# 8
@@ -730,10 +1050,10 @@ class TransLayer(nn.Module):
             dropout=0.25,
         )
 
-    def forward(self, x):
-        x = x + self.attn(self.norm(x))
+    def forward(self, x, mask=None):
+        x = x + self.attn(self.norm(x), mask=mask)
         return x
-def SNN_Block(dim1, dim2, dropout=0.25):
+def SNN_Block(dim1, dim2, dropout=0.25, fused=False):
     r"""
     Multilayer Reception Block w/ Self-Normalization (Linear + ELU + Alpha Dropout)
 
@@ -741,8 +1061,90 @@ def SNN_Block(dim1, dim2, dropout=0.25):
         dim1 (int): Dimension of input features
         dim2 (int): Dimension of output features
         dropout (float): Dropout rate
+        fused (bool): build a FusedSNNBlock, same parameters and state dict
+    """
+    block = FusedSNNBlock if fused else nn.Sequential
+    return block(nn.Linear(dim1, dim2), nn.ELU(), nn.AlphaDropout(p=dropout, inplace=False))
+
+_SELU_ALPHA = 1.7580993408473766  # -alpha' of alpha dropout, the SELU negative saturation value
+
+def _pack_bits(mask):
+    # bool [n] -> uint8 [ceil(n / 8)]
+    mask = F.pad(mask.reshape(-1).to(torch.uint8), (0, -mask.numel() % 8)).view(-1, 8)
+    weights = 1 << torch.arange(8, dtype=torch.uint8, device=mask.device)
+    return (mask * weights).sum(dim=1, dtype=torch.uint8)
+
+def _unpack_bits(packed, numel):
+    bits = (packed[:, None] >> torch.arange(8, dtype=torch.uint8, device=packed.device)) & 1
+    return bits.view(-1)[:numel].bool()
+
+class _FusedSNNFunction(torch.autograd.Function):
+    r"""
+    y = alpha_dropout(elu(x W^T + b)) in one pass over the activation, saving only x, y and a 1-bit keep mask.
+
+    With keep mask m, a = ((alpha^2 p + 1)(1 - p))^-1/2 and e = elu(z):
+        y = a * m * e + alpha * a * (m - 1 + p)
+    Dropped units get no gradient, and for kept ones e = (y - alpha * a * p) / a recovers the ELU
+    output, whose derivative is 1 for e > 0 and e + elu_alpha otherwise.
     """
-    return nn.Sequential(nn.Linear(dim1, dim2), nn.ELU(), nn.AlphaDropout(p=dropout, inplace=False))
+
+    @staticmethod
+    def forward(ctx, x, weight, bias, p, elu_alpha):
+        a = 1.0 / math.sqrt((_SELU_ALPHA * _SELU_ALPHA * p + 1) * (1 - p))
+        shape = x.shape
+        x2 = x.reshape(-1, shape[-1])
+        y = torch.addmm(bias, x2, weight.t()) if bias is not None else x2 @ weight.t()
+        F.elu(y, alpha=elu_alpha, inplace=True)
+        keep = torch.empty_like(y, dtype=torch.bool).bernoulli_(1 - p)
+        y.mul_(keep).mul_(a).add_(keep.to(y.dtype).sub_(1 - p).mul_(_SELU_ALPHA * a))
+        ctx.save_for_backward(x2, weight, y, _pack_bits(keep))
+        ctx.a, ctx.p, ctx.elu_alpha, ctx.has_bias, ctx.shape = a, p, elu_alpha, bias is not None, shape
+        return y.view(*shape[:-1], -1)
+
+    @staticmethod
+    def backward(ctx, grad_y):
+        x2, weight, y, packed = ctx.saved_tensors
+        a, p = ctx.a, ctx.p
+        keep = _unpack_bits(packed, y.numel()).view_as(y)
+        e = (y - _SELU_ALPHA * a * p) / a
+        grad_z = grad_y.reshape_as(y) * a * keep * torch.where(e > 0, torch.ones_like(e), e + ctx.elu_alpha)
+        grad_x = grad_w = grad_b = None
+        if ctx.needs_input_grad[0]:
+            grad_x = (grad_z @ weight).view(ctx.shape)
+        if ctx.needs_input_grad[1]:
+            grad_w = grad_z.t() @ x2
+        if ctx.has_bias and ctx.needs_input_grad[2]:
+            grad_b = grad_z.sum(dim=0)
+        return grad_x, grad_w, grad_b, None, None
+
+class FusedSNNBlock(nn.Sequential):
+    r"""
+    Drop-in SNN_Block (same Linear / ELU / AlphaDropout children, so existing weights load unchanged)
+    whose training forward is one custom autograd op that keeps a bitmask instead of the ELU output
+    and the float dropout mask. An inactive dropout (eval mode or p = 0) runs linear + elu directly; the
+    dropout child's own mode decides, so MC dropout keeps working. A first child that is no longer an
+    nn.Linear (e.g. lowrank.LowRankLinear after compress) runs the unfused layers.
+    """
+
+    def forward(self, x):
+        linear, elu, dropout = self[0], self[1], self[2]
+        if not (dropout.training and dropout.p > 0):
+            return F.elu(linear(x), alpha=elu.alpha)
+        if not isinstance(linear, nn.Linear):
+            return F.alpha_dropout(F.elu(linear(x), alpha=elu.alpha), dropout.p, training=True)
+        return _FusedSNNFunction.apply(x, linear.weight, linear.bias, dropout.p, elu.alpha)
+
+def fuse_snn_blocks(module):
+    r"""
+    Replace every Linear + ELU + AlphaDropout Sequential inside module by a FusedSNNBlock sharing its parameters
+    """
+    for name, child in module.named_children():
+        if (type(child) is nn.Sequential and len(child) == 3 and isinstance(child[0], nn.Linear)
+                and isinstance(child[1], nn.ELU) and isinstance(child[2], nn.AlphaDropout)):
+            setattr(module, name, FusedSNNBlock(*child))
+        else:
+            fuse_snn_blocks(child)
+    return module
 class MLP(nn.Module):
     def __init__(self, input_dim, hidden_dim, output_dim, num_layers):
         super().__init__()
@@ -820,6 +1222,9 @@ class TrCross(nn.Module):
             "pathomics": {"small": [512, 256], "large": [1024, 1024, 1024, 256]},
         }
         self.dim = args.feature_dim
+        # "nystrom" (default) or a define_attention backend; cross-attention stays exact with nystrom
+        self.attention_backend = getattr(args, "attention_backend", "nystrom")
+        cross_backend = None if self.attention_backend == "nystrom" else self.attention_backend
 
         # Radiology Embedding Network
         hidden = self.size_dict["Radiology"][model_size]
@@ -839,21 +1244,36 @@ class TrCross(nn.Module):
                 fc_omic.append(SNN_Block(dim1=hidden[i], dim2=hidden[i + 1], dropout=0.0))#0.25
             sig_networks.append(nn.Sequential(*fc_omic))
         self.Pathomics_fc = nn.ModuleList(sig_networks)
-        ###trsformer
+        # learned stand-ins for absent modalities, see forward(ra_mask=..., pa_mask=...)
+        self.missing_modality = bool(getattr(args, "missing_modality", 0))
+        if self.missing_modality:
+            self.ra_placeholder = nn.Parameter(torch.zeros(self.size_dict["Radiology"][model_size][-1]))
+            self.pa_placeholder = nn.Parameter(torch.zeros(len(omic_sizes), hidden[-1]))
+            self._register_load_state_dict_pre_hook(_placeholder_pre_hook, with_module=True)
+        ###trsformer, shared between roles with args.share_transformer
+        self.share_transformer = getattr(args, "share_transformer", "none")
+        transformers = {}
         # Encoder
-        self.radiology_encoder = Transformer(self.dim)
+        self.radiology_encoder = define_transformer(transformers, "radiology_encoder", self.dim, self.share_transformer, self.attention_backend)
         # Decoder
-        self.radiology_decoder = Transformer(self.dim)
+        self.radiology_decoder = define_transformer(transformers, "radiology_decoder", self.dim, self.share_transformer, self.attention_backend)
 
 
         ###crossAttention
-        self.R_In_P= MultiheadAttention(embed_dim=args.feature_dim, num_heads=1)
-        self.P_In_R = MultiheadAttention(embed_dim=args.feature_dim, num_heads=1)
+        self.use_co_attention = bool(getattr(args, "co_attention", 0))
+        # run the independent radiology / pathomics branches concurrently
+        self.parallel_branches = bool(getattr(args, "parallel_branches", 0))
+        if self.use_co_attention:
+            self.co_attention = CoAttention(embed_dim=args.feature_dim, num_heads=1, backend=cross_backend or "exact")
+            self._register_load_state_dict_pre_hook(_co_attention_pre_hook)
+        else:
+            self.R_In_P= MultiheadAttention(embed_dim=args.feature_dim, num_heads=1, backend=cross_backend)
+            self.P_In_R = MultiheadAttention(embed_dim=args.feature_dim, num_heads=1, backend=cross_backend)
 
         # Encoder
-        self.pathomics_encoder = Transformer(self.dim)
+        self.pathomics_encoder = define_transformer(transformers, "pathomics_encoder", self.dim, self.share_transformer, self.attention_backend)
         # Decoder
-        self.pathomics_decoder = Transformer(self.dim)
+        self.pathomics_decoder = define_transformer(transformers, "pathomics_decoder", self.dim, self.share_transformer, self.attention_backend)
         ####MLP
 
         # self.bbox_embed = MLP(self.dim*2, self.dim*2, 1, 1)
@@ -865,60 +1285,127 @@ class TrCross(nn.Module):
                                       scale_dim1=args.path_scale, scale_dim2=args.omic_scale, mmhid=args.mmhid,
                                       dropout_rate=args.dropout_rate)
         self.classifier = MLP(self.dim, self.dim, 1, 1)
-        self.classifier2 = MLP(self.dim*2, self.dim*2, 1, 1)
+        # label_dim > 1: discrete-time hazards for the nll / ce losses, one per time bin
+        self.label_dim = getattr(args, "label_dim", 1)
+        self.classifier2 = MLP(self.dim*2, self.dim*2, self.label_dim, 1)
         act = define_act_layer(act_type=args.act_type)
 
 
         self.act = act
-        self.output_range = Parameter(torch.FloatTensor([6]), requires_grad=False)
-        self.output_shift = Parameter(torch.FloatTensor([-3]), requires_grad=False)
+        self.output_range = Parameter(torch.tensor([6.0]), requires_grad=False)
+        self.output_shift = Parameter(torch.tensor([-3.0]), requires_grad=False)
 
-    def forward(self, **kwargs):
-
-        x_ra = kwargs["ra"]
-        x_pa = [kwargs["pa%d" % i] for i in range(1, 5)]
-
-        #ra embedding
-        radiology_features = self.Radiology_fc(x_ra)
+    def radiology_branch(self, x_ra, mask=None):
+        #ra embedding, absent tokens skip Radiology_fc
+        if mask is None:
+            radiology_features = self.Radiology_fc(x_ra)
+        else:
+            radiology_features = embed_present(self.Radiology_fc, x_ra, mask, self.ra_placeholder)
+        # ra encoder
+        return self.radiology_encoder(radiology_features, mask)  # cls token + patch tokens
 
-        #pa embedding
-        pathomics_features = [self.Pathomics_fc[idx].forward(sig_feat) for idx, sig_feat in enumerate(x_pa)]
+    def embed_pathomics(self, x_pa, mask=None):
+        #pa embedding [B, 4, D], absent groups skip their Pathomics_fc
+        if mask is None:
+            pathomics_features = [self.Pathomics_fc[idx](sig_feat) for idx, sig_feat in enumerate(x_pa)]
+        else:
+            pathomics_features = [embed_present(self.Pathomics_fc[idx], sig_feat, mask[:, idx], self.pa_placeholder[idx])
+                                  for idx, sig_feat in enumerate(x_pa)]
         pathomics_features = torch.stack(pathomics_features)
-        pathomics_features = pathomics_features.transpose(1,0)
+        return pathomics_features.transpose(1,0)
 
-        # ra encoder
-        cls_token_ra_encoder, patch_token_ra_encoder = self.radiology_encoder(
-            radiology_features)  # cls token + patch tokens
+    def pathomics_branch(self, x_pa, mask=None):
         # pa encoder
-        cls_token_pa_encoder, patch_token_pa_encoder = self.pathomics_encoder(
-            pathomics_features)  # cls token + patch tokens
+        return self.pathomics_encoder(self.embed_pathomics(x_pa, mask), mask)  # cls token + patch tokens
 
-        # cross-omics attention
-        ra_in_pa, Att = self.R_In_P(
-            patch_token_ra_encoder.transpose(1, 0),
-            patch_token_pa_encoder.transpose(1, 0),
-            patch_token_pa_encoder.transpose(1, 0),
-        )  # ([5, 16, 256])
-        pa_in_ra, Att = self.P_In_R(
-            patch_token_pa_encoder.transpose(1, 0),
-            patch_token_ra_encoder.transpose(1, 0),
-            patch_token_ra_encoder.transpose(1, 0),
-        )  # ([4, 16, 256])
+    def modality_masks(self, x_ra, x_pa, ra_mask=None, pa_mask=None):
+        r"""
+        Presence masks ([B, ra_tokens] and [B, 4], True = present) from the optional ra_mask / pa_mask
+        kwargs and the modalities that were not passed at all; (None, None) when everything is present.
+        """
+        if ra_mask is None and pa_mask is None and x_ra is not None and all(x is not None for x in x_pa):
+            return None, None
+        if not self.missing_modality:
+            raise ValueError("missing modalities need a network built with args.missing_modality")
+        present = [x for x in [x_ra] + x_pa if x is not None]
+        B = present[0].size(0) if present else ra_mask.size(0) if ra_mask is not None else pa_mask.size(0)
+        device = self.pa_placeholder.device
+
+        T = x_ra.size(1) if x_ra is not None else 1
+        if x_ra is None:
+            ra_mask = torch.zeros(B, T, dtype=torch.bool, device=device)
+        elif ra_mask is None:
+            ra_mask = torch.ones(B, T, dtype=torch.bool, device=device)
+        elif ra_mask.dim() == 1:
+            ra_mask = ra_mask[:, None].expand(B, T)
+        if pa_mask is None:
+            pa_mask = torch.ones(B, len(x_pa), dtype=torch.bool, device=device)
+        pa_mask = pa_mask & torch.tensor([x is not None for x in x_pa], device=pa_mask.device)
+        return ra_mask.bool(), pa_mask.bool()
+
+    def forward(self, **kwargs):
+
+        x_ra = kwargs.get("ra")
+        x_pa = [kwargs.get("pa%d" % i) for i in range(1, 5)]
+        # optional presence masks, absent modalities are replaced by learned placeholder tokens
+        ra_mask, pa_mask = self.modality_masks(x_ra, x_pa, kwargs.get("ra_mask"), kwargs.get("pa_mask"))
+
+        if self.parallel_branches:
+            (cls_token_ra_encoder, patch_token_ra_encoder), (cls_token_pa_encoder, patch_token_pa_encoder) = run_branches(
+                (self.radiology_branch, x_ra, ra_mask), (self.pathomics_branch, x_pa, pa_mask))
+        else:
+            cls_token_ra_encoder, patch_token_ra_encoder = self.radiology_branch(x_ra, ra_mask)
+            cls_token_pa_encoder, patch_token_pa_encoder = self.pathomics_branch(x_pa, pa_mask)
+
+        return self.decode(cls_token_ra_encoder, patch_token_ra_encoder, cls_token_pa_encoder, patch_token_pa_encoder,
+                           ra_mask, pa_mask)
+
+    def decode(self, cls_token_ra_encoder, patch_token_ra_encoder, cls_token_pa_encoder, patch_token_pa_encoder,
+               ra_mask=None, pa_mask=None):
+        r"""
+        Everything after the two encoders: cross-attention, decoders, fusion and the hazard head.
+        Callers that already hold encoder outputs (e.g. attribution scans) can rerun only this part.
+        """
+        # cross-omics attention, absent tokens are padded out of the keys
+        ra_padding_mask, pa_padding_mask = key_padding_mask(ra_mask), key_padding_mask(pa_mask)
+        if self.use_co_attention:
+            ra_in_pa, pa_in_ra = self.co_attention(
+                patch_token_ra_encoder, patch_token_pa_encoder, ra_padding_mask, pa_padding_mask)  # batch first
+        else:
+            ra_in_pa, Att = self.R_In_P(
+                patch_token_ra_encoder.transpose(1, 0),
+                patch_token_pa_encoder.transpose(1, 0),
+                patch_token_pa_encoder.transpose(1, 0),
+                key_padding_mask=pa_padding_mask,
+            )  # ([5, 16, 256])
+            pa_in_ra, Att = self.P_In_R(
+                patch_token_pa_encoder.transpose(1, 0),
+                patch_token_ra_encoder.transpose(1, 0),
+                patch_token_ra_encoder.transpose(1, 0),
+                key_padding_mask=ra_padding_mask,
+            )  # ([4, 16, 256])
+            ra_in_pa, pa_in_ra = ra_in_pa.transpose(1, 0), pa_in_ra.transpose(1, 0)
 
         # decoder
-        # radiology decoder
-        cls_token_radiology_decoder, _ = self.radiology_decoder(
-            ra_in_pa.transpose(1, 0))  # cls token + patch tokens
-        # genomics decoder
-        cls_token_pathomics_decoder, _ = self.pathomics_decoder(
-            pa_in_ra.transpose(1, 0))  # cls token + patch tokens
+        if self.parallel_branches:
+            (cls_token_radiology_decoder, _), (cls_token_pathomics_decoder, _) = run_branches(
+                (self.radiology_decoder, ra_in_pa, ra_mask), (self.pathomics_decoder, pa_in_ra, pa_mask))
+        else:
+            # radiology decoder
+            cls_token_radiology_decoder, _ = self.radiology_decoder(
+                ra_in_pa, ra_mask)  # cls token + patch tokens
+            # genomics decoder
+            cls_token_pathomics_decoder, _ = self.pathomics_decoder(
+                pa_in_ra, pa_mask)  # cls token + patch tokens
 
         features = self.fusion(cls_token_radiology_decoder, cls_token_pathomics_decoder)
         features2 = self.fusion(cls_token_ra_encoder, cls_token_pa_encoder)
         out = torch.cat((features, features2), 1)
         hazard = self.classifier2(out)
         # hazard = self.classifier(features)
-        if self.act is not None:
+        if self.label_dim > 1:
+            hazard = torch.sigmoid(hazard)  # per-bin hazards in (0, 1), see loss.nll_loss
+        elif self.act is not None:
             hazard = self.act(hazard)
 
             if isinstance(self.act, nn.Sigmoid):
@@ -936,8 +1423,8 @@ class PathomicNet(nn.Module):
         self.act = act
 
 
-        self.output_range = Parameter(torch.FloatTensor([6]), requires_grad=False)
-        self.output_shift = Parameter(torch.FloatTensor([-3]), requires_grad=False)
+        self.output_range = Parameter(torch.tensor([6.0]), requires_grad=False)
+        self.output_shift = Parameter(torch.tensor([-3.0]), requires_grad=False)
 
         # self.Concat = Concat(skip=opt.skip, use_bilinear=opt.use_bilinear, gate1=opt.path_gate, gate2=opt.omic_gate, dim1=opt.path_dim, dim2=opt.omic_dim, scale_dim1=opt.path_scale, scale_dim2=opt.omic_scale, mmhid=opt.mmhid, dropout_rate=opt.dropout_rate)
 
@@ -1046,22 +1533,21 @@ class RANet(nn.Module):
             sig_networks.append(nn.Sequential(*fc_omic))
         self.Pathomics_fc = nn.ModuleList(sig_networks)
         ###trsformer
-        # Encoder
-        self.radiology_encoder = Transformer(self.dim)
-        # Decoder
-        self.radiology_decoder = Transformer(self.dim)
-
-        # Encoder
-        self.pathomics_encoder = Transformer(self.dim)
-        # Decoder
-        self.pathomics_decoder = Transformer(self.dim)
+        # the legacy layout keeps all four for checkpoint compatibility, a shared layout only builds radiology
+        self.share_transformer = getattr(args, "share_transformer", "none")
+        transformers = {}
+        modalities = ["radiology", "pathomics"] if self.share_transformer == "none" else ["radiology"]
+        for modality in modalities:
+            for stage in ["encoder", "decoder"]:
+                role = modality + "_" + stage
+                setattr(self, role, define_transformer(transformers, role, self.dim, self.share_transformer))
         ####MLP
 
         self.bbox_embed = MLP(self.dim, self.dim, 1, 1)
     def forward(self, **kwargs):
 
         x_ra = kwargs["ra"]
-        x_pa = [kwargs["pa%d" % i] for i in range(1, 5)]
+        x_pa = [kwargs.get("pa%d" % i) for i in range(1, 5)]
 
         #ra embedding
         radiology_features = self.Radiology_fc(x_ra)
@@ -1108,15 +1594,14 @@ class PATHNet(nn.Module):
             sig_networks.append(nn.Sequential(*fc_omic))
         self.Pathomics_fc = nn.ModuleList(sig_networks)
         ###trsformer
-        # Encoder
-        self.radiology_encoder = Transformer(self.dim)
-        # Decoder
-        self.radiology_decoder = Transformer(self.dim)
-
-        # Encoder
-        self.pathomics_encoder = Transformer(self.dim)
-        # Decoder
-        self.pathomics_decoder = Transformer(self.dim)
+        # the legacy layout keeps all four for checkpoint compatibility, a shared layout only builds pathomics
+        self.share_transformer = getattr(args, "share_transformer", "none")
+        transformers = {}
+        modalities = ["radiology", "pathomics"] if self.share_transformer == "none" else ["pathomics"]
+        for modality in modalities:
+            for stage in ["encoder", "decoder"]:
+                role = modality + "_" + stage
+                setattr(self, role, define_transformer(transformers, role, self.dim, self.share_transformer))
         ####MLP
 
         self.bbox_embed = MLP(self.dim, self.dim, 1, 1)
@@ -1190,8 +1675,8 @@ class PATHNet2(nn.Module):
 
         # if init_max: init_max_weights(self)
 
-        self.output_range = Parameter(torch.FloatTensor([6]), requires_grad=False)
-        self.output_shift = Parameter(torch.FloatTensor([-3]), requires_grad=False)
+        self.output_range = Parameter(torch.tensor([6.0]), requires_grad=False)
+        self.output_shift = Parameter(torch.tensor([-3.0]), requires_grad=False)
 
     def forward(self, **kwargs):
         x_pa = [kwargs["pa%d" % i] for i in range(1, 5)]
@@ -1226,11 +1711,11 @@ class PATHNet_TU(nn.Module):
 
         # if init_max: init_max_weights(self)
 
-        self.output_range = Parameter(torch.FloatTensor([6]), requires_grad=False)
-        self.output_shift = Parameter(torch.FloatTensor([-3]), requires_grad=False)
+        self.output_range = Parameter(torch.tensor([6.0]), requires_grad=False)
+        self.output_shift = Parameter(torch.tensor([-3.0]), requires_grad=False)
 
     def forward(self, **kwargs):
-        x_pa = [kwargs["pa%d" % i] for i in range(1, 5)]
+        x_pa = [kwargs.get("pa%d" % i) for i in range(1, 5)]
         path_PaTu_features = x_pa[0]
         # path_PaEp_features = x_pa[1]
         # path_PaSt_features = x_pa[2]
@@ -1282,11 +1767,11 @@ class PATHNet_PaEp(nn.Module):
 
         # if init_max: init_max_weights(self)
 
-        self.output_range = Parameter(torch.FloatTensor([6]), requires_grad=False)
-        self.output_shift = Parameter(torch.FloatTensor([-3]), requires_grad=False)
+        self.output_range = Parameter(torch.tensor([6.0]), requires_grad=False)
+        self.output_shift = Parameter(torch.tensor([-3.0]), requires_grad=False)
 
     def forward(self, **kwargs):
-        x_pa = [kwargs["pa%d" % i] for i in range(1, 5)]
+        x_pa = [kwargs.get("pa%d" % i) for i in range(1, 5)]
         path_PaTu_features = x_pa[0]
         path_PaEp_features = x_pa[1]
         path_PaSt_features = x_pa[2]
@@ -1338,11 +1823,11 @@ class PATHNet_PaSt(nn.Module):
 
         # if init_max: init_max_weights(self)
 
-        self.output_range = Parameter(torch.FloatTensor([6]), requires_grad=False)
-        self.output_shift = Parameter(torch.FloatTensor([-3]), requires_grad=False)
+        self.output_range = Parameter(torch.tensor([6.0]), requires_grad=False)
+        self.output_shift = Parameter(torch.tensor([-3.0]), requires_grad=False)
 
     def forward(self, **kwargs):
-        x_pa = [kwargs["pa%d" % i] for i in range(1, 5)]
+        x_pa = [kwargs.get("pa%d" % i) for i in range(1, 5)]
         path_PaTu_features = x_pa[0]
         path_PaEp_features = x_pa[1]
         path_PaSt_features = x_pa[2]
@@ -1394,11 +1879,11 @@ class PATHNet_PaSt(nn.Module):
 
         # if init_max: init_max_weights(self)
 
-        self.output_range = Parameter(torch.FloatTensor([6]), requires_grad=False)
-        self.output_shift = Parameter(torch.FloatTensor([-3]), requires_grad=False)
+        self.output_range = Parameter(torch.tensor([6.0]), requires_grad=False)
+        self.output_shift = Parameter(torch.tensor([-3.0]), requires_grad=False)
 
     def forward(self, **kwargs):
-        x_pa = [kwargs["pa%d" % i] for i in range(1, 5)]
+        x_pa = [kwargs.get("pa%d" % i) for i in range(1, 5)]
         path_PaTu_features = x_pa[0]
         path_PaEp_features = x_pa[1]
         path_PaSt_features = x_pa[2]
@@ -1450,11 +1935,11 @@ class PATHNet_PaNu(nn.Module):
 
         # if init_max: init_max_weights(self)
 
-        self.output_range = Parameter(torch.FloatTensor([6]), requires_grad=False)
-        self.output_shift = Parameter(torch.FloatTensor([-3]), requires_grad=False)
+        self.output_range = Parameter(torch.tensor([6.0]), requires_grad=False)
+        self.output_shift = Parameter(torch.tensor([-3.0]), requires_grad=False)
 
     def forward(self, **kwargs):
-        x_pa = [kwargs["pa%d" % i] for i in range(1, 5)]
+        x_pa = [kwargs.get("pa%d" % i) for i in range(1, 5)]
         path_PaTu_features = x_pa[0]
         path_PaEp_features = x_pa[1]
         path_PaSt_features = x_pa[2]
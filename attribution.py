@@ -0,0 +1,172 @@
+import torch
+
+from evaluator import risk_from_hazards
+from utils import PA_KEYS
+
+MODALITIES = ("ra",) + PA_KEYS
+
+
+def _repeat(t, n):
+    # [B, ...] -> [n * B, ...], copy j of sample i sits at j * B + i
+    return None if t is None else t.repeat(n, *([1] * (t.dim() - 1)))
+
+
+def _pick(t, n, index):
+    # t holds n stacked variants of the batch, gather variants index -> [len(index) * B, ...]
+    return t.view(n, -1, *t.shape[1:])[index].reshape(-1, *t.shape[1:])
+
+
+def _cat(tensors):
+    return None if tensors[0] is None else torch.cat(tensors)
+
+
+@torch.no_grad()
+def _ablation_scan(net, inputs, modalities):
+    x_ra = inputs.get("ra")
+    x_pa = [inputs.get(key) for key in PA_KEYS]
+    # the patients' own presence masks, so the intact variant matches net(**inputs)
+    ra_mask, pa_mask = net.modality_masks(x_ra, x_pa, inputs.get("ra_mask"), inputs.get("pa_mask"))
+    masked = net.missing_modality
+    if masked and ra_mask is None:
+        ra_mask = torch.ones(x_ra.shape[:2], dtype=torch.bool, device=x_ra.device)
+        pa_mask = torch.ones(x_ra.size(0), len(PA_KEYS), dtype=torch.bool, device=x_ra.device)
+    B = (ra_mask if masked else x_ra).size(0)
+
+    ablate_ra = "ra" in modalities
+    groups = [PA_KEYS.index(m) for m in modalities if m != "ra"]
+
+    # radiology branch: intact (+ ablated), pathomics encoder: intact + one variant per ablated group.
+    # ablated = absent (patient mask AND ablation, placeholders) for networks built with
+    # args.missing_modality, zero-filled input otherwise
+    ra_in, ra_masks = [x_ra], [ra_mask]
+    if ablate_ra:
+        ra_in.append(x_ra if masked else torch.zeros_like(x_ra))
+        ra_masks.append(torch.zeros_like(ra_mask) if masked else None)
+    pa_masks = [pa_mask]
+    for g in groups:
+        if masked:
+            mask = pa_mask.clone()
+            mask[:, g] = False
+            pa_masks.append(mask)
+        else:
+            pa_masks.append(None)
+    ra_masks, pa_masks = _cat(ra_masks), _cat(pa_masks)
+    cls_ra, patch_ra = net.radiology_branch(_cat(ra_in), ra_masks)
+
+    # every Pathomics_fc embeds its group once, plus once more for the baseline of an ablated group,
+    # and the encoder input of each variant is assembled from those embeddings
+    n_pa = 1 + len(groups)
+    intact = net.embed_pathomics(x_pa, pa_mask)  # [B, 4, D]
+    features = []
+    for i in range(len(PA_KEYS)):
+        if i not in groups:
+            features.append(_repeat(intact[:, i], n_pa))
+            continue
+        if masked:
+            baseline = net.pa_placeholder[i].to(intact.dtype).expand_as(intact[:, i])
+        else:
+            baseline = net.Pathomics_fc[i](torch.zeros_like(x_pa[i]))
+        index = [int(v == 1 + groups.index(i)) for v in range(n_pa)]
+        features.append(_pick(torch.cat([intact[:, i], baseline]), 2, index))
+    cls_pa, patch_pa = net.pathomics_encoder(torch.stack(features, dim=1), pa_masks)
+
+    # variant v uses radiology output ra_index[v] and pathomics output pa_index[v], v = 0 is intact
+    ra_index, pa_index = [0], [0]
+    for m in modalities:
+        ra_index.append(1 if m == "ra" else 0)
+        pa_index.append(0 if m == "ra" else 1 + groups.index(PA_KEYS.index(m)))
+    n_ra = len(ra_in)
+    outputs = net.decode(
+        _pick(cls_ra, n_ra, ra_index), _pick(patch_ra, n_ra, ra_index),
+        _pick(cls_pa, n_pa, pa_index), _pick(patch_pa, n_pa, pa_index),
+        _pick(ra_masks, n_ra, ra_index) if masked else None,
+        _pick(pa_masks, n_pa, pa_index) if masked else None,
+    )
+    return risk_from_hazards(outputs[1]).view(len(modalities) + 1, B)
+
+
+@torch.no_grad()
+def modality_ablation(net, inputs, modalities=MODALITIES, chunk_size=None):
+    r"""
+    Risk change of every patient when each modality is removed, all variants in one expanded batch
+
+    The radiology branch runs only for the intact and the ablated radiomics. Each pathomics group is
+    embedded once (and once more for its baseline when it is ablated), and the pathomics encoder runs
+    for the intact groups plus one variant per ablated group; only cross-attention, decoders and
+    fusion (TrCross.decode) run for every variant. Both branches take the patients' own ra_mask /
+    pa_mask (modality_masks), so the intact risk matches net(**inputs). A removed modality is
+    absent (its mask ANDed off, placeholders) for networks built with args.missing_modality, and
+    zero-filled otherwise.
+
+    args:
+        net (TrCross): define_net mode "rapath"
+        inputs (dict): forward kwargs, ra [B, T, 863], pa1..pa4 and optionally ra_mask / pa_mask
+        modalities (tuple): modalities to ablate, one at a time
+        chunk_size (int): patients per expanded batch (the batch grows len(modalities) + 1 times)
+
+    Returns {"risk": [B], "ablated_risk": [B, M], "attribution": risk - ablated_risk [B, M], "modalities"}.
+    """
+    if not hasattr(net, "decode"):
+        raise ValueError("modality ablation needs a TrCross (rapath) network")
+    net.eval()
+    B = next(v for v in inputs.values() if v is not None).size(0)
+    chunk_size = chunk_size or B
+    risks = torch.cat([_ablation_scan(net, {k: v if v is None else v[s:s + chunk_size] for k, v in inputs.items()}, modalities)
+                       for s in range(0, B, chunk_size)], dim=1)
+    risk, ablated = risks[0], risks[1:].t()
+    return {"risk": risk, "ablated_risk": ablated, "attribution": risk[:, None] - ablated, "modalities": list(modalities)}
+
+
+def integrated_gradients(net, inputs, steps=32, baseline=None, chunk_size=8, output_index=1):
+    r"""
+    Integrated gradients of the risk with respect to the radiomics features
+
+    The straight path from baseline to ra is sampled at ``steps`` midpoints; ``chunk_size`` of them
+    are stacked along the batch per forward/backward, which bounds memory. For TrCross the pathomics
+    branch does not depend on ra, so it runs once and its outputs are reused for every step.
+
+    args:
+        net (nn.Module): any define_net model reading ra
+        inputs (dict): forward kwargs, ra [B, T, 863]
+        steps (int): interpolation steps
+        baseline (Tensor): reference input, default: zeros
+
+    Returns {"attribution": [B, T, 863], "delta": [B]}, delta = sum(attribution) - (risk(ra) - risk(baseline)),
+    which goes to 0 as steps grows.
+    """
+    net.eval()
+    x = inputs["ra"]
+    baseline = torch.zeros_like(x) if baseline is None else baseline.expand_as(x)
+    B = x.size(0)
+    others = {k: v for k, v in inputs.items() if k != "ra"}
+
+    reuse = hasattr(net, "decode")
+    if reuse:
+        x_pa = [inputs.get(key) for key in PA_KEYS]
+        ra_mask, pa_mask = net.modality_masks(x, x_pa, inputs.get("ra_mask"), inputs.get("pa_mask"))
+        with torch.no_grad():
+            cls_pa, patch_pa = net.pathomics_branch(x_pa, pa_mask)
+
+    alphas = (torch.arange(steps, dtype=x.dtype, device=x.device) + 0.5) / steps
+    total = torch.zeros_like(x)
+    for start in range(0, steps, chunk_size):
+        a = alphas[start:start + chunk_size]
+        c = a.numel()
+        path = baseline[None] + a.view(-1, *([1] * x.dim())) * (x - baseline)[None]
+        path = path.reshape(c * B, *x.shape[1:]).requires_grad_(True)
+        if reuse:
+            cls_ra, patch_ra = net.radiology_branch(path, _repeat(ra_mask, c))
+            outputs = net.decode(cls_ra, patch_ra, _repeat(cls_pa, c), _repeat(patch_pa, c),
+                                 _repeat(ra_mask, c), _repeat(pa_mask, c))
+        else:
+            outputs = net(ra=path, **{k: _repeat(v, c) for k, v in others.items()})
+        risk = risk_from_hazards(outputs[output_index])
+        grad, = torch.autograd.grad(risk.sum(), path)
+        total += grad.view(c, B, *x.shape[1:]).sum(dim=0)
+
+    attribution = (x - baseline) * total / steps
+    with torch.no_grad():
+        end = risk_from_hazards(net(**inputs)[output_index])
+        begin = risk_from_hazards(net(**dict(inputs, ra=baseline))[output_index])
+    delta = attribution.reshape(B, -1).sum(dim=1) - (end - begin)
+    return {"attribution": attribution, "delta": delta}
@@ -0,0 +1,769 @@
+import argparse
+import json
+import os
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import torch
+
+from loss import define_loss
+from utils import LOSS_TYPES, NET_MODES, default_args, load_camlif, synthetic_inputs, timeit
+
+
+_CPU_BASE_MB = 0.0
+
+
+def _rss_mb(field):
+    # VmRSS / VmHWM of this process, ru_maxrss (KB on linux) where /proc is unavailable
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _reset_peak(device):
+    global _CPU_BASE_MB
+    if torch.device(device).type == "cuda":
+        torch.cuda.reset_peak_memory_stats(device)
+        return
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")  # reset VmHWM to the current VmRSS (linux >= 4.0)
+    except OSError:
+        pass
+    _CPU_BASE_MB = _rss_mb("VmRSS")
+
+
+def _peak_mb(device):
+    r"""
+    CUDA: peak allocated memory since _reset_peak. CPU: growth of the resident high water mark
+    since _reset_peak; memory freed earlier in the process can be reused without showing up, so
+    CPU figures are only comparable between configurations run in fresh processes (isolated)
+    """
+    if torch.device(device).type == "cuda":
+        return torch.cuda.max_memory_allocated(device) / 2**20
+    return max(_rss_mb("VmHWM") - _CPU_BASE_MB, 0.0)
+
+
+_ISOLATED = """
+import json, sys
+sys.path.insert(0, %(root)r)
+import torch
+torch.set_num_threads(%(threads)r)
+import benchmark
+print(json.dumps(getattr(benchmark, %(fn)r)(*%(args)r, **%(kwargs)r)))
+"""
+
+
+def isolated(fn, *args, **kwargs):
+    r"""
+    Run the benchmark function named fn in a fresh interpreter (same thread count) and return its
+    result, so the CPU peak memory it reports does not depend on what ran before
+    """
+    script = _ISOLATED % {"root": os.path.dirname(os.path.abspath(__file__)), "threads": torch.get_num_threads(),
+                          "fn": fn, "args": args, "kwargs": kwargs}
+    out = subprocess.run([sys.executable, "-c", script], check=True, capture_output=True, text=True)
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+def bench_net(mode, batch_size, repeats=20, warmup=3, ra_tokens=1, device="cpu"):
+    camlif = load_camlif()
+    net = camlif.define_net(default_args(mode=mode)).to(device)
+    inputs = synthetic_inputs(batch_size, ra_tokens=ra_tokens, device=device)
+
+    def forward():
+        with torch.no_grad():
+            net(**inputs)
+
+    def forward_backward():
+        net.zero_grad(set_to_none=True)
+        out = net(**inputs)
+        out[1].float().sum().backward()
+
+    _reset_peak(device)
+    net.eval()
+    fwd = timeit(forward, repeats, warmup, device)
+    fwd_peak = _peak_mb(device)
+
+    _reset_peak(device)
+    net.train()
+    bwd = timeit(forward_backward, repeats, warmup, device)
+    bwd_peak = _peak_mb(device)
+
+    return {
+        "forward_ms": fwd["median_ms"],
+        "forward_backward_ms": bwd["median_ms"],
+        "throughput": batch_size / (fwd["median_ms"] / 1e3),
+        "forward_peak_mb": fwd_peak,
+        "forward_backward_peak_mb": bwd_peak,
+        "params": sum(p.numel() for p in net.parameters()),
+    }
+
+
+def loss_inputs(loss_type, batch_size, n_bins=4, dim=256, device="cpu"):
+    c = torch.randint(0, 2, (batch_size,), device=device)
+    if loss_type == "cox_surv":
+        hazards = torch.randn(batch_size, 1, device=device, requires_grad=True)
+        times = torch.rand(batch_size, device=device) * 100
+        return {"hazards": hazards, "S": times, "c": c}, []
+    hazards = torch.rand(batch_size, n_bins, device=device).clamp(1e-3, 1 - 1e-3).requires_grad_()
+    Y = torch.randint(0, n_bins, (batch_size,), device=device)
+    n_aux = 4 if loss_type == "nll_surv_ol" else 2
+    aux = [torch.randn(batch_size, dim, device=device, requires_grad=True) for _ in range(n_aux)]
+    return {"hazards": hazards, "S": None, "Y": Y, "c": c}, aux
+
+
+def bench_loss(loss_type, batch_size, repeats=20, warmup=3, device="cpu"):
+    loss_fn = define_loss(default_args(loss=loss_type))
+    surv_inputs, aux = loss_inputs(loss_type, batch_size, device=device)
+
+    def step():
+        if isinstance(loss_fn, list):
+            loss = loss_fn[0](**surv_inputs) + loss_fn[1](*aux).mean()
+        else:
+            loss = loss_fn(**surv_inputs)
+        loss.backward()
+
+    _reset_peak(device)
+    result = timeit(step, repeats, warmup, device)
+    return {
+        "forward_backward_ms": result["median_ms"],
+        "throughput": batch_size / (result["median_ms"] / 1e3),
+        "peak_mb": _peak_mb(device),
+    }
+
+
+_COLD_START = """
+import json, sys, time
+start = time.perf_counter()
+sys.path.insert(0, %(root)r)
+from utils import default_args, load_camlif
+camlif = load_camlif()
+imported = time.perf_counter()
+args = default_args(mode=%(mode)r)
+if %(fast)r:
+    net = camlif.define_net(args, state_dict=%(checkpoint)r)
+else:
+    import torch
+    net = camlif.define_net(args)
+    net.load_state_dict(torch.load(%(checkpoint)r, map_location="cpu"))
+built = time.perf_counter()
+print(json.dumps({"import_ms": (imported - start) * 1e3, "build_ms": (built - imported) * 1e3}))
+"""
+
+
+def bench_cold_start(mode, checkpoint=None, repeats=5):
+    r"""
+    Fresh-interpreter startup: import CA-MLIF.py and get a loaded define_net model, eager init + load_state_dict
+    against meta-device construction with assigned weights
+    """
+    root = os.path.dirname(os.path.abspath(__file__))
+    tmp = None
+    if checkpoint is None:
+        tmp = tempfile.NamedTemporaryFile(suffix=".pt", delete=False)
+        tmp.close()
+        torch.save(load_camlif().define_net(default_args(mode=mode)).state_dict(), tmp.name)
+        checkpoint = tmp.name
+    results = {}
+    try:
+        for fast in (False, True):
+            runs = []
+            for _ in range(repeats):
+                code = _COLD_START % {"root": root, "mode": mode, "fast": fast, "checkpoint": checkpoint}
+                start = time.perf_counter()
+                out = subprocess.run([sys.executable, "-c", code], check=True, capture_output=True, text=True)
+                run = json.loads(out.stdout.strip().splitlines()[-1])
+                run["process_ms"] = (time.perf_counter() - start) * 1e3
+                runs.append(run)
+            results["fast" if fast else "eager"] = {
+                key: statistics.median(run[key] for run in runs) for key in runs[0]
+            }
+    finally:
+        if tmp is not None:
+            os.unlink(tmp.name)
+    return results
+
+
+_CHECKPOINT_LOAD = """
+import json, resource, sys, time
+sys.path.insert(0, %(root)r)
+import torch
+from checkpoint import ShardedCheckpoint
+before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+start = time.perf_counter()
+if %(kind)r == "torch_load":
+    state_dict = torch.load(%(pt)r, map_location="cpu")
+else:
+    state_dict = ShardedCheckpoint(%(sharded)r).state_dict(%(prefixes)r)
+loaded = time.perf_counter()
+total = sum(float(t.float().sum()) for t in state_dict.values())  # touch every page that was loaded
+touched = time.perf_counter()
+print(json.dumps({
+    "load_ms": (loaded - start) * 1e3,
+    "load_and_touch_ms": (touched - start) * 1e3,
+    "rss_delta_mb": (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before) / 1024,
+}))
+"""
+
+
+def bench_checkpoint(mode, prefixes=None, repeats=5):
+    r"""
+    Fresh-process load time and RSS growth: torch.load of the full state dict against the mmap'ed sharded
+    format, loading everything and loading only ``prefixes``
+    """
+    from checkpoint import save_sharded
+
+    root = os.path.dirname(os.path.abspath(__file__))
+    prefixes = prefixes or ["Radiology_fc", "radiology_encoder"]
+    state_dict = load_camlif().define_net(default_args(mode=mode)).state_dict()
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        pt = os.path.join(tmp, "model.pt")
+        sharded = os.path.join(tmp, "sharded")
+        torch.save(state_dict, pt)
+        save_sharded(state_dict, sharded, metadata={"mode": mode})
+        cases = [("torch_load", None), ("sharded_full", None), ("sharded_partial", prefixes)]
+        for kind, keep in cases:
+            runs = []
+            for _ in range(repeats):
+                code = _CHECKPOINT_LOAD % {"root": root, "kind": kind, "pt": pt, "sharded": sharded, "prefixes": keep}
+                out = subprocess.run([sys.executable, "-c", code], check=True, capture_output=True, text=True)
+                runs.append(json.loads(out.stdout.strip().splitlines()[-1]))
+            results[kind] = {key: statistics.median(run[key] for run in runs) for key in runs[0]}
+    return results
+
+
+def bench_branch_scaling(threads, batch_size=16, repeats=20, warmup=3, ra_tokens=1):
+    r"""
+    rapath forward latency with sequential and concurrent branches (args.parallel_branches) per thread count
+    """
+    camlif = load_camlif()
+    sequential = camlif.define_net(default_args(mode="rapath")).eval()
+    parallel = camlif.define_net(default_args(mode="rapath", parallel_branches=1)).eval()
+    parallel.load_state_dict(sequential.state_dict())
+    inputs = synthetic_inputs(batch_size, ra_tokens=ra_tokens)
+    results = {}
+    for t in threads:
+        torch.set_num_threads(t)
+        row = {}
+        for kind, net in (("sequential", sequential), ("parallel", parallel)):
+            with torch.no_grad():
+                row[kind + "_ms"] = timeit(lambda: net(**inputs), repeats, warmup)["median_ms"]
+        row["speedup"] = row["sequential_ms"] / row["parallel_ms"]
+        results[t] = row
+    return results
+
+
+def bench_ensemble(k=5, batch_size=16, repeats=20, warmup=3, ra_tokens=1):
+    r"""
+    k fold models: sequential forwards + mean against one vmapped FoldEnsemble forward
+    """
+    from ensemble import FoldEnsemble
+
+    camlif = load_camlif()
+    args = default_args(mode="rapath", co_attention=1)
+    models = [camlif.define_net(args).eval() for _ in range(k)]
+    ensemble = FoldEnsemble(models).eval()
+    inputs = synthetic_inputs(batch_size, ra_tokens=ra_tokens)
+
+    def sequential():
+        return torch.stack([m(**inputs)[1] for m in models]).mean(dim=0)
+
+    with torch.no_grad():
+        seq = timeit(sequential, repeats, warmup)["median_ms"]
+        vec = timeit(lambda: ensemble(**inputs), repeats, warmup)["median_ms"]
+    return {
+        "sequential_ms": seq,
+        "vmap_ms": vec,
+        "sequential_throughput": batch_size / (seq / 1e3),
+        "vmap_throughput": batch_size / (vec / 1e3),
+        "speedup": seq / vec,
+    }
+
+
+def bench_mc_dropout(mode="rapath", n_samples=30, batch_size=16, chunk_size=None, repeats=5, warmup=1, ra_tokens=1):
+    r"""
+    MC-dropout: one forward per sample against the tiled, chunked batch
+    """
+    from uncertainty import mc_dropout, mc_dropout_loop
+
+    net = load_camlif().define_net(default_args(mode=mode))
+    inputs = synthetic_inputs(batch_size, ra_tokens=ra_tokens)
+    loop = timeit(lambda: mc_dropout_loop(net, inputs, n_samples), repeats, warmup)["median_ms"]
+    tiled = timeit(lambda: mc_dropout(net, inputs, n_samples, chunk_size), repeats, warmup)["median_ms"]
+    return {"loop_ms": loop, "tiled_ms": tiled, "speedup": loop / tiled}
+
+
+def bench_retrieval(n=1000000, dim=256, n_queries=100, k=10, hnsw_n=100000, n_train=100000, seed=0):
+    r"""
+    Build / query latency and recall@k of the embedding indexes against exact search, on clustered
+    synthetic embeddings. HNSW inserts one point at a time in Python, so it gets its own (smaller) n.
+    """
+    from retrieval import FlatIndex, HNSWIndex, IVFPQIndex, recall_at_k
+
+    g = torch.Generator().manual_seed(seed)
+    centers = torch.randn(1000, dim, generator=g)
+    data = centers[torch.randint(0, 1000, (n,), generator=g)] + 0.3 * torch.randn(n, dim, generator=g)
+    queries = data[torch.randint(0, n, (n_queries,), generator=g)] + 0.05 * torch.randn(n_queries, dim, generator=g)
+
+    def run(index, x, train=None):
+        start = time.perf_counter()
+        if train is not None:
+            index.train(train)
+        index.add(x)
+        build = time.perf_counter() - start
+        start = time.perf_counter()
+        _, ids = index.search(queries, k)
+        return ids, {"build_s": build, "query_ms": (time.perf_counter() - start) * 1e3 / n_queries}
+
+    results = {}
+    truth, results["flat"] = run(FlatIndex(dim), data)
+    ids, results["ivfpq"] = run(IVFPQIndex(dim), data, train=data[:n_train])
+    results["ivfpq"]["recall"] = recall_at_k(ids, truth)
+    if hnsw_n:
+        sub_truth, _ = run(FlatIndex(dim), data[:hnsw_n])
+        ids, results["hnsw"] = run(HNSWIndex(dim), data[:hnsw_n])
+        results["hnsw"]["recall"] = recall_at_k(ids, sub_truth)
+        results["hnsw"]["n"] = hnsw_n
+    return results
+
+
+def bench_cascade(n=512, cheap_mode="path", policy="boundary", max_cindex_loss=0.005, ra_tokens=1, seed=0):
+    r"""
+    Cascade serving on a synthetic cohort: share of TrCross compute saved at a fixed C-index loss.
+    The models are untrained, so only the routed fraction / latency numbers are meaningful here.
+    """
+    from cascade import CascadeModel, cascade_report
+    from predict import risk_cutoffs
+
+    camlif = load_camlif()
+    cheap = camlif.define_net(default_args(mode=cheap_mode)).eval()
+    expensive = camlif.define_net(default_args(mode="rapath")).eval()
+    g = torch.Generator().manual_seed(seed)
+    inputs = synthetic_inputs(n, ra_tokens=ra_tokens, generator=g)
+    time_ = torch.rand(n, generator=g) * 100
+    c = (torch.rand(n, generator=g) < 0.3).float()
+
+    cascade = CascadeModel(cheap, expensive, policy=policy)
+    with torch.no_grad():
+        cascade.calibrate(inputs)
+        cascade.cutoffs = risk_cutoffs(cascade._expensive_risk(inputs))
+        cheap_risk, spread = cascade._cheap_risk(inputs)
+    scale = (spread if spread is not None else cheap_risk).std().item()
+    thresholds = [scale * f for f in (0.0, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0)]
+    report = cascade_report(cascade, inputs, time_, c, thresholds, max_cindex_loss)
+    stats = {"cheap_ms": report["cheap_ms"], "expensive_ms": report["expensive_ms"], "full_c_index": report["full_c_index"]}
+    if report["selected"] is not None:
+        stats.update({k: report["selected"][k] for k in ("routed", "compute_saved", "c_index_loss")})
+    return stats
+
+
+def bench_distill(batch_size=16, repeats=20, warmup=3, ra_tokens=1):
+    r"""
+    Forward latency of TrCross against the distilled StudentNet
+    """
+    from distill import StudentNet
+
+    teacher = load_camlif().define_net(default_args(mode="rapath")).eval()
+    student = StudentNet().eval()
+    inputs = synthetic_inputs(batch_size, ra_tokens=ra_tokens)
+    with torch.no_grad():
+        t = timeit(lambda: teacher(**inputs), repeats, warmup)["median_ms"]
+        s = timeit(lambda: student(**inputs), repeats, warmup)["median_ms"]
+    return {"teacher_ms": t, "student_ms": s, "speedup": t / s}
+
+
+def bench_lowrank(mode, energy=0.9, batch_size=16, repeats=20, warmup=3, ra_tokens=1):
+    r"""
+    Parameter memory and forward latency of a define_net model before / after SVD compression
+    """
+    import copy
+
+    from lowrank import compress, parameter_bytes
+
+    net = load_camlif().define_net(default_args(mode=mode)).eval()
+    compressed = copy.deepcopy(net)
+    ranks = compress(compressed, energy=energy)
+    inputs = synthetic_inputs(batch_size, ra_tokens=ra_tokens)
+    with torch.no_grad():
+        dense = timeit(lambda: net(**inputs), repeats, warmup)["median_ms"]
+        lowrank = timeit(lambda: compressed(**inputs), repeats, warmup)["median_ms"]
+    return {
+        "layers": len(ranks),
+        "dense_mb": parameter_bytes(net) / 2 ** 20,
+        "lowrank_mb": parameter_bytes(compressed) / 2 ** 20,
+        "dense_ms": dense,
+        "lowrank_ms": lowrank,
+        "speedup": dense / lowrank,
+    }
+
+
+def bench_attention_layer(backend, n, dim=256, batch_size=1, repeats=5, warmup=1, device="cpu"):
+    layer = load_camlif().TransLayer(dim=dim, backend=backend).to(device).eval()
+    x = torch.randn(batch_size, n, dim, device=device)
+    _reset_peak(device)
+    with torch.no_grad():
+        stats = timeit(lambda: layer(x), repeats, warmup, device)
+    return {"forward_ms": stats["median_ms"], "peak_mb": _peak_mb(device)}
+
+
+def bench_attention(tokens, backends=("nystrom", "exact", "chunked", "linear"), dim=256, batch_size=1, repeats=5,
+                    warmup=1, device="cpu", isolate=False):
+    r"""
+    Forward latency and peak memory of one TransLayer per attention backend and token count,
+    each in a fresh process with isolate
+    """
+    results = {}
+    for backend in backends:
+        for n in sorted(tokens):
+            args = (backend, n, dim, batch_size, repeats, warmup, device)
+            results[(backend, n)] = isolated("bench_attention_layer", *args) if isolate else bench_attention_layer(*args)
+    return results
+
+
+_COMPILED = """
+import json, sys, time
+sys.path.insert(0, %(root)r)
+import torch
+from compiled import CompiledNet
+from utils import default_args, load_camlif, synthetic_inputs
+torch.manual_seed(0)
+net = load_camlif().define_net(default_args(mode=%(mode)r)).eval()
+compiled = CompiledNet(net, cache_dir=%(cache_dir)r)
+inputs = synthetic_inputs(%(batch_size)r)
+start = time.perf_counter()
+compiled(**inputs)
+first = time.perf_counter()
+times = []
+for _ in range(%(repeats)r):
+    t = time.perf_counter()
+    compiled(**inputs)
+    times.append(time.perf_counter() - t)
+with torch.no_grad():
+    eager = []
+    for _ in range(%(repeats)r):
+        t = time.perf_counter()
+        net(**inputs)
+        eager.append(time.perf_counter() - t)
+from compiled import save_disk_cache
+save_disk_cache(%(cache_dir)r)
+print(json.dumps({
+    "first_call_ms": (first - start) * 1e3,
+    "compiled_ms": sorted(times)[len(times) // 2] * 1e3,
+    "eager_ms": sorted(eager)[len(eager) // 2] * 1e3,
+}))
+"""
+
+
+def bench_compiled(mode="rapath", batch_size=16, repeats=20):
+    r"""
+    CompiledNet in fresh processes: first-call latency with an empty compile cache (cold) and with the
+    on-disk cache from the previous process (warm), plus steady-state compiled against eager latency
+    """
+    root = os.path.dirname(os.path.abspath(__file__))
+    results = {}
+    with tempfile.TemporaryDirectory() as cache_dir:
+        for kind in ("cold", "warm"):
+            code = _COMPILED % {"root": root, "mode": mode, "cache_dir": cache_dir, "batch_size": batch_size, "repeats": repeats}
+            out = subprocess.run([sys.executable, "-c", code], check=True, capture_output=True, text=True)
+            results[kind] = json.loads(out.stdout.strip().splitlines()[-1])
+    return results
+
+
+def _saved_bytes(fn):
+    # bytes of the distinct storages autograd keeps for backward
+    storages = {}
+
+    def pack(t):
+        storages[t.untyped_storage().data_ptr()] = t.untyped_storage().nbytes()
+        return t
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda t: t):
+        out = fn()
+    return out, sum(storages.values())
+
+
+def bench_snn(batch_size=1024, dims=(290, 512, 256), dropout=0.25, repeats=20, warmup=3):
+    r"""
+    Training step (forward + backward) and saved activation memory of an SNN_Block stack, nn.Sequential
+    against FusedSNNBlock with the same weights
+    """
+    camlif = load_camlif()
+    blocks = [camlif.SNN_Block(dims[i], dims[i + 1], dropout) for i in range(len(dims) - 1)]
+    reference = torch.nn.Sequential(*blocks).train()
+    fused = camlif.fuse_snn_blocks(torch.nn.Sequential(*[torch.nn.Sequential(*b) for b in blocks])).train()
+    x = torch.randn(batch_size, dims[0], requires_grad=True)
+    results = {}
+    for name, net in (("sequential", reference), ("fused", fused)):
+        out, saved = _saved_bytes(lambda: net(x))
+        step = timeit(lambda: net(x).sum().backward(), repeats, warmup)["median_ms"]
+        results[name + "_ms"] = step
+        results[name + "_saved_mb"] = saved / 2 ** 20
+    results["speedup"] = results["sequential_ms"] / results["fused_ms"]
+    return results
+
+
+def bench_attribution(batch_size=16, repeats=5, warmup=1, ra_tokens=1):
+    r"""
+    Modality ablation: one zero-filled TrCross forward per ablated modality against the batched scan
+    """
+    from attribution import MODALITIES, modality_ablation
+
+    net = load_camlif().define_net(default_args(mode="rapath")).eval()
+    inputs = synthetic_inputs(batch_size, ra_tokens=ra_tokens)
+
+    def loop():
+        out = [net(**inputs)[1]]
+        for m in MODALITIES:
+            out.append(net(**dict(inputs, **{m: torch.zeros_like(inputs[m])}))[1])
+        return out
+
+    with torch.no_grad():
+        naive = timeit(loop, repeats, warmup)["median_ms"]
+    batched = timeit(lambda: modality_ablation(net, inputs), repeats, warmup)["median_ms"]
+    return {"loop_ms": naive, "batched_ms": batched, "speedup": naive / batched}
+
+
+def bench_sharing(share_modes=("none", "modality", "stage", "all"), batch_size=16, repeats=10, warmup=2, ra_tokens=1):
+    r"""
+    Parameter and Adam state memory and train step latency of TrCross per args.share_transformer
+    (accuracy per mode: sweep.py --share_transformer)
+    """
+    from loss import CoxSurvLoss
+
+    results = {}
+    inputs = synthetic_inputs(batch_size, ra_tokens=ra_tokens)
+    time_, c = torch.rand(batch_size) * 100, (torch.rand(batch_size) < 0.3).float()
+    loss_fn = CoxSurvLoss()
+    for share in share_modes:
+        net = load_camlif().define_net(default_args(mode="rapath", share_transformer=share)).train()
+        optimizer = torch.optim.Adam(net.parameters(), lr=1e-4)
+
+        def step():
+            loss = loss_fn(net(**inputs)[1], time_, c)
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+
+        stats = timeit(step, repeats, warmup)
+        state = sum(t.numel() * t.element_size() for s in optimizer.state.values() for t in s.values() if torch.is_tensor(t))
+        transformer = {id(p): p for name, p in net.named_parameters() if "_encoder." in name or "_decoder." in name}
+        results[share] = {
+            "parameter_mb": sum(p.numel() * p.element_size() for p in net.parameters()) / 2 ** 20,
+            "transformer_mb": sum(p.numel() * p.element_size() for p in transformer.values()) / 2 ** 20,
+            "optimizer_state_mb": state / 2 ** 20,
+            "step_ms": stats["median_ms"],
+        }
+    return results
+
+
+def compare(results, baseline, tolerance=0.1, memory_tolerance=None):
+    r"""
+    Every latency key (``*_ms``) slower than baseline by more than tolerance, and every memory key
+    (``*_mb``) larger by more than memory_tolerance (default: tolerance), is a regression
+    """
+    memory_tolerance = tolerance if memory_tolerance is None else memory_tolerance
+    regressions = []
+    for name, stats in results.items():
+        ref = baseline.get(name)
+        if ref is None:
+            continue
+        for key, value in stats.items():
+            for suffix, tol in (("_ms", tolerance), ("_mb", memory_tolerance)):
+                if key.endswith(suffix) and key in ref and ref[key] > 0 and value > ref[key] * (1 + tol):
+                    regressions.append("%s %s: %.3f %s -> %.3f %s (+%.1f%%)" % (
+                        name, key, ref[key], suffix[1:], value, suffix[1:], 100 * (value / ref[key] - 1)))
+    return regressions
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="CA-MLIF micro-benchmarks")
+    parser.add_argument("--modes", nargs="*", default=list(NET_MODES))
+    parser.add_argument("--losses", nargs="*", default=list(LOSS_TYPES))
+    parser.add_argument("--batch_sizes", nargs="*", type=int, default=[1, 16, 64])
+    parser.add_argument("--threads", nargs="*", type=int, default=[1, torch.get_num_threads()])
+    parser.add_argument("--ra_tokens", type=int, default=1)
+    parser.add_argument("--repeats", type=int, default=20)
+    parser.add_argument("--warmup", type=int, default=3)
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--output", default="bench_results.json")
+    parser.add_argument("--baseline", default=None, help="results json of a previous run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.1)
+    parser.add_argument("--memory_tolerance", type=float, default=None, help="for *_mb keys, default: --tolerance")
+    parser.add_argument("--in_process", action="store_true",
+                        help="run every configuration in this process (faster, CPU peak memory not comparable)")
+    parser.add_argument("--cold_start", action="store_true", help="also measure fresh-process model startup")
+    parser.add_argument("--checkpoint", default=None, help="state dict used by --cold_start, default: a fresh one")
+    parser.add_argument("--branch_scaling", action="store_true", help="also compare sequential and concurrent branches")
+    parser.add_argument("--ensemble", type=int, default=0, help="also compare a k-fold loop against FoldEnsemble")
+    parser.add_argument("--mc_dropout", type=int, default=0, help="also compare T looped MC-dropout forwards to one tiled forward")
+    parser.add_argument("--retrieval", type=int, default=0, help="also benchmark the embedding indexes at this size")
+    parser.add_argument("--cascade", type=int, default=0, help="also measure cascade serving on a cohort of this size")
+    parser.add_argument("--distill", action="store_true", help="also compare TrCross against the distilled student")
+    parser.add_argument("--lowrank", nargs="*", type=float, default=[], help="also measure SVD compression at these energy thresholds")
+    parser.add_argument("--attention", nargs="*", type=int, default=[], help="also compare attention backends at these token counts")
+    parser.add_argument("--compiled", action="store_true", help="also measure cold / warm torch.compile startup and latency")
+    parser.add_argument("--fused_snn", action="store_true", help="also compare SNN_Block against FusedSNNBlock")
+    parser.add_argument("--attribution", action="store_true", help="also compare looped and batched modality ablation")
+    parser.add_argument("--sharing", action="store_true", help="also compare the TrCross Transformer sharing modes")
+    parser.add_argument("--checkpoint_io", action="store_true", help="also compare torch.load against sharded mmap loading")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    # CPU peak memory is a process high water mark, measure each configuration in a fresh process
+    isolate = not args.in_process and torch.device(args.device).type == "cpu"
+
+    def run(fn, *fn_args):
+        return isolated(fn.__name__, *fn_args) if isolate else fn(*fn_args)
+
+    results = {}
+    for threads in args.threads:
+        torch.set_num_threads(threads)
+        for batch_size in args.batch_sizes:
+            for mode in args.modes:
+                name = "net/%s/bs%d/t%d" % (mode, batch_size, threads)
+                results[name] = run(bench_net, mode, batch_size, args.repeats, args.warmup, args.ra_tokens, args.device)
+                print("%-40s fwd %8.3f ms  fwd+bwd %8.3f ms  %10.1f samples/s" % (
+                    name, results[name]["forward_ms"], results[name]["forward_backward_ms"], results[name]["throughput"]))
+            for loss_type in args.losses:
+                name = "loss/%s/bs%d/t%d" % (loss_type, batch_size, threads)
+                results[name] = run(bench_loss, loss_type, batch_size, args.repeats, args.warmup, args.device)
+                print("%-40s fwd+bwd %8.3f ms" % (name, results[name]["forward_backward_ms"]))
+
+    if args.cold_start:
+        for mode in args.modes:
+            for kind, stats in bench_cold_start(mode, args.checkpoint, repeats=5).items():
+                name = "cold_start/%s/%s" % (mode, kind)
+                results[name] = stats
+                print("%-40s import %8.1f ms  build %8.1f ms  process %8.1f ms" % (
+                    name, stats["import_ms"], stats["build_ms"], stats["process_ms"]))
+
+    if args.branch_scaling:
+        for batch_size in args.batch_sizes:
+            for t, stats in bench_branch_scaling(args.threads, batch_size, args.repeats, args.warmup, args.ra_tokens).items():
+                name = "branches/bs%d/t%d" % (batch_size, t)
+                results[name] = stats
+                print("%-40s sequential %8.3f ms  parallel %8.3f ms  x%.2f" % (
+                    name, stats["sequential_ms"], stats["parallel_ms"], stats["speedup"]))
+
+    if args.ensemble > 0:
+        for batch_size in args.batch_sizes:
+            stats = bench_ensemble(args.ensemble, batch_size, args.repeats, args.warmup, args.ra_tokens)
+            name = "ensemble/k%d/bs%d" % (args.ensemble, batch_size)
+            results[name] = stats
+            print("%-40s loop %8.3f ms  vmap %8.3f ms  x%.2f" % (
+                name, stats["sequential_ms"], stats["vmap_ms"], stats["speedup"]))
+
+    if args.mc_dropout > 0:
+        for mode in args.modes:
+            for batch_size in args.batch_sizes:
+                stats = bench_mc_dropout(mode, args.mc_dropout, batch_size, ra_tokens=args.ra_tokens)
+                name = "mc_dropout/%s/T%d/bs%d" % (mode, args.mc_dropout, batch_size)
+                results[name] = stats
+                print("%-40s loop %8.3f ms  tiled %8.3f ms  x%.2f" % (
+                    name, stats["loop_ms"], stats["tiled_ms"], stats["speedup"]))
+
+    if args.retrieval > 0:
+        for kind, stats in bench_retrieval(args.retrieval, hnsw_n=min(args.retrieval, 100000)).items():
+            name = "retrieval/%s/n%d" % (kind, stats.get("n", args.retrieval))
+            results[name] = stats
+            print("%-40s build %8.1f s  query %8.3f ms  recall %s" % (
+                name, stats["build_s"], stats["query_ms"], "%.3f" % stats["recall"] if "recall" in stats else "exact"))
+
+    if args.cascade > 0:
+        stats = bench_cascade(args.cascade, ra_tokens=args.ra_tokens)
+        name = "cascade/n%d" % args.cascade
+        results[name] = stats
+        print("%-40s cheap %8.3f ms  rapath %8.3f ms  routed %s  saved %s" % (
+            name, stats["cheap_ms"], stats["expensive_ms"], stats.get("routed"), stats.get("compute_saved")))
+
+    if args.distill:
+        for batch_size in args.batch_sizes:
+            stats = bench_distill(batch_size, args.repeats, args.warmup, args.ra_tokens)
+            name = "distill/bs%d" % batch_size
+            results[name] = stats
+            print("%-40s teacher %8.3f ms  student %8.3f ms  x%.2f" % (
+                name, stats["teacher_ms"], stats["student_ms"], stats["speedup"]))
+
+    for energy in args.lowrank:
+        for mode in args.modes:
+            for batch_size in args.batch_sizes:
+                stats = bench_lowrank(mode, energy, batch_size, args.repeats, args.warmup, args.ra_tokens)
+                name = "lowrank/%s/e%g/bs%d" % (mode, energy, batch_size)
+                results[name] = stats
+                print("%-40s %7.1f -> %7.1f MB  dense %8.3f ms  lowrank %8.3f ms  x%.2f" % (
+                    name, stats["dense_mb"], stats["lowrank_mb"], stats["dense_ms"], stats["lowrank_ms"], stats["speedup"]))
+
+    if args.attention:
+        for (backend, n), stats in bench_attention(args.attention, device=args.device, isolate=isolate).items():
+            name = "attention/%s/n%d" % (backend, n)
+            results[name] = stats
+            print("%-40s fwd %10.3f ms  peak %8.1f MB" % (name, stats["forward_ms"], stats["peak_mb"]))
+
+    if args.compiled:
+        for mode in args.modes:
+            for batch_size in args.batch_sizes:
+                for kind, stats in bench_compiled(mode, batch_size, args.repeats).items():
+                    name = "compiled/%s/bs%d/%s" % (mode, batch_size, kind)
+                    results[name] = stats
+                    print("%-40s first call %10.1f ms  compiled %8.3f ms  eager %8.3f ms" % (
+                        name, stats["first_call_ms"], stats["compiled_ms"], stats["eager_ms"]))
+
+    if args.fused_snn:
+        for batch_size in args.batch_sizes:
+            stats = bench_snn(batch_size, repeats=args.repeats, warmup=args.warmup)
+            name = "fused_snn/bs%d" % batch_size
+            results[name] = stats
+            print("%-40s step %8.3f -> %8.3f ms  saved %7.2f -> %7.2f MB" % (
+                name, stats["sequential_ms"], stats["fused_ms"], stats["sequential_saved_mb"], stats["fused_saved_mb"]))
+
+    if args.attribution:
+        for batch_size in args.batch_sizes:
+            stats = bench_attribution(batch_size, ra_tokens=args.ra_tokens)
+            name = "attribution/bs%d" % batch_size
+            results[name] = stats
+            print("%-40s loop %8.3f ms  batched %8.3f ms  x%.2f" % (
+                name, stats["loop_ms"], stats["batched_ms"], stats["speedup"]))
+
+    if args.sharing:
+        for share, stats in bench_sharing(ra_tokens=args.ra_tokens).items():
+            name = "sharing/%s" % share
+            results[name] = stats
+            print("%-40s params %7.2f MB  transformers %7.2f MB  adam %7.2f MB  step %8.3f ms" % (
+                name, stats["parameter_mb"], stats["transformer_mb"], stats["optimizer_state_mb"], stats["step_ms"]))
+
+    if args.checkpoint_io:
+        for mode in args.modes:
+            for kind, stats in bench_checkpoint(mode).items():
+                name = "checkpoint/%s/%s" % (mode, kind)
+                results[name] = stats
+                print("%-40s load %8.1f ms  load+touch %8.1f ms  rss +%8.1f MB" % (
+                    name, stats["load_ms"], stats["load_and_touch_ms"], stats["rss_delta_mb"]))
+
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance, args.memory_tolerance)
+        if regressions:
+            print("performance regressions against %s:" % args.baseline)
+            for line in regressions:
+                print("  " + line)
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
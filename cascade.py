@@ -0,0 +1,140 @@
+import time
+
+import torch
+from torch import nn
+
+from evaluator import concordance_index, risk_from_hazards
+from uncertainty import mc_dropout
+
+
+def _select(inputs, mask):
+    return {k: v[mask] for k, v in inputs.items()}
+
+
+class CascadeModel(nn.Module):
+    r"""
+    Two-tier inference: a cheap model scores every patient, only the uncertain ones go to TrCross
+
+    A patient is routed to the expensive tier when
+      - policy "boundary": its calibrated cheap risk is within ``threshold`` of a risk-group cutoff, or
+      - policy "uncertainty": the MC-dropout std of its cheap risk is above ``threshold``.
+
+    The two tiers output risks on different scales, so the cheap risk is mapped onto the expensive
+    one with an affine fit (calibrate) before merging.
+
+    args:
+        cheap (nn.Module): e.g. define_net mode "path" (PATHNet2 on the concatenated pathomics)
+        expensive (nn.Module): define_net mode "rapath"
+        policy (str): "boundary" or "uncertainty"
+        threshold (float): routing threshold, see above
+        cutoffs (Tensor): risk-group cutoffs on the expensive scale (predict.risk_cutoffs)
+        mc_samples (int): MC-dropout samples for the "uncertainty" policy
+    """
+
+    def __init__(self, cheap, expensive, policy="boundary", threshold=0.1, cutoffs=None, mc_samples=16, output_index=1):
+        super(CascadeModel, self).__init__()
+        if policy not in ("boundary", "uncertainty"):
+            raise NotImplementedError("cascade policy [%s] is not found" % policy)
+        self.cheap = cheap
+        self.expensive = expensive
+        self.policy = policy
+        self.threshold = threshold
+        self.mc_samples = mc_samples
+        self.output_index = output_index
+        self.register_buffer("cutoffs", torch.zeros(0) if cutoffs is None else torch.as_tensor(cutoffs, dtype=torch.float))
+        self.register_buffer("scale", torch.ones(1))
+        self.register_buffer("shift", torch.zeros(1))
+
+    def _cheap_risk(self, inputs):
+        if self.policy == "uncertainty":
+            samples = mc_dropout(self.cheap, inputs, self.mc_samples, output_index=self.output_index)["samples"]
+            T, B, K = samples.shape
+            risks = risk_from_hazards(samples.reshape(T * B, K)).reshape(T, B)
+            risk = risks.mean(dim=0)
+            spread = risks.std(dim=0) * self.scale.abs()  # on the expensive tier's scale, like the cutoffs
+        else:
+            risk = risk_from_hazards(self.cheap(**inputs)[self.output_index])
+            spread = None
+        return risk * self.scale + self.shift, spread
+
+    def _expensive_risk(self, inputs):
+        return risk_from_hazards(self.expensive(**inputs)[self.output_index])
+
+    def route(self, risk, spread=None, threshold=None):
+        r"""
+        Boolean mask of patients that need the expensive tier
+        """
+        threshold = self.threshold if threshold is None else threshold
+        if self.policy == "uncertainty":
+            return spread > threshold
+        if self.cutoffs.numel() == 0:
+            return torch.ones_like(risk, dtype=torch.bool)
+        margin = (risk[:, None] - self.cutoffs[None, :].to(risk.device)).abs().min(dim=1).values
+        return margin < threshold
+
+    @torch.no_grad()
+    def calibrate(self, inputs):
+        r"""
+        Least-squares affine map from cheap risk to expensive risk on a calibration cohort
+        """
+        self.scale.fill_(1.0)
+        self.shift.fill_(0.0)
+        cheap = risk_from_hazards(self.cheap(**inputs)[self.output_index]).float()
+        target = self._expensive_risk(inputs).float()
+        A = torch.stack([cheap, torch.ones_like(cheap)], dim=1)
+        sol = torch.linalg.lstsq(A, target[:, None]).solution.reshape(-1)
+        self.scale.fill_(sol[0].item())
+        self.shift.fill_(sol[1].item())
+        return self
+
+    @torch.no_grad()
+    def forward(self, **inputs):
+        risk, spread = self._cheap_risk(inputs)
+        routed = self.route(risk, spread)
+        if routed.any():
+            risk = risk.clone()
+            risk[routed] = self._expensive_risk(_select(inputs, routed)).to(risk.dtype)
+        return risk, routed
+
+
+@torch.no_grad()
+def cascade_report(cascade, inputs, time_, c, thresholds, max_cindex_loss=0.005, repeats=3):
+    r"""
+    Sweep routing thresholds on a validation cohort and report routed fraction, compute saved and
+    C-index against running TrCross on everyone
+
+    Both tiers are evaluated once on the whole cohort; every threshold is then simulated with a
+    torch.where, and compute is estimated from each tier's measured per-patient latency. The
+    returned "selected" entry is the threshold with the most compute saved whose C-index loss stays
+    within max_cindex_loss.
+    """
+    cascade.eval()
+
+    def timed(fn):
+        fn()
+        start = time.perf_counter()
+        for _ in range(repeats):
+            out = fn()
+        return out, (time.perf_counter() - start) / repeats
+
+    (cheap_risk, spread), t_cheap = timed(lambda: cascade._cheap_risk(inputs))
+    exp_risk, t_exp = timed(lambda: cascade._expensive_risk(inputs))
+    full = concordance_index(exp_risk, time_, c).item()
+
+    rows = []
+    for th in thresholds:
+        routed = cascade.route(cheap_risk, spread, th)
+        merged = torch.where(routed, exp_risk.to(cheap_risk.dtype), cheap_risk)
+        frac = routed.float().mean().item()
+        cost = t_cheap + frac * t_exp
+        cidx = concordance_index(merged, time_, c).item()
+        rows.append({
+            "threshold": float(th),
+            "routed": frac,
+            "compute_saved": 1 - cost / t_exp,
+            "c_index": cidx,
+            "c_index_loss": full - cidx,
+        })
+    ok = [r for r in rows if r["c_index_loss"] <= max_cindex_loss]
+    selected = max(ok, key=lambda r: r["compute_saved"]) if ok else None
+    return {"full_c_index": full, "cheap_ms": t_cheap * 1e3, "expensive_ms": t_exp * 1e3, "sweep": rows, "selected": selected}
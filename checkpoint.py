@@ -0,0 +1,185 @@
+import json
+import mmap
+import os
+import struct
+from collections import OrderedDict
+
+import torch
+
+# safetensors dtype tags, shard files are readable by the safetensors package as well
+_DTYPES = {
+    torch.float64: "F64",
+    torch.float32: "F32",
+    torch.float16: "F16",
+    torch.bfloat16: "BF16",
+    torch.int64: "I64",
+    torch.int32: "I32",
+    torch.int16: "I16",
+    torch.int8: "I8",
+    torch.uint8: "U8",
+    torch.bool: "BOOL",
+}
+_TAGS = {v: k for k, v in _DTYPES.items()}
+
+INDEX_FILE = "index.json"
+ROOT_SHARD = "__root__"  # file stem shared by the module's own parameters and buffers (e.g. output_range)
+
+
+def shard_prefix(key):
+    # "Pathomics_fc.2.0.weight" -> "Pathomics_fc", one shard per top-level submodule
+    return key.split(".", 1)[0]
+
+
+def _write_shard(path, tensors, metadata=None):
+    tensors = OrderedDict(
+        sorted(tensors.items(), key=lambda kv: (-kv[1].element_size(), kv[0]))
+    )  # widest dtype first keeps every tensor aligned to its element size
+    header = OrderedDict()
+    offset = 0
+    for name, t in tensors.items():
+        nbytes = t.numel() * t.element_size()
+        header[name] = {"dtype": _DTYPES[t.dtype], "shape": list(t.shape), "data_offsets": [offset, offset + nbytes]}
+        offset += nbytes
+    if metadata:
+        header["__metadata__"] = {k: str(v) for k, v in metadata.items()}
+    header = json.dumps(header, separators=(",", ":")).encode("utf-8")
+    header += b" " * (-len(header) % 8)  # data section starts 8-byte aligned
+
+    with open(path, "wb") as f:
+        f.write(struct.pack("<Q", len(header)))
+        f.write(header)
+        for t in tensors.values():
+            if t.numel() > 0:
+                f.write(t.reshape(-1).view(torch.uint8).numpy().tobytes())
+
+
+def save_sharded(state_dict, path, metadata=None):
+    r"""
+    Write a state dict (or a module) as one safetensors-format shard per top-level submodule plus an index,
+    the module's own parameters and buffers go to one shared shard
+
+    args:
+        state_dict (dict or nn.Module): weights to save
+        path (str): output directory
+        metadata (dict): free-form string metadata (e.g. mode, feature_dim) stored in the index and
+            in every shard's safetensors header
+    """
+    if isinstance(state_dict, torch.nn.Module):
+        state_dict = state_dict.state_dict()
+    os.makedirs(path, exist_ok=True)
+
+    groups = OrderedDict()
+    aliases = {}
+    shards = OrderedDict()
+    seen = {}
+    for key, t in state_dict.items():
+        # tied weights are stored once, later keys alias the first occurrence; the key is taken from the
+        # source tensor, a copy to the CPU would give every tensor of a CUDA model its own storage
+        ptr = (t.device, t.data_ptr(), t.dtype, tuple(t.shape)) if t.numel() > 0 else None
+        if ptr is not None and ptr in seen:
+            aliases[key] = seen[ptr]
+            continue
+        if ptr is not None:
+            seen[ptr] = key
+        prefix = shard_prefix(key)
+        # top-level tensors share one file instead of one tiny shard each
+        stem = prefix if "." in key else ROOT_SHARD
+        groups.setdefault(stem, OrderedDict())[key] = t.detach().to("cpu").contiguous()
+        shards[prefix] = "%s.safetensors" % stem
+
+    for stem, tensors in groups.items():
+        _write_shard(os.path.join(path, "%s.safetensors" % stem), tensors, dict(metadata or {}, format="pt"))
+
+    with open(os.path.join(path, INDEX_FILE), "w") as f:
+        json.dump({"shards": shards, "aliases": aliases, "metadata": metadata or {}}, f, indent=2)
+
+
+class _Shard(object):
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            (n,) = struct.unpack("<Q", f.read(8))
+            self.header = json.loads(f.read(n).decode("utf-8"))
+            self.data_start = 8 + n
+            size = os.fstat(f.fileno()).st_size
+            # copy-on-write mapping: pages are shared with the page cache until a tensor is written to
+            self.buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY) if size > self.data_start else None
+        self.metadata = self.header.pop("__metadata__", {})
+
+    def keys(self):
+        return self.header.keys()
+
+    def tensor(self, name):
+        info = self.header[name]
+        dtype = _TAGS[info["dtype"]]
+        begin, end = info["data_offsets"]
+        shape = info["shape"]
+        if end == begin:
+            return torch.empty(shape, dtype=dtype)
+        count = (end - begin) // torch.empty((), dtype=dtype).element_size()
+        return torch.frombuffer(self.buffer, dtype=dtype, count=count, offset=self.data_start + begin).reshape(shape)
+
+
+class ShardedCheckpoint(object):
+    r"""
+    Lazy, memory-mapped reader for checkpoints written by save_sharded
+
+    Shards are opened on first access, tensors are zero-copy views of the mapped files.
+
+    Usage:
+        ckpt = ShardedCheckpoint("fold0/")
+        ckpt.load_into(net, prefixes=["Radiology_fc", "radiology_encoder"])
+        net.fusion.load_state_dict(ckpt.submodule("fusion"))
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, INDEX_FILE)) as f:
+            index = json.load(f)
+        self.shards = index["shards"]
+        self.aliases = index.get("aliases", {})
+        self.metadata = index.get("metadata", {})
+        self._open = {}
+
+    @property
+    def prefixes(self):
+        return list(self.shards.keys())
+
+    def _shard(self, prefix):
+        filename = self.shards[prefix]
+        if filename not in self._open:
+            self._open[filename] = _Shard(os.path.join(self.path, filename))
+        return self._open[filename]
+
+    def _shard_keys(self, prefix):
+        # the root file holds several prefixes
+        return [k for k in self._shard(prefix).keys() if shard_prefix(k) == prefix]
+
+    def keys(self, prefixes=None):
+        if prefixes is None:
+            # a submodule made only of tied tensors (e.g. a shared Transformer) has aliases but no shard
+            return [k for p in self.prefixes for k in self._shard_keys(p)] + list(self.aliases)
+        keys = [k for p in prefixes if p in self.shards for k in self._shard_keys(p)]
+        keys += [k for k in self.aliases if shard_prefix(k) in prefixes]
+        return keys
+
+    def __getitem__(self, key):
+        key = self.aliases.get(key, key)
+        return self._shard(shard_prefix(key)).tensor(key)
+
+    def state_dict(self, prefixes=None):
+        return OrderedDict((k, self[k]) for k in self.keys(prefixes))
+
+    def submodule(self, prefix):
+        # state dict of one submodule with its prefix stripped, ready for submodule.load_state_dict
+        strip = len(prefix) + 1
+        return OrderedDict((k[strip:], self[k]) for k in self.keys([shard_prefix(prefix)]) if k.startswith(prefix + "."))
+
+    def load_into(self, model, prefixes=None, assign=False):
+        r"""
+        Load the given shards (default: all) into model, returns the missing / unexpected keys like load_state_dict
+
+        With assign=True the module's parameters become the mmap-backed tensors themselves (no copy),
+        which also works for modules constructed on the meta device.
+        """
+        state_dict = self.state_dict(prefixes)
+        return model.load_state_dict(state_dict, strict=prefixes is None, assign=assign)
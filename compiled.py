@@ -0,0 +1,157 @@
+import bisect
+import os
+import warnings
+
+import torch
+from torch import nn
+
+BATCH_BUCKETS = (1, 8, 32, 128)
+TOKEN_BUCKETS = (1, 4, 16, 64)
+CACHE_FILE = "compile_cache.bin"
+
+
+def enable_disk_cache(cache_dir):
+    r"""
+    Keep inductor's compiled graphs in cache_dir so a restarted process reuses them instead of recompiling.
+    Call before the first compilation.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    os.environ["TORCHINDUCTOR_CACHE_DIR"] = os.path.abspath(cache_dir)
+    os.environ.setdefault("TORCHINDUCTOR_FX_GRAPH_CACHE", "1")
+    try:
+        import torch._inductor.config as inductor_config
+
+        inductor_config.fx_graph_cache = True
+    except ImportError:
+        pass
+    # portable artifact bundle (torch >= 2.6), also restores dynamo / autotuning state
+    path = os.path.join(cache_dir, CACHE_FILE)
+    if os.path.exists(path) and hasattr(torch.compiler, "load_cache_artifacts"):
+        with open(path, "rb") as f:
+            torch.compiler.load_cache_artifacts(f.read())
+
+
+def save_disk_cache(cache_dir):
+    if not hasattr(torch.compiler, "save_cache_artifacts"):
+        return False
+    artifacts = torch.compiler.save_cache_artifacts()
+    if artifacts is None:
+        return False
+    with open(os.path.join(cache_dir, CACHE_FILE), "wb") as f:
+        f.write(artifacts[0])
+    return True
+
+
+def _bucket(value, buckets):
+    i = bisect.bisect_left(buckets, value)
+    return buckets[i] if i < len(buckets) else None
+
+
+def _pad(x, dim, size):
+    if x.size(dim) == size:
+        return x
+    shape = list(x.shape)
+    shape[dim] = size - x.size(dim)
+    return torch.cat([x, x.new_zeros(shape)], dim=dim)
+
+
+class CompiledNet(nn.Module):
+    r"""
+    Inference wrapper that runs a define_net model through torch.compile at a few static shapes
+
+    The batch is zero-padded up to the next batch bucket and the outputs are sliced back, which is
+    exact because patients never interact in eval mode. Radiomics token counts are padded to a token
+    bucket only for networks built with args.missing_modality, where the padded tokens are masked
+    out (ra_mask); other networks need an exact token bucket. Shapes beyond the largest bucket, and
+    buckets whose compilation fails, run eagerly.
+
+    args:
+        net (nn.Module): define_net model, used in eval mode
+        batch_buckets (tuple): static batch sizes
+        token_buckets (tuple): static radiomics token counts
+        cache_dir (str): on-disk compile cache shared across processes (enable_disk_cache)
+        compile_kwargs (dict): passed to torch.compile, e.g. {"mode": "max-autotune"}
+    """
+
+    def __init__(self, net, batch_buckets=BATCH_BUCKETS, token_buckets=TOKEN_BUCKETS, cache_dir=None, **compile_kwargs):
+        super(CompiledNet, self).__init__()
+        self.net = net.eval()
+        if getattr(net, "parallel_branches", False):
+            net.parallel_branches = False  # the thread pool cannot be traced, the compiled graph schedules both branches
+        self.batch_buckets = tuple(sorted(batch_buckets))
+        self.token_buckets = tuple(sorted(token_buckets))
+        self.cache_dir = cache_dir
+        if cache_dir is not None:
+            enable_disk_cache(cache_dir)
+        import torch._dynamo
+
+        # one graph per bucket pair, keep them all
+        torch._dynamo.config.cache_size_limit = max(torch._dynamo.config.cache_size_limit,
+                                                    2 * len(self.batch_buckets) * len(self.token_buckets))
+        self.compiled = torch.compile(net, dynamic=False, **compile_kwargs)
+        self.failed = set()
+        self.stats = {"compiled": 0, "eager": 0}
+
+    def bucket(self, inputs):
+        r"""
+        (batch, tokens) bucket for inputs, None when they have to run eagerly
+        """
+        B = next(iter(inputs.values())).size(0)
+        b = _bucket(B, self.batch_buckets)
+        t = None
+        if "ra" in inputs and inputs["ra"].dim() == 3:
+            T = inputs["ra"].size(1)
+            if getattr(self.net, "missing_modality", False):
+                t = _bucket(T, self.token_buckets)
+            else:
+                t = T if T in self.token_buckets else None
+            if t is None:
+                return None
+        if b is None or (b, t) in self.failed:
+            return None
+        return b, t
+
+    def _padded(self, inputs, b, t):
+        B = next(iter(inputs.values())).size(0)
+        out = {}
+        if t is not None and getattr(self.net, "missing_modality", False):
+            T = inputs["ra"].size(1)
+            ra_mask = inputs.get("ra_mask")
+            if ra_mask is None:
+                ra_mask = torch.ones(B, T, dtype=torch.bool, device=inputs["ra"].device)
+            elif ra_mask.dim() == 1:
+                ra_mask = ra_mask[:, None].expand(B, T)
+            out["ra_mask"] = _pad(ra_mask, 1, t)
+            out["ra"] = _pad(inputs["ra"], 1, t)
+            if "pa_mask" not in inputs:
+                out["pa_mask"] = torch.ones(B, 4, dtype=torch.bool, device=inputs["ra"].device)
+        for k, v in inputs.items():
+            out.setdefault(k, v)
+        return {k: _pad(v, 0, b) for k, v in out.items()}
+
+    @torch.no_grad()
+    def forward(self, **inputs):
+        key = self.bucket(inputs)
+        if key is None:
+            self.stats["eager"] += 1
+            return self.net(**inputs)
+        B = next(iter(inputs.values())).size(0)
+        try:
+            outputs = self.compiled(**self._padded(inputs, *key))
+        except Exception as e:
+            warnings.warn("compilation failed for bucket %s, running it eagerly: %s" % (key, e))
+            self.failed.add(key)
+            self.stats["eager"] += 1
+            return self.net(**inputs)
+        self.stats["compiled"] += 1
+        return tuple(o[:B] for o in outputs)
+
+    def warmup(self, make_inputs):
+        r"""
+        Compile every bucket ahead of time, make_inputs(batch_size, ra_tokens) builds example inputs
+        """
+        for b in self.batch_buckets:
+            for t in self.token_buckets:
+                self(**make_inputs(b, t))
+        if self.cache_dir is not None:
+            save_disk_cache(self.cache_dir)
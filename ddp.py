@@ -0,0 +1,254 @@
+import argparse
+import json
+import math
+import os
+import socket
+import sys
+import tempfile
+import time
+
+import torch
+import torch.distributed as dist
+from torch.utils.data import Sampler
+
+from loss import CoxSurvLoss, define_loss
+from utils import FEATURE_DIMS, check_loss, default_args, load_camlif, synthetic_inputs
+
+
+class CensoringBalancedSampler(Sampler):
+    r"""
+    DistributedSampler that deals censored and uncensored patients to the ranks separately, so every
+    rank (and every local batch) sees the cohort's censoring rate
+
+    Each stratum is shuffled with seed + epoch, padded by repetition to a multiple of num_replicas and
+    dealt round-robin; a rank's share of both strata is then shuffled together.
+
+    args:
+        c (Tensor): [N] censorship status, 0 or 1
+        num_replicas (int), rank (int): default: from the process group
+    """
+
+    def __init__(self, c, num_replicas=None, rank=None, shuffle=True, seed=0):
+        if num_replicas is None:
+            num_replicas = dist.get_world_size() if dist.is_initialized() else 1
+        if rank is None:
+            rank = dist.get_rank() if dist.is_initialized() else 0
+        c = torch.as_tensor(c).reshape(-1).bool()
+        self.strata = [torch.nonzero(c).reshape(-1), torch.nonzero(~c).reshape(-1)]
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+        self.num_samples = sum(math.ceil(s.numel() / num_replicas) for s in self.strata)
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __iter__(self):
+        g = torch.Generator().manual_seed(self.seed + self.epoch)
+        mine = []
+        for stratum in self.strata:
+            if stratum.numel() == 0:
+                continue
+            idx = stratum[torch.randperm(stratum.numel(), generator=g)] if self.shuffle else stratum
+            total = math.ceil(idx.numel() / self.num_replicas) * self.num_replicas
+            idx = idx.repeat(math.ceil(total / idx.numel()))[:total]
+            mine.append(idx[self.rank::self.num_replicas])
+        mine = torch.cat(mine)
+        if self.shuffle:
+            mine = mine[torch.randperm(mine.numel(), generator=g)]
+        return iter(mine.tolist())
+
+    def __len__(self):
+        return self.num_samples
+
+
+def gather(x, differentiable=False):
+    r"""
+    Concatenate x from every rank along dim 0 (equal sizes); differentiable gathers send each rank's
+    gradient back to the rank that produced the slice
+    """
+    if not dist.is_initialized() or dist.get_world_size() == 1:
+        return x
+    if differentiable:
+        from torch.distributed.nn.functional import all_gather
+
+        return torch.cat(all_gather(x))
+    out = [torch.empty_like(x) for _ in range(dist.get_world_size())]
+    dist.all_gather(out, x)
+    return torch.cat(out)
+
+
+def surv_loss(loss_fn, hazards, time, c, Y=None):
+    r"""
+    CoxSurvLoss on the global batch (risk sets span every rank), other losses on the local batch
+    """
+    if isinstance(loss_fn, list):
+        loss_fn = loss_fn[0]  # the auxiliary terms need model internals, only the survival term is used
+    if isinstance(loss_fn, CoxSurvLoss):
+        return loss_fn(gather(hazards, differentiable=True), gather(time), gather(c))
+    return loss_fn(hazards=hazards, S=None, Y=Y, c=c)
+
+
+def load_cohort(opt):
+    if opt.data is None:
+        g = torch.Generator().manual_seed(opt.seed)
+        inputs = synthetic_inputs(opt.synthetic, ra_tokens=opt.ra_tokens, generator=g)
+        labels = {"time": torch.rand(opt.synthetic, generator=g) * 100,
+                  "c": (torch.rand(opt.synthetic, generator=g) < 0.3).float()}
+        return inputs, labels
+    import pyarrow.parquet as pq
+
+    from ingest import load_features
+
+    inputs = load_features(opt.data, opt.mode, cache_dir=opt.cache_dir, ra_tokens=opt.ra_tokens)
+    columns = [opt.time_column, opt.censor_column] + ([opt.label_column] if opt.label_column else [])
+    table = pq.read_table(opt.data, columns=columns)
+    labels = {"time": torch.as_tensor(table.column(opt.time_column).to_numpy()).float(),
+              "c": torch.as_tensor(table.column(opt.censor_column).to_numpy()).float()}
+    if opt.label_column:
+        labels["Y"] = torch.as_tensor(table.column(opt.label_column).to_numpy()).long()
+    return inputs, labels
+
+
+def train(rank, world_size, opt, init_method):
+    r"""
+    One rank: gloo process group, DDP-wrapped define_net model, censoring-balanced shards
+    """
+    torch.set_num_threads(opt.threads)
+    dist.init_process_group("gloo", init_method=init_method, rank=rank, world_size=world_size)
+    try:
+        inputs, labels = load_cohort(opt)
+        # one hazard per time bin for the discrete-time losses
+        label_dim = 1 if opt.loss == "cox_surv" else int(labels["Y"].max()) + 1
+        torch.manual_seed(opt.seed)  # identical initial weights on every rank
+        args = default_args(mode=opt.mode, loss=opt.loss, feature_dim=opt.feature_dim, co_attention=opt.co_attention,
+                            label_dim=label_dim)
+        net = load_camlif().define_net(args)
+        # TrCross keeps heads it never calls (classifier, bbox_embed)
+        model = torch.nn.parallel.DistributedDataParallel(net, find_unused_parameters=True)
+        loss_fn = define_loss(args)
+        optimizer = torch.optim.Adam(model.parameters(), lr=opt.lr, weight_decay=opt.weight_decay)
+
+        sampler = CensoringBalancedSampler(labels["c"], world_size, rank, seed=opt.seed)
+        epochs = []
+        for epoch in range(opt.epochs):
+            sampler.set_epoch(epoch)
+            order = torch.tensor(list(sampler))
+            model.train()
+            start = time.perf_counter()
+            total, steps = 0.0, 0
+            # equal step counts on every rank, the collectives of the last step must line up
+            for s in range(0, len(sampler) - opt.batch_size + 1, opt.batch_size):
+                idx = order[s:s + opt.batch_size]
+                batch = {k: v[idx] for k, v in inputs.items()}
+                hazards = model(**batch)[1]
+                Y = labels["Y"][idx] if "Y" in labels else None
+                loss = surv_loss(loss_fn, hazards, labels["time"][idx], labels["c"][idx], Y)
+                optimizer.zero_grad()
+                loss.backward()
+                optimizer.step()
+                total += loss.item()
+                steps += 1
+            seconds = time.perf_counter() - start
+            epochs.append({"epoch": epoch, "loss": total / max(steps, 1), "seconds": seconds,
+                           "samples_per_s": steps * opt.batch_size * world_size / seconds})
+            if rank == 0 and opt.log:
+                print("epoch %d: loss %.4f, %.1f samples/s" % (epoch, epochs[-1]["loss"], epochs[-1]["samples_per_s"]))
+        if rank == 0:
+            if opt.output is not None:
+                torch.save(net.state_dict(), opt.output)
+            if opt.stats is not None:
+                with open(opt.stats, "w") as f:
+                    json.dump(epochs, f)
+    finally:
+        dist.destroy_process_group()
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def launch(opt, world_size):
+    r"""
+    Spawn world_size local ranks (torchrun-style), returns rank 0's per-epoch stats
+    """
+    import torch.multiprocessing as mp
+
+    with tempfile.TemporaryDirectory() as tmp:
+        opt.stats = os.path.join(tmp, "stats.json")
+        init_method = "tcp://127.0.0.1:%d" % _free_port()
+        mp.spawn(train, args=(world_size, opt, init_method), nprocs=world_size, join=True)
+        with open(opt.stats) as f:
+            return json.load(f)
+
+
+def scaling(opt, world_sizes, cores=None):
+    r"""
+    Strong scaling on one node: the cores are split evenly between the ranks, the per-rank batch
+    stays fixed. Efficiency = throughput(n) / (n * throughput(1)), skipping the first (warmup) epoch.
+    """
+    cores = cores or os.cpu_count()
+    results = {}
+    for n in world_sizes:
+        opt.threads = max(1, cores // n)
+        stats = launch(opt, n)
+        steady = stats[1:] or stats
+        results[n] = sum(e["samples_per_s"] for e in steady) / len(steady)
+    base = results[min(world_sizes)] / min(world_sizes)
+    return {n: {"samples_per_s": v, "efficiency": v / (n * base)} for n, v in results.items()}
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Data-parallel training of a define_net model on CPU (gloo)")
+    parser.add_argument("--data", default=None, help="Parquet cohort, default: synthetic")
+    parser.add_argument("--synthetic", type=int, default=4096, help="synthetic cohort size")
+    parser.add_argument("--time_column", default="time")
+    parser.add_argument("--censor_column", default="c")
+    parser.add_argument("--label_column", default=None, help="discrete time bin, needed by the nll / ce losses")
+    parser.add_argument("--cache_dir", default=None)
+    parser.add_argument("--mode", default="rapath")
+    parser.add_argument("--loss", default="cox_surv")
+    parser.add_argument("--feature_dim", type=int, default=256, choices=FEATURE_DIMS)
+    parser.add_argument("--co_attention", type=int, default=0)
+    parser.add_argument("--ra_tokens", type=int, default=1)
+    parser.add_argument("--nproc", type=int, default=2)
+    parser.add_argument("--threads", type=int, default=1, help="intra-op threads per rank")
+    parser.add_argument("--epochs", type=int, default=10)
+    parser.add_argument("--batch_size", type=int, default=32, help="per rank")
+    parser.add_argument("--lr", type=float, default=2e-4)
+    parser.add_argument("--weight_decay", type=float, default=1e-4)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default=None, help="where rank 0 saves the trained state dict")
+    parser.add_argument("--stats", default=None)
+    parser.add_argument("--scaling", nargs="*", type=int, default=None, help="report scaling over these process counts")
+    parser.add_argument("--log", type=int, default=1)
+    opt = parser.parse_args(argv)
+    try:
+        # the synthetic cohort has no time bins, the non-Cox losses need a label column
+        check_loss(opt.mode, opt.loss, opt.data is not None and opt.label_column is not None)
+    except ValueError as e:
+        parser.error(str(e))
+    return opt
+
+
+def main(argv=None):
+    opt = parse_args(argv)
+    if "RANK" in os.environ and "WORLD_SIZE" in os.environ:
+        # started by torchrun
+        train(int(os.environ["RANK"]), int(os.environ["WORLD_SIZE"]), opt, "env://")
+        return 0
+    if opt.scaling:
+        opt.log = 0
+        for n, stats in sorted(scaling(opt, opt.scaling).items()):
+            print("%3d procs  %10.1f samples/s  efficiency %.2f" % (n, stats["samples_per_s"], stats["efficiency"]))
+        return 0
+    launch(opt, opt.nproc)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,167 @@
+import os
+
+import torch
+from torch import nn
+
+from evaluator import concordance_index, risk_from_hazards
+from loss import CosineLoss
+from utils import PA_DIMS, PA_KEYS, RA_DIM, load_camlif, timeit
+
+CLS_NAMES = ("cls_ra_encoder", "cls_ra_decoder", "cls_pa_encoder", "cls_pa_decoder")
+
+
+class StudentNet(nn.Module):
+    r"""
+    Compact student for TrCross: an SNN_Block stack on the raw features (ra averaged over tokens,
+    concatenated with pa1..pa4), no Transformers and no cross-attention
+
+    Returns (features, hazard) like the define_net models, plus the four predicted CLS tokens
+    (TrCross output order) when built with cls_heads.
+
+    args:
+        feature_dim (int): width of the fused TrCross features the student imitates
+        hidden (list): SNN_Block widths before the feature layer
+        label_dim (int): hazard outputs, > 1 gives per-bin sigmoid hazards like TrCross.classifier2
+        cls_heads (bool): also predict the encoder / decoder CLS tokens
+    """
+
+    def __init__(self, feature_dim=256, hidden=(512,), label_dim=1, dropout=0.25, cls_heads=False):
+        super(StudentNet, self).__init__()
+        camlif = load_camlif()
+        dims = [RA_DIM + sum(PA_DIMS)] + list(hidden) + [feature_dim]
+        self.encoder = nn.Sequential(*[camlif.SNN_Block(dim1=dims[i], dim2=dims[i + 1], dropout=dropout) for i in range(len(dims) - 1)])
+        self.label_dim = label_dim
+        self.classifier = nn.Linear(feature_dim, label_dim)
+        self.cls_heads = nn.Linear(feature_dim, len(CLS_NAMES) * feature_dim) if cls_heads else None
+
+    def forward(self, **kwargs):
+        x_ra = kwargs["ra"]
+        if x_ra.dim() == 3:
+            x_ra = x_ra.mean(dim=1)  # radiomics tokens -> one vector per patient
+        x = torch.cat([x_ra] + [kwargs[key] for key in PA_KEYS], dim=1)
+        features = self.encoder(x)
+        hazard = self.classifier(features)
+        if self.label_dim > 1:
+            hazard = torch.sigmoid(hazard)  # per-bin hazards in (0, 1), the teacher's binned head
+        if self.cls_heads is None:
+            return features, hazard
+        cls = self.cls_heads(features).chunk(len(CLS_NAMES), dim=1)
+        return (features, hazard) + cls
+
+
+def _batches(inputs, batch_size, order=None):
+    n = next(iter(inputs.values())).size(0)
+    order = torch.arange(n) if order is None else order
+    for start in range(0, n, batch_size):
+        idx = order[start:start + batch_size]
+        yield idx, {k: v[idx] for k, v in inputs.items()}
+
+
+def _targets(outputs, with_cls):
+    targets = {"features": outputs[0], "hazard": outputs[1]}
+    if with_cls:
+        targets.update(zip(CLS_NAMES, outputs[2:6]))
+    return targets
+
+
+@torch.no_grad()
+def teacher_outputs(teacher, inputs, batch_size=256, with_cls=False, path=None):
+    r"""
+    Teacher targets for a whole dataset, computed once in eval mode
+
+    With path, the targets are saved there on the first call and memory-mapped on later ones, so
+    the teacher never runs again for that dataset.
+    """
+    if path is not None and os.path.exists(path):
+        return torch.load(path, mmap=True, weights_only=True)
+    teacher.eval()
+    chunks = [_targets(teacher(**batch), with_cls) for _, batch in _batches(inputs, batch_size)]
+    targets = {k: torch.cat([c[k] for c in chunks]).float() for k in chunks[0]}
+    if path is not None:
+        torch.save(targets, path)
+    return targets
+
+
+class DistillLoss(nn.Module):
+    r"""
+    MSE on the hazards, cosine (or MSE) on the fused features and optionally the CLS tokens
+
+    args:
+        hazard (float), features (float), cls (float): weight of each term
+        feature_loss (str): "cos" (loss.CosineLoss) or "mse"
+    """
+
+    def __init__(self, hazard=1.0, features=1.0, cls=0.0, feature_loss="cos"):
+        super(DistillLoss, self).__init__()
+        self.weights = {"hazard": hazard, "features": features, "cls": cls}
+        self.mse = nn.MSELoss()
+        if feature_loss == "cos":
+            cosine = CosineLoss()
+            self.feature_loss = lambda y, y_hat: cosine(y, y_hat).mean()
+        elif feature_loss == "mse":
+            self.feature_loss = self.mse
+        else:
+            raise NotImplementedError("feature loss [%s] is not found" % feature_loss)
+
+    def forward(self, outputs, targets):
+        loss = self.weights["hazard"] * self.mse(outputs[1], targets["hazard"])
+        loss = loss + self.weights["features"] * self.feature_loss(targets["features"], outputs[0])
+        if self.weights["cls"] and len(outputs) > 2:
+            for name, cls in zip(CLS_NAMES, outputs[2:]):
+                loss = loss + self.weights["cls"] * self.feature_loss(targets[name], cls) / len(CLS_NAMES)
+        return loss
+
+
+def distill(student, inputs, teacher=None, targets=None, criterion=None, epochs=50, batch_size=64, lr=1e-3,
+            weight_decay=1e-4, generator=None, log_every=0):
+    r"""
+    Train student to imitate teacher
+
+    Either pass precomputed targets (teacher_outputs, cached mode: the teacher runs once per
+    dataset) or the teacher itself (it then runs on every batch of every epoch).
+    """
+    if (teacher is None) == (targets is None):
+        raise ValueError("pass exactly one of teacher / targets")
+    with_cls = getattr(student, "cls_heads", None) is not None
+    criterion = criterion or DistillLoss(cls=1.0 if with_cls else 0.0)
+    optimizer = torch.optim.Adam(student.parameters(), lr=lr, weight_decay=weight_decay)
+    if teacher is not None:
+        teacher.eval()
+    n = next(iter(inputs.values())).size(0)
+
+    history = []
+    for epoch in range(epochs):
+        student.train()
+        total = 0.0
+        for idx, batch in _batches(inputs, batch_size, torch.randperm(n, generator=generator)):
+            if targets is not None:
+                batch_targets = {k: v[idx] for k, v in targets.items()}
+            else:
+                with torch.no_grad():
+                    batch_targets = _targets(teacher(**batch), with_cls)
+            loss = criterion(student(**batch), batch_targets)
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+            total += loss.item() * idx.numel()
+        history.append(total / n)
+        if log_every and (epoch + 1) % log_every == 0:
+            print("epoch %d: distill loss %.4f" % (epoch + 1, history[-1]))
+    return history
+
+
+@torch.no_grad()
+def distill_report(student, teacher, inputs, time, c, repeats=20, warmup=3):
+    r"""
+    Latency of both models on inputs and the student's C-index gap to the teacher
+    """
+    student.eval()
+    teacher.eval()
+    report = {}
+    for name, net in (("teacher", teacher), ("student", student)):
+        risk = risk_from_hazards(net(**inputs)[1])
+        report[name + "_c_index"] = concordance_index(risk, time, c).item()
+        report[name + "_ms"] = timeit(lambda: net(**inputs), repeats, warmup)["median_ms"]
+    report["c_index_gap"] = report["teacher_c_index"] - report["student_c_index"]
+    report["speedup"] = report["teacher_ms"] / report["student_ms"]
+    return report
@@ -0,0 +1,69 @@
+import copy
+
+from torch import nn
+from torch.func import functional_call, stack_module_state, vmap
+
+from utils import load_camlif
+
+
+class FoldEnsemble(nn.Module):
+    r"""
+    k fold models of the same architecture evaluated in one vmapped forward over stacked parameters
+
+    Returns a dict with the mean and variance of the hazards over the members and the per-member
+    hazards [k, B, ...].
+
+    Cross-attention must use CoAttention (args.co_attention=1, existing R_In_P / P_In_R weights load
+    into it): the legacy multi_head_attention_forward branches on torch.equal, which vmap can not trace.
+
+    args:
+        models (list): trained fold models, all built from the same args
+        output_index (int): position of the hazard in the model's output tuple
+    """
+
+    def __init__(self, models, output_index=1):
+        super(FoldEnsemble, self).__init__()
+        if len(models) == 0:
+            raise ValueError("FoldEnsemble needs at least one model")
+        for model in models:
+            if hasattr(model, "R_In_P") and not getattr(model, "use_co_attention", False):
+                raise ValueError("build the fold models with args.co_attention=1 to vmap TrCross")
+        self.num_members = len(models)
+        self.output_index = output_index
+
+        params, buffers = stack_module_state(list(models))
+        self.params = nn.ParameterDict({k.replace(".", "__"): nn.Parameter(v, requires_grad=False) for k, v in params.items()})
+        for k, v in buffers.items():
+            self.register_buffer(k.replace(".", "__"), v)
+        self._buffer_names = list(buffers.keys())
+
+        base = copy.deepcopy(models[0]).to("meta")
+        if hasattr(base, "parallel_branches"):
+            base.parallel_branches = False  # vmap state is thread-local, branches must stay on this thread
+        self._base = [base]  # not a submodule, it only provides the forward structure
+
+    @classmethod
+    def from_checkpoints(cls, args, paths, **kwargs):
+        camlif = load_camlif()
+        models = [camlif.define_net(args, state_dict=path).eval() for path in paths]
+        return cls(models, **kwargs)
+
+    def train(self, mode=True):
+        super(FoldEnsemble, self).train(mode)
+        self._base[0].train(mode)
+        return self
+
+    def forward(self, **inputs):
+        base = self._base[0]
+        params = {k.replace("__", "."): v for k, v in self.params.items()}
+        buffers = {k: getattr(self, k.replace(".", "__")) for k in self._buffer_names}
+
+        def member(p, b, x):
+            return functional_call(base, (p, b), args=(), kwargs=x)[self.output_index]
+
+        hazards = vmap(member, in_dims=(0, 0, None), randomness="different")(params, buffers, inputs)
+        return {
+            "hazard": hazards.mean(dim=0),
+            "var": hazards.var(dim=0, unbiased=False),
+            "members": hazards,
+        }
@@ -0,0 +1,246 @@
+import torch
+
+
+def risk_from_hazards(hazards):
+    r"""
+    Turn a model output into a scalar risk per patient (higher risk = shorter survival)
+
+    args:
+        hazards (Tensor): [B, 1] / [B] Cox-style log-risk, or [B, K] discrete-time hazards
+    """
+    if hazards.dim() == 2 and hazards.size(1) > 1:
+        S = torch.cumprod(1 - hazards, dim=1)  # surival is cumulative product of 1 - hazards
+        return -S.sum(dim=1)
+    return hazards.reshape(-1)
+
+
+def _lexsort(time, risk):
+    # sort by time asc, ties broken by risk asc (stable sort on the secondary key first)
+    order = risk.argsort(dim=-1, stable=True)
+    order = order.gather(-1, time.gather(-1, order).argsort(dim=-1, stable=True))
+    return order
+
+
+def _merge_count(r):
+    # for every position i, count later positions j > i with r[j] < r[i] and r[j] <= r[i]
+    # bottom-up merge sort: log n levels, each one batched searchsorted + one batched sort of the
+    # merged runs, O(n log n) per level and O(n log^2 n) overall
+    *lead, n = r.shape
+    size = 1 << max(n - 1, 0).bit_length()
+    if size > n:
+        r = torch.cat([r, r.new_full((*lead, size - n), float("inf"))], dim=-1)
+    less = torch.zeros(*lead, size, dtype=torch.long, device=r.device)
+    leq = torch.zeros_like(less)
+    order = torch.arange(size, device=r.device).expand(*lead, size)
+    vals = r
+    s = 1
+    while s < size:
+        nb = size // (2 * s)
+        v = vals.reshape(*lead, nb, 2, s)
+        o = order.reshape(*lead, nb, 2, s)
+        left_v, right_v = v[..., 0, :].contiguous(), v[..., 1, :].contiguous()
+        left_o = o[..., 0, :].reshape(*lead, -1)
+        lt = torch.searchsorted(right_v, left_v, side="left")
+        le = torch.searchsorted(right_v, left_v, side="right")
+        less.scatter_add_(-1, left_o, lt.reshape(*lead, -1))
+        leq.scatter_add_(-1, left_o, le.reshape(*lead, -1))
+        vals, idx = v.reshape(*lead, nb, 2 * s).sort(dim=-1)
+        order = o.reshape(*lead, nb, 2 * s).gather(-1, idx).reshape(*lead, size)
+        vals = vals.reshape(*lead, size)
+        s *= 2
+    return less[..., :n], leq[..., :n]
+
+
+def concordance_index(risk, time, c):
+    r"""
+    Harrell's C-index by merge-sort inversion counting in O(n log^2 n) work and O(log n) batched
+    levels (the pairwise definition is O(n^2)), fully on-device
+
+    args:
+        risk (Tensor): [..., n] predicted risk, higher = earlier event
+        time (Tensor): [..., n] observed (or binned) survival time
+        c (Tensor): [..., n] censorship status, 0 or 1 (same convention as loss.py)
+
+    Leading dimensions are evaluated independently, which is how the bootstrap is batched.
+    """
+    risk = risk.float()
+    time = time.float()
+    event = 1 - c.float()
+    n = risk.size(-1)
+
+    order = _lexsort(time, risk)
+    risk, time, event = risk.gather(-1, order), time.gather(-1, order), event.gather(-1, order)
+
+    less, leq = _merge_count(risk)
+
+    # pairs with identical (time, risk) sit next to each other and were counted as ties, drop them
+    idx = torch.arange(n, device=risk.device).expand_as(risk)
+    same = (time[..., 1:] == time[..., :-1]) & (risk[..., 1:] == risk[..., :-1])
+    ends = torch.cat([~same, torch.ones_like(same[..., :1])], dim=-1)
+    end_pos = torch.where(ends, idx, torch.full_like(idx, n)).flip(-1).cummin(dim=-1).values.flip(-1)
+    later_same = end_pos - idx
+
+    comparable = n - torch.searchsorted(time.contiguous(), time.contiguous(), side="right")
+    concordant = less.float()
+    tied = (leq - less - later_same).float()
+
+    num = (event * (concordant + 0.5 * tied)).sum(dim=-1)
+    den = (event * comparable.float()).sum(dim=-1)
+    return num / den.clamp(min=1)
+
+
+def kaplan_meier(time, event):
+    r"""
+    Kaplan-Meier estimate, returns (unique event-or-censor times, S(t) right after each time)
+
+    args:
+        time (Tensor): [n] observed time
+        event (Tensor): [n] 1 if the event was observed
+    """
+    time = time.float()
+    event = event.float()
+    times, inverse = torch.unique(time, sorted=True, return_inverse=True)
+    d = torch.zeros_like(times).scatter_add_(0, inverse, event)
+    n = torch.zeros_like(times).scatter_add_(0, inverse, torch.ones_like(event))
+    at_risk = n.flip(0).cumsum(0).flip(0)
+    surv = torch.cumprod(1 - d / at_risk, dim=0)
+    return times, surv
+
+
+def step_eval(times, values, t, left=1.0):
+    # evaluate a right-continuous step function (times, values) at t
+    pos = torch.searchsorted(times.contiguous(), t.float().contiguous(), side="right")
+    padded = torch.cat([values.new_full((1,), left), values])
+    return padded[pos]
+
+
+def _censoring_weights(time, c, eps=1e-7):
+    # inverse probability of censoring weights, G is the KM of the censoring distribution
+    times, G = kaplan_meier(time, c.float())
+    return lambda t: step_eval(times, G, t).clamp(min=eps)
+
+
+def cumulative_dynamic_auc(risk, time, c, eval_times):
+    r"""
+    IPCW time-dependent AUC (cumulative cases / dynamic controls), one value per eval time
+
+    args:
+        risk (Tensor): [n] predicted risk
+        time (Tensor): [n] observed time
+        c (Tensor): [n] censorship status
+        eval_times (Tensor): [K] time points
+    """
+    risk, time = risk.float(), time.float()
+    event = 1 - c.float()
+    eval_times = eval_times.float().to(risk.device)
+    G = _censoring_weights(time, c)
+
+    cases = (time[None, :] <= eval_times[:, None]) & (event[None, :] > 0)  # [K, n]
+    controls = (time[None, :] > eval_times[:, None]).float()
+    w = cases.float() / G(time)[None, :]
+
+    sorted_risk, order = risk.sort()
+    C = torch.cat([controls.new_zeros(controls.size(0), 1), controls[:, order].cumsum(dim=1)], dim=1)
+    lo = torch.searchsorted(sorted_risk, risk, side="left")
+    hi = torch.searchsorted(sorted_risk, risk, side="right")
+    n_less = C[:, lo]
+    n_tied = C[:, hi] - n_less
+
+    num = (w * (n_less + 0.5 * n_tied)).sum(dim=1)
+    den = w.sum(dim=1) * controls.sum(dim=1)
+    auc = num / den.clamp(min=1e-12)
+    mean_auc = auc.mean()
+    return auc, mean_auc
+
+
+def brier_score(surv, time, c, eval_times):
+    r"""
+    IPCW Brier score at each eval time
+
+    args:
+        surv (Tensor): [n, K] predicted S(t) at eval_times
+        time (Tensor): [n] observed time
+        c (Tensor): [n] censorship status
+        eval_times (Tensor): [K] time points
+    """
+    time = time.float()
+    event = 1 - c.float()
+    eval_times = eval_times.float().to(surv.device)
+    G = _censoring_weights(time, c)
+
+    died = ((time[:, None] <= eval_times[None, :]) & (event[:, None] > 0)).float()
+    alive = (time[:, None] > eval_times[None, :]).float()
+    score = surv.pow(2) * died / G(time)[:, None] + (1 - surv).pow(2) * alive / G(eval_times)[None, :]
+    return score.mean(dim=0)
+
+
+def integrated_brier_score(surv, time, c, eval_times):
+    scores = brier_score(surv, time, c, eval_times)
+    eval_times = eval_times.float().to(scores.device)
+    if eval_times.numel() < 2:
+        return scores.mean()
+    return torch.trapz(scores, eval_times) / (eval_times[-1] - eval_times[0])
+
+
+class SurvEvaluator(object):
+    r"""
+    Accumulates risks / survival curves across validation batches and evaluates on-device
+
+    Usage:
+        evaluator = SurvEvaluator(eval_times=torch.arange(1, 4))
+        for batch in loader:
+            evaluator.update(hazard, time, c)
+        results = evaluator.compute(n_bootstrap=1000)
+    """
+
+    def __init__(self, eval_times=None):
+        self.eval_times = eval_times
+        self.reset()
+
+    def reset(self):
+        self.risk, self.time, self.c, self.surv = [], [], [], []
+
+    @torch.no_grad()
+    def update(self, hazards, time, c, surv=None):
+        self.risk.append(risk_from_hazards(hazards.detach()).float())
+        self.time.append(time.detach().reshape(-1).to(self.risk[-1].device))
+        self.c.append(c.detach().reshape(-1).to(self.risk[-1].device))
+        if surv is not None:
+            self.surv.append(surv.detach())
+
+    def _cat(self):
+        return torch.cat(self.risk), torch.cat(self.time), torch.cat(self.c)
+
+    @torch.no_grad()
+    def bootstrap(self, n_bootstrap=1000, alpha=0.05, chunk_size=256, generator=None):
+        r"""
+        Percentile bootstrap CI of the C-index, replicates are evaluated as one batch per chunk
+        """
+        risk, time, c = self._cat()
+        n = risk.numel()
+        stats = []
+        for start in range(0, n_bootstrap, chunk_size):
+            b = min(chunk_size, n_bootstrap - start)
+            idx = torch.randint(n, (b, n), device=risk.device, generator=generator)
+            stats.append(concordance_index(risk[idx], time[idx], c[idx]))
+        stats = torch.cat(stats)
+        q = torch.tensor([alpha / 2, 1 - alpha / 2], device=stats.device)
+        lower, upper = torch.quantile(stats, q)
+        return lower.item(), upper.item()
+
+    @torch.no_grad()
+    def compute(self, n_bootstrap=0, alpha=0.05, generator=None):
+        risk, time, c = self._cat()
+        results = {"c_index": concordance_index(risk, time, c).item()}
+        if n_bootstrap > 0:
+            results["c_index_ci"] = self.bootstrap(n_bootstrap, alpha, generator=generator)
+
+        if self.eval_times is not None:
+            eval_times = torch.as_tensor(self.eval_times, device=risk.device)
+            auc, mean_auc = cumulative_dynamic_auc(risk, time, c, eval_times)
+            results["auc"] = auc.tolist()
+            results["mean_auc"] = mean_auc.item()
+            if len(self.surv) > 0:
+                surv = torch.cat(self.surv).to(risk.device)
+                results["ibs"] = integrated_brier_score(surv, time, c, eval_times).item()
+        return results
@@ -0,0 +1,124 @@
+import hashlib
+import json
+import os
+import warnings
+
+import numpy as np
+import torch
+
+# feature groups each define_net mode's forward actually reads
+MODE_GROUPS = {
+    "path": ("pa1", "pa2", "pa3", "pa4"),
+    "ra": ("ra",),
+    "path_TU": ("pa1",),
+    "path_PaEp": ("pa2",),
+    "path_PaSt": ("pa3",),
+    "path_PaNu": ("pa4",),
+    "rapath": ("ra", "pa1", "pa2", "pa3", "pa4"),
+}
+
+
+def mode_columns(mode, names, manifest=None):
+    r"""
+    Columns to read for each feature group of a mode
+
+    A group is either stored as one fixed-size-list column named after it ("ra", "pa1", ...) or as
+    flat scalar columns prefixed with it ("ra_0", "ra_1", ...). A manifest (group -> column names,
+    e.g. the one written by prune.py) overrides both.
+
+    args:
+        mode (str): define_net mode
+        names (list): column names of the table
+        manifest (dict): explicit group -> columns mapping
+    """
+    columns = {}
+    for group in MODE_GROUPS[mode]:
+        if manifest is not None and group in manifest:
+            columns[group] = list(manifest[group])
+        elif group in names:
+            columns[group] = [group]
+        else:
+            columns[group] = [n for n in names if n.startswith(group + "_")]
+        if not columns[group]:
+            raise KeyError("no columns found for feature group [%s]" % group)
+    return columns
+
+
+def _column_to_numpy(column):
+    # zero-copy for a single-chunk, null-free column, otherwise one contiguous copy
+    import pyarrow as pa
+
+    if column.num_chunks == 1:
+        arr = column.chunk(0)
+    else:
+        arr = pa.concat_arrays(column.chunks)
+    if pa.types.is_fixed_size_list(arr.type):
+        width = arr.type.list_size
+        return arr.flatten().to_numpy(zero_copy_only=arr.null_count == 0).reshape(-1, width)
+    return arr.to_numpy(zero_copy_only=False)
+
+
+def _group_to_numpy(table, cols):
+    if len(cols) == 1:
+        x = _column_to_numpy(table.column(cols[0]))
+        return x if x.ndim == 2 else x[:, None]
+    # flat columns: a single [N, len(cols)] buffer, filled column by column
+    out = np.empty((table.num_rows, len(cols)), dtype=np.float32)
+    for j, name in enumerate(cols):
+        out[:, j] = _column_to_numpy(table.column(name))
+    return out
+
+
+def _cache_key(path, columns):
+    stat = os.stat(path)
+    key = json.dumps([os.path.abspath(path), stat.st_size, stat.st_mtime_ns, columns], sort_keys=True)
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()[:16]
+
+
+def load_features(path, mode, cache_dir=None, manifest=None, ra_tokens=1, dtype=np.float32):
+    r"""
+    Read only the column chunks a mode consumes and return its forward kwargs as tensors
+
+    With cache_dir, the converted arrays are saved as .npy once and memory-mapped on later calls,
+    so repeated experiments skip both Parquet decoding and conversion.
+
+    args:
+        path (str): Parquet file
+        mode (str): define_net mode
+        cache_dir (str): where converted arrays are cached
+        manifest (dict): explicit group -> columns mapping
+        ra_tokens (int): radiomics tokens per patient, ra is returned as [N, ra_tokens, 863]
+    """
+    import pyarrow.parquet as pq
+
+    pf = pq.ParquetFile(path)
+    columns = mode_columns(mode, pf.schema_arrow.names, manifest)
+
+    cached = {}
+    if cache_dir is not None:
+        key = _cache_key(path, columns)
+        files = {g: os.path.join(cache_dir, "%s.%s.npy" % (key, g)) for g in columns}
+        if all(os.path.exists(f) for f in files.values()):
+            # copy-on-write maps: zero-copy, and torch gets a writable buffer
+            cached = {g: np.load(f, mmap_mode="c") for g, f in files.items()}
+
+    if not cached:
+        wanted = [c for cols in columns.values() for c in cols]
+        table = pq.read_table(path, columns=wanted)  # column projection: other column chunks are never read
+        cached = {g: _group_to_numpy(table, cols) for g, cols in columns.items()}
+        cached = {g: x if x.dtype == dtype else x.astype(dtype) for g, x in cached.items()}
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            for g, x in cached.items():
+                np.save(files[g], x)
+
+    inputs = {}
+    for group, x in cached.items():
+        with warnings.catch_warnings():
+            # arrow buffers are read-only, the tensors share them and must not be modified in place
+            warnings.simplefilter("ignore", UserWarning)
+            t = torch.from_numpy(x)
+        if group == "ra":
+            t = t.reshape(t.size(0), ra_tokens, -1)
+        inputs[group] = t
+    return inputs
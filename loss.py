@@ -1,5 +1,4 @@
 import torch
-import numpy as np
 import torch.nn as nn
 import torch.nn.functional as F
 
@@ -97,16 +96,12 @@ class NLLSurvLoss(object):
 
 
 class CoxSurvLoss(object):
-    def __call__(hazards, S, c, **kwargs):
+    def __call__(self, hazards, S, c, **kwargs):
         # This calculation credit to Travers Ching https://github.com/traversc/cox-nnet
         # Cox-nnet: An artificial neural network method for prognosis prediction of high-throughput omics data
-        current_batch_len = len(S)
-        R_mat = np.zeros([current_batch_len, current_batch_len], dtype=int)
-        for i in range(current_batch_len):
-            for j in range(current_batch_len):
-                R_mat[i, j] = S[j] >= S[i]
-        device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-        R_mat = torch.FloatTensor(R_mat).to(device)
+        S = torch.as_tensor(S, device=hazards.device).reshape(-1)
+        R_mat = (S[None, :] >= S[:, None]).float()  # R_mat[i, j] = S[j] >= S[i]
+        c = torch.as_tensor(c, device=hazards.device).reshape(-1).float()
         theta = hazards.reshape(-1)
         exp_theta = torch.exp(theta)
         loss_cox = -torch.mean((theta - torch.log(torch.sum(exp_theta * R_mat, dim=1))) * (1 - c))
@@ -0,0 +1,136 @@
+import fnmatch
+
+import torch
+from torch import nn
+
+from utils import load_camlif
+
+# embedding stacks and heads: Radiology_fc, the first SNN_Block of every Pathomics_fc branch, the
+# MLP heads, the PATHNet* encoders and ConvNet.fc
+DEFAULT_TARGETS = (
+    "Radiology_fc.*",
+    "Pathomics_fc.*.0.0",
+    "bbox_embed.layers.*",
+    "classifier.layers.*",
+    "classifier2.layers.*",
+    "encoder.*",
+    "fc.*",
+)
+
+
+class LowRankLinear(nn.Module):
+    r"""
+    W ~= U V, y = U (V x) + b: an in x out Linear stored as in x rank + rank x out
+
+    args:
+        first (nn.Linear): in_features -> rank, no bias
+        second (nn.Linear): rank -> out_features, carries the original bias
+    """
+
+    def __init__(self, in_features, out_features, rank, bias=True, device=None, dtype=None):
+        super(LowRankLinear, self).__init__()
+        self.in_features = in_features
+        self.out_features = out_features
+        self.rank = rank
+        self.first = nn.Linear(in_features, rank, bias=False, device=device, dtype=dtype)
+        self.second = nn.Linear(rank, out_features, bias=bias, device=device, dtype=dtype)
+
+    def forward(self, x):
+        return self.second(self.first(x))
+
+    def extra_repr(self):
+        return "in_features=%d, out_features=%d, rank=%d" % (self.in_features, self.out_features, self.rank)
+
+
+def svd_rank(S, energy):
+    r"""
+    Smallest rank whose singular values keep ``energy`` of the squared Frobenius norm
+    """
+    cum = torch.cumsum(S.double() ** 2, dim=0)
+    return int(torch.searchsorted(cum, energy * cum[-1]).item()) + 1
+
+
+@torch.no_grad()
+def factorize_linear(linear, rank=None, energy=None):
+    r"""
+    Truncated-SVD LowRankLinear for linear, or linear itself when the factorization would not be smaller
+
+    args:
+        rank (int): kept singular values
+        energy (float): alternatively, fraction of spectral energy to keep (e.g. 0.95)
+    """
+    if (rank is None) == (energy is None):
+        raise ValueError("pass exactly one of rank / energy")
+    W = linear.weight.float()
+    U, S, Vh = torch.linalg.svd(W, full_matrices=False)
+    r = min(rank, S.numel()) if rank is not None else svd_rank(S, energy)
+    if r * (linear.in_features + linear.out_features) >= linear.in_features * linear.out_features:
+        return linear
+    sqrt_s = S[:r].sqrt()
+    layer = LowRankLinear(linear.in_features, linear.out_features, r, bias=linear.bias is not None,
+                          device=W.device, dtype=linear.weight.dtype)
+    layer.first.weight.copy_(sqrt_s[:, None] * Vh[:r])
+    layer.second.weight.copy_(U[:, :r] * sqrt_s[None, :])
+    if linear.bias is not None:
+        layer.second.bias.copy_(linear.bias)
+    return layer
+
+
+def _replace(net, name, module):
+    parent, _, attr = name.rpartition(".")
+    setattr(net.get_submodule(parent), attr, module)
+
+
+def _targets(net, targets):
+    return [name for name, m in net.named_modules()
+            if isinstance(m, nn.Linear) and any(fnmatch.fnmatchcase(name, t) for t in targets)]
+
+
+def compress(net, rank=None, energy=None, targets=DEFAULT_TARGETS):
+    r"""
+    Replace the targeted nn.Linear layers of net by truncated-SVD factorizations (in place)
+
+    args:
+        targets (tuple): fnmatch patterns of Linear module names
+
+    Returns {name: (out_features, in_features, rank)} of the layers that were factorized.
+    """
+    ranks = {}
+    for name in _targets(net, targets):
+        linear = net.get_submodule(name)
+        layer = factorize_linear(linear, rank=rank, energy=energy)
+        if layer is not linear:
+            _replace(net, name, layer)
+            ranks[name] = (linear.out_features, linear.in_features, layer.rank)
+    return ranks
+
+
+def load_compressed(args, state_dict):
+    r"""
+    Rebuild a compressed network from its state dict, the ranks are read from the factor shapes
+    """
+    camlif = load_camlif()
+    with torch.device("meta"):
+        net = camlif.define_net(args)
+        for key, value in state_dict.items():
+            if key.endswith(".first.weight"):
+                name = key[:-len(".first.weight")]
+                linear = net.get_submodule(name)
+                _replace(net, name, LowRankLinear(linear.in_features, linear.out_features, value.size(0),
+                                                  bias=linear.bias is not None))
+    net.load_state_dict(state_dict, assign=True)
+    return net
+
+
+def finetune(compressed, original, inputs, epochs=10, batch_size=64, lr=1e-4, cache_path=None):
+    r"""
+    Recover accuracy by distilling the uncompressed network's hazards and features into the compressed one
+    """
+    from distill import distill, teacher_outputs
+
+    targets = teacher_outputs(original, inputs, path=cache_path)
+    return distill(compressed, inputs, targets=targets, epochs=epochs, batch_size=batch_size, lr=lr)
+
+
+def parameter_bytes(net):
+    return sum(p.numel() * p.element_size() for p in net.parameters())
@@ -0,0 +1,137 @@
+import torch
+
+from evaluator import step_eval
+
+
+def survival_curves(hazards, logits=False):
+    r"""
+    S(t) for every bin, hazards [B, K] -> S [B, K]
+
+    args:
+        hazards (Tensor): per-bin hazards, or raw logits with logits=True
+    """
+    if logits:
+        hazards = torch.sigmoid(hazards)
+    return torch.cumprod(1 - hazards, dim=1)  # surival is cumulative product of 1 - hazards
+
+
+def expected_survival(S, bin_widths=None):
+    r"""
+    Restricted mean survival time, sum_k S(t_k) * width_k (bin index units when no widths are given)
+    """
+    if bin_widths is None:
+        return S.sum(dim=1)
+    return (S * torch.as_tensor(bin_widths, dtype=S.dtype, device=S.device)).sum(dim=1)
+
+
+def median_survival(S, times=None):
+    r"""
+    First time S(t) <= 0.5, inf for patients whose curve never crosses 0.5
+
+    args:
+        S (Tensor): [B, K] survival curves
+        times (Tensor): [K] time of each column, default: bin index
+    """
+    if times is None:
+        times = torch.arange(S.size(1), dtype=S.dtype, device=S.device)
+    times = torch.as_tensor(times, dtype=S.dtype, device=S.device)
+    below = S <= 0.5
+    first = below.float().argmax(dim=1)
+    median = times[first]
+    return torch.where(below.any(dim=1), median, torch.full_like(median, float("inf")))
+
+
+def risk_cutoffs(risk, n_groups=3):
+    # quantile cutoffs, fit them on the training cohort and reuse them for new patients
+    q = torch.linspace(0, 1, n_groups + 1, dtype=torch.float, device=risk.device)[1:-1]
+    return torch.quantile(risk.float(), q)
+
+
+def risk_groups(risk, cutoffs):
+    r"""
+    Group index per patient, 0 = lowest risk
+    """
+    return torch.bucketize(risk.float(), cutoffs.to(risk.device))
+
+
+def group_kaplan_meier(time, c, groups, n_groups=None):
+    r"""
+    Kaplan-Meier curves of every risk group at once
+
+    args:
+        time (Tensor): [n] observed time
+        c (Tensor): [n] censorship status, 0 or 1
+        groups (Tensor): [n] group index from risk_groups
+
+    Returns (times [U], S [G, U]) on the union of observed times.
+    """
+    n_groups = n_groups or int(groups.max().item()) + 1
+    event = 1 - c.float()
+    times, inverse = torch.unique(time.float(), sorted=True, return_inverse=True)
+    d = torch.zeros(n_groups, times.numel(), device=time.device)
+    n = torch.zeros_like(d)
+    d.index_put_((groups, inverse), event, accumulate=True)
+    n.index_put_((groups, inverse), torch.ones_like(event), accumulate=True)
+    at_risk = n.flip(1).cumsum(dim=1).flip(1)
+    S = torch.cumprod(1 - d / at_risk.clamp(min=1), dim=1)
+    return times, S
+
+
+def stratify(risk, time, c, cutoffs=None, n_groups=3):
+    r"""
+    Risk-group stratification of a cohort: group assignment plus each group's KM curve
+    """
+    if cutoffs is None:
+        cutoffs = risk_cutoffs(risk, n_groups)
+    groups = risk_groups(risk, cutoffs)
+    times, S = group_kaplan_meier(time, c, groups, cutoffs.numel() + 1)
+    return {"cutoffs": cutoffs, "groups": groups, "times": times, "survival": S}
+
+
+class BreslowEstimator(object):
+    r"""
+    Breslow baseline hazard for Cox-mode models (cox_surv), cached after fit
+
+    S_i(t) = S0(t) ** exp(risk_i), so predicting a patient's full curve is one exp plus a broadcast pow.
+
+    Usage:
+        breslow = BreslowEstimator().fit(train_risk, train_time, train_c)
+        S = breslow.predict_survival(test_risk)  # [B, U] on breslow.times
+    """
+
+    def __init__(self):
+        self.times = None
+        self.cum_baseline_hazard = None
+        self.baseline_survival = None
+
+    @torch.no_grad()
+    def fit(self, risk, time, c):
+        risk = risk.reshape(-1).float()
+        time = time.reshape(-1).float()
+        event = 1 - c.reshape(-1).float()
+        times, inverse = torch.unique(time, sorted=True, return_inverse=True)
+        d = torch.zeros_like(times).scatter_add_(0, inverse, event)
+        exp_risk = torch.zeros_like(times).scatter_add_(0, inverse, torch.exp(risk))
+        risk_set = exp_risk.flip(0).cumsum(0).flip(0)  # sum of exp(risk) over patients with T >= t
+        keep = d > 0
+        self.times = times[keep]
+        self.cum_baseline_hazard = torch.cumsum(d[keep] / risk_set[keep], dim=0)
+        self.baseline_survival = torch.exp(-self.cum_baseline_hazard)
+        return self
+
+    def predict_cumulative_hazard(self, risk, times=None):
+        H0 = self.cum_baseline_hazard if times is None else step_eval(self.times, self.cum_baseline_hazard, times, left=0.0)
+        return H0.to(risk.device)[None, :] * torch.exp(risk.reshape(-1, 1).float())
+
+    def predict_survival(self, risk, times=None):
+        S0 = self.baseline_survival if times is None else step_eval(self.times, self.baseline_survival, times)
+        return torch.pow(S0.to(risk.device)[None, :], torch.exp(risk.reshape(-1, 1).float()))
+
+    def state_dict(self):
+        return {"times": self.times, "cum_baseline_hazard": self.cum_baseline_hazard}
+
+    def load_state_dict(self, state_dict):
+        self.times = state_dict["times"]
+        self.cum_baseline_hazard = state_dict["cum_baseline_hazard"]
+        self.baseline_survival = torch.exp(-self.cum_baseline_hazard)
+        return self
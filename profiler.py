@@ -0,0 +1,237 @@
+import json
+import time
+import warnings
+from collections import OrderedDict
+
+import torch
+
+# forward order of TrCross, fusion is called twice (decoder tokens, then encoder tokens),
+# co_attention replaces R_In_P / P_In_R when args.co_attention is set; Pathomics_fc is a ModuleList
+# that is indexed, never called, so each group's embedding is its own stage
+TRCROSS_STAGES = [
+    "Radiology_fc",
+    "Pathomics_fc.0",
+    "Pathomics_fc.1",
+    "Pathomics_fc.2",
+    "Pathomics_fc.3",
+    "radiology_encoder",
+    "pathomics_encoder",
+    "R_In_P",
+    "P_In_R",
+    "co_attention",
+    "radiology_decoder",
+    "pathomics_decoder",
+    "fusion",
+    "classifier2",
+]
+
+
+class StageProfiler(object):
+    r"""
+    Opt-in per-stage forward instrumentation (wall time, FLOPs, allocated / peak memory)
+
+    On CUDA each stage records its allocation delta and peak from the caching allocator. On CPU
+    the block runs under torch.profiler with profile_memory and each stage call is a
+    record_function range, whose net allocation is the stage's allocated_mb (no CPU peak).
+    FLOPs are counted per stage, which needs stages that nest on one thread: a model with
+    parallel_branches runs stages concurrently, and flops is turned off for it.
+
+    Hooks only exist inside the ``with`` block, so a model that is not being profiled
+    runs exactly as before.
+
+    args:
+        model (nn.Module): model to instrument
+        stages (list): names of submodules to time, default: every direct child
+        flops (bool): count FLOPs with torch.utils.flop_counter (slower, off by default)
+        memory (bool): record allocated (and on CUDA peak) memory
+
+    Usage:
+        with StageProfiler(net, stages=TRCROSS_STAGES) as prof:
+            net(**inputs)
+        print(prof.table())
+        prof.to_chrome_trace("trace.json")
+    """
+
+    def __init__(self, model, stages=None, flops=False, memory=True):
+        self.model = model
+        if stages is None:
+            stages = [name for name, _ in model.named_children()]
+        modules = dict(model.named_modules())
+        self.stages = [s for s in stages if s in modules]
+        self.modules = [modules[s] for s in self.stages]
+        if flops and getattr(model, "parallel_branches", False):
+            warnings.warn("stages overlap with parallel_branches, FLOP counting is disabled")
+            flops = False
+        self.flops = flops
+        self.memory = memory
+        self.records = []
+        self._handles = []
+        self._open = {}
+        self._calls = {}
+        self._origin = None
+        self._memory_profile = None
+
+    def _device(self, module):
+        for p in module.parameters():
+            return p.device
+        return torch.device("cpu")
+
+    def _sync(self, device):
+        if device.type == "cuda":
+            torch.cuda.synchronize(device)
+
+    def _pre_hook(self, name):
+        def hook(module, inputs):
+            device = self._device(module)
+            self._sync(device)
+            call = self._calls.get(name, 0)
+            self._calls[name] = call + 1
+            state = {"device": device, "call": call}
+            if self.memory and device.type == "cuda":
+                state["mem_before"] = torch.cuda.memory_allocated(device)
+                torch.cuda.reset_peak_memory_stats(device)
+            elif self._memory_profile is not None:
+                state["scope"] = torch.profiler.record_function(self._scope(name, call))
+                state["scope"].__enter__()
+            if self.flops:
+                from torch.utils.flop_counter import FlopCounterMode
+
+                state["counter"] = FlopCounterMode(display=False)
+                state["counter"].__enter__()
+            state["start"] = time.perf_counter()
+            self._open[name] = state
+
+        return hook
+
+    def _post_hook(self, name):
+        def hook(module, inputs, output):
+            state = self._open.pop(name)
+            device = state["device"]
+            self._sync(device)
+            end = time.perf_counter()
+            record = {
+                "name": name,
+                "call": state["call"],
+                "start": state["start"] - self._origin,
+                "wall_ms": (end - state["start"]) * 1e3,
+            }
+            if "counter" in state:
+                state["counter"].__exit__(None, None, None)
+                record["flops"] = state["counter"].get_total_flops()
+            if self.memory:
+                if device.type == "cuda":
+                    record["allocated_mb"] = (torch.cuda.memory_allocated(device) - state["mem_before"]) / 2**20
+                    record["peak_mb"] = (torch.cuda.max_memory_allocated(device) - state["mem_before"]) / 2**20
+                elif "scope" in state:
+                    state["scope"].__exit__(None, None, None)  # allocated_mb is filled in on __exit__
+            self.records.append(record)
+
+        return hook
+
+    @staticmethod
+    def _scope(name, call):
+        return "stage::%s::%d" % (name, call)
+
+    def __enter__(self):
+        self.records = []
+        self._calls = {}
+        if self.memory and any(self._device(m).type != "cuda" for m in self.modules):
+            from torch.profiler import ProfilerActivity, profile
+
+            self._memory_profile = profile(activities=[ProfilerActivity.CPU], profile_memory=True)
+            self._memory_profile.__enter__()
+        self._origin = time.perf_counter()
+        for name, module in zip(self.stages, self.modules):
+            self._handles.append(module.register_forward_pre_hook(self._pre_hook(name)))
+            self._handles.append(module.register_forward_hook(self._post_hook(name)))
+        return self
+
+    def __exit__(self, *exc):
+        for handle in self._handles:
+            handle.remove()
+        self._handles = []
+        self._open = {}
+        if self._memory_profile is not None:
+            self._memory_profile.__exit__(None, None, None)
+            # a range's cpu_memory_usage is the bytes allocated minus freed inside it
+            usage = {e.name: e.cpu_memory_usage for e in self._memory_profile.events() if e.name.startswith("stage::")}
+            for r in self.records:
+                scope = self._scope(r["name"], r["call"])
+                if scope in usage:
+                    r["allocated_mb"] = usage[scope] / 2**20
+            self._memory_profile = None
+        return False
+
+    def summary(self):
+        stats = OrderedDict()
+        for name in self.stages:
+            rows = [r for r in self.records if r["name"] == name]
+            if not rows:
+                continue
+            stats[name] = {
+                "calls": len(rows),
+                "total_ms": sum(r["wall_ms"] for r in rows),
+                "mean_ms": sum(r["wall_ms"] for r in rows) / len(rows),
+            }
+            if self.flops:
+                stats[name]["flops"] = sum(r["flops"] for r in rows)
+            if self.memory:
+                if "peak_mb" in rows[0]:
+                    stats[name]["peak_mb"] = max(r["peak_mb"] for r in rows)
+                if "allocated_mb" in rows[0]:
+                    stats[name]["allocated_mb"] = sum(r.get("allocated_mb", 0.0) for r in rows)
+        return stats
+
+    def table(self):
+        stats = self.summary()
+        total = sum(s["total_ms"] for s in stats.values()) or 1.0
+        header = "%-20s %6s %10s %10s %7s" % ("stage", "calls", "total ms", "mean ms", "%")
+        if self.flops:
+            header += " %10s" % "GFLOPs"
+        if self.memory:
+            header += " %10s %10s" % ("alloc MB", "peak MB")
+        lines = [header, "-" * len(header)]
+        for name, s in stats.items():
+            line = "%-20s %6d %10.3f %10.3f %6.1f%%" % (
+                name, s["calls"], s["total_ms"], s["mean_ms"], 100 * s["total_ms"] / total)
+            if self.flops:
+                line += " %10.4f" % (s["flops"] / 1e9)
+            if self.memory:
+                line += " %10s %10s" % tuple("%.1f" % s[k] if k in s else "-" for k in ("allocated_mb", "peak_mb"))
+            lines.append(line)
+        return "\n".join(lines)
+
+    def to_json(self, path):
+        with open(path, "w") as f:
+            json.dump({"summary": self.summary(), "records": self.records}, f, indent=2)
+
+    def to_chrome_trace(self, path):
+        # load in chrome://tracing or https://ui.perfetto.dev
+        events = []
+        for r in self.records:
+            args = {k: v for k, v in r.items() if k not in ("name", "start", "wall_ms")}
+            events.append({
+                "name": r["name"],
+                "ph": "X",
+                "ts": r["start"] * 1e6,
+                "dur": r["wall_ms"] * 1e3,
+                "pid": 0,
+                "tid": 0,
+                "args": args,
+            })
+        with open(path, "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+
+def find_regressions(current, baseline, key="mean_ms", tolerance=0.2):
+    r"""
+    Compare two summaries (dicts of name -> stats) and list entries slower than baseline by more than tolerance
+    """
+    regressions = []
+    for name, stats in current.items():
+        if name not in baseline or key not in stats or key not in baseline[name]:
+            continue
+        ref = baseline[name][key]
+        if ref > 0 and stats[key] > ref * (1 + tolerance):
+            regressions.append((name, ref, stats[key]))
+    return regressions
@@ -0,0 +1,251 @@
+import argparse
+import copy
+import json
+import os
+import sys
+
+import torch
+from torch import nn
+
+from evaluator import concordance_index, risk_from_hazards
+from utils import FEATURE_DIMS, PA_DIMS, PA_KEYS, RA_DIM, default_args, load_camlif, timeit
+
+GROUP_DIMS = dict(zip(("ra",) + PA_KEYS, (RA_DIM,) + PA_DIMS))
+
+# submodule whose first nn.Linear reads each feature group, per define_net mode; the groups of one
+# submodule are concatenated in this order (PATHNet2 reads pa1..pa4 as one 793-d vector)
+INPUT_LAYERS = {
+    "path": {"encoder": PA_KEYS},
+    "ra": {"Radiology_fc": ("ra",)},
+    "path_TU": {"encoder": ("pa1",)},
+    "path_PaEp": {"encoder": ("pa2",)},
+    "path_PaSt": {"encoder": ("pa3",)},
+    "path_PaNu": {"encoder": ("pa4",)},
+    "rapath": dict([("Radiology_fc", ("ra",))] + [("Pathomics_fc.%d" % i, (key,)) for i, key in enumerate(PA_KEYS)]),
+}
+
+
+def first_linear(module):
+    r"""
+    (name, layer) of the first nn.Linear inside module
+    """
+    for name, m in module.named_modules():
+        if isinstance(m, nn.Linear):
+            return name, m
+    raise ValueError("no nn.Linear found")
+
+
+def _input_slices(mode):
+    # (submodule, first linear name, [(group, offset)]) for every input layer of mode
+    for path, groups in INPUT_LAYERS[mode].items():
+        offsets, start = [], 0
+        for group in groups:
+            offsets.append((group, start))
+            start += GROUP_DIMS[group]
+        yield path, groups, offsets
+
+
+################
+# Ranking
+################
+def weight_norm_scores(net, mode):
+    r"""
+    L2 norm of each input column of the first Linear, per feature group
+    """
+    scores = {}
+    for path, _, offsets in _input_slices(mode):
+        _, linear = first_linear(net.get_submodule(path))
+        for group, start in offsets:
+            scores[group] = linear.weight.detach()[:, start:start + GROUP_DIMS[group]].norm(dim=0).float()
+    return scores
+
+
+def saliency_scores(net, mode, inputs, batch_size=256):
+    r"""
+    Mean |x * d risk / dx| of each input column over a cohort (gradient x input saliency)
+    """
+    groups = [g for _, gs, _ in _input_slices(mode) for g in gs]
+    scores = {g: torch.zeros(GROUP_DIMS[g]) for g in groups}
+    was_training = net.training
+    net.eval()
+    n = next(iter(inputs.values())).size(0)
+    for start in range(0, n, batch_size):
+        batch = {k: v[start:start + batch_size].detach().clone() for k, v in inputs.items()}
+        for g in groups:
+            batch[g].requires_grad_(True)
+        risk = risk_from_hazards(net(**batch)[1])
+        grads = torch.autograd.grad(risk.sum(), [batch[g] for g in groups])
+        for g, grad in zip(groups, grads):
+            s = (grad * batch[g]).abs()
+            scores[g] += s.reshape(-1, s.size(-1)).sum(dim=0).detach().float().cpu()
+    net.train(was_training)
+    return {g: s / n for g, s in scores.items()}
+
+
+def select_columns(scores, keep):
+    r"""
+    Indices (ascending, so the column order is preserved) of the top columns of every group
+
+    args:
+        keep (float or dict): fraction of columns to keep, globally or per group
+    """
+    indices = {}
+    for group, s in scores.items():
+        frac = keep[group] if isinstance(keep, dict) else keep
+        k = max(1, int(round(frac * s.numel())))
+        indices[group] = torch.topk(s, k).indices.sort().values
+    return indices
+
+
+################
+# Slimming
+################
+def slim(net, mode, indices):
+    r"""
+    Replace the first Linear of every input layer by one that only reads the kept columns (in place)
+    """
+    for path, groups, offsets in _input_slices(mode):
+        module = net.get_submodule(path)
+        name, linear = first_linear(module)
+        cols = torch.cat([start + torch.as_tensor(indices.get(g, torch.arange(GROUP_DIMS[g]))) for g, start in offsets])
+        slimmed = nn.Linear(cols.numel(), linear.out_features, bias=linear.bias is not None,
+                            device=linear.weight.device, dtype=linear.weight.dtype)
+        if linear.weight.device.type != "meta":  # meta: shapes only, load_state_dict assigns the weights
+            with torch.no_grad():
+                slimmed.weight.copy_(linear.weight[:, cols.to(linear.weight.device)])
+                if linear.bias is not None:
+                    slimmed.bias.copy_(linear.bias)
+        parent, _, attr = (path + "." + name if name else path).rpartition(".")
+        setattr(net.get_submodule(parent), attr, slimmed)
+    return net
+
+
+def slice_inputs(inputs, indices):
+    # keep only the selected columns of in-memory inputs
+    return {k: v[..., torch.as_tensor(indices[k], device=v.device)] if k in indices else v for k, v in inputs.items()}
+
+
+def column_manifest(indices, names=None, ra_tokens=1):
+    r"""
+    group -> kept column names, the manifest ingest.mode_columns reads
+
+    args:
+        names (dict): original column names of each group, default "<group>_<i>" flat columns;
+            ra holds ra_tokens x 863 columns, a kept feature is kept for every token
+    """
+    manifest = {}
+    for group, idx in indices.items():
+        idx = [int(i) for i in idx]
+        if group == "ra":
+            idx = [t * RA_DIM + i for t in range(ra_tokens) for i in idx]
+        if names is not None and group in names:
+            manifest[group] = [names[group][i] for i in idx]
+        else:
+            manifest[group] = ["%s_%d" % (group, i) for i in idx]
+    return manifest
+
+
+def load_pruned(args, state_dict, indices):
+    r"""
+    Rebuild a slimmed network from its state dict and kept column indices without allocating the full one
+    """
+    camlif = load_camlif()
+    with torch.device("meta"):
+        net = slim(camlif.define_net(args), args.mode, indices)
+    net.load_state_dict(state_dict, assign=True)
+    return net
+
+
+################
+# Report
+################
+def count_parameters(net):
+    return sum(p.numel() for p in net.parameters())
+
+
+@torch.no_grad()
+def _c_index(net, inputs, time, c):
+    net.eval()
+    return concordance_index(risk_from_hazards(net(**inputs)[1]), time, c).item()
+
+
+def prune_report(net, mode, inputs, time, c, levels=(1.0, 0.75, 0.5, 0.25, 0.1), method="norm", saliency_inputs=None,
+                 finetune=None, repeats=20, warmup=3):
+    r"""
+    C-index, parameter count and forward latency at every pruning level
+
+    args:
+        method (str): "norm" (weight column norm) or "saliency" (gradient x input on saliency_inputs,
+            default: inputs)
+        finetune (callable): optional finetune(net, indices), run on each slimmed copy before evaluation
+    """
+    if method == "norm":
+        scores = weight_norm_scores(net, mode)
+    elif method == "saliency":
+        scores = saliency_scores(net, mode, inputs if saliency_inputs is None else saliency_inputs)
+    else:
+        raise NotImplementedError("ranking method [%s] is not found" % method)
+
+    rows = []
+    for level in levels:
+        indices = select_columns(scores, level)
+        pruned = slim(copy.deepcopy(net), mode, indices)
+        if finetune is not None:
+            finetune(pruned, indices)
+        pruned.eval()
+        sliced = slice_inputs(inputs, indices)
+        with torch.no_grad():
+            latency = timeit(lambda: pruned(**sliced), repeats, warmup)["median_ms"]
+        rows.append({
+            "keep": level,
+            "columns": {g: int(i.numel()) for g, i in indices.items()},
+            "parameters": count_parameters(pruned),
+            "c_index": _c_index(pruned, sliced, time, c),
+            "forward_ms": latency,
+        })
+    return rows
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Prune input feature columns of a define_net model")
+    parser.add_argument("checkpoint", help="torch.save'd state dict")
+    parser.add_argument("output_dir")
+    parser.add_argument("--mode", default="rapath")
+    parser.add_argument("--feature_dim", type=int, default=256, choices=FEATURE_DIMS)
+    parser.add_argument("--co_attention", type=int, default=0)
+    parser.add_argument("--keep", type=float, default=0.5, help="fraction of columns kept in every group")
+    parser.add_argument("--method", default="norm", choices=("norm", "saliency"))
+    parser.add_argument("--data", default=None, help="Parquet cohort for saliency ranking")
+    parser.add_argument("--ra_tokens", type=int, default=1)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    opt = parse_args(argv)
+    args = default_args(mode=opt.mode, feature_dim=opt.feature_dim, co_attention=opt.co_attention)
+    net = load_camlif().define_net(args, state_dict=opt.checkpoint)
+
+    if opt.method == "saliency":
+        if opt.data is None:
+            raise ValueError("--method saliency needs --data")
+        from ingest import load_features
+
+        scores = saliency_scores(net, opt.mode, load_features(opt.data, opt.mode, ra_tokens=opt.ra_tokens))
+    else:
+        scores = weight_norm_scores(net, opt.mode)
+    indices = select_columns(scores, opt.keep)
+    slim(net, opt.mode, indices)
+
+    os.makedirs(opt.output_dir, exist_ok=True)
+    torch.save(net.state_dict(), os.path.join(opt.output_dir, "model.pt"))
+    with open(os.path.join(opt.output_dir, "indices.json"), "w") as f:
+        json.dump({g: i.tolist() for g, i in indices.items()}, f)
+    with open(os.path.join(opt.output_dir, "columns.json"), "w") as f:
+        json.dump(column_manifest(indices, ra_tokens=opt.ra_tokens), f)
+    print("kept %s, %d parameters" % (", ".join("%s %d/%d" % (g, i.numel(), GROUP_DIMS[g]) for g, i in indices.items()),
+                                      count_parameters(net)))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,440 @@
+import heapq
+import json
+import math
+import os
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+
+def patient_embedding(outputs, with_tokens=False):
+    r"""
+    Retrieval embedding from a TrCross forward: the fused features, optionally concatenated with the
+    four encoder / decoder cls tokens, L2-normalised
+    """
+    parts = [outputs[0]]
+    if with_tokens:
+        parts += list(outputs[2:6])
+    return F.normalize(torch.cat([p.reshape(p.size(0), -1).float() for p in parts], dim=1), dim=1)
+
+
+def _sq_dist(q, x):
+    # [nq, d], [n, d] -> [nq, n] squared L2
+    return (q.pow(2).sum(1, keepdim=True) - 2 * q @ x.t() + x.pow(2).sum(1)[None, :]).clamp(min=0)
+
+
+def kmeans(x, k, iters=20, chunk_size=65536, generator=None):
+    r"""
+    Plain Lloyd's k-means on a [n, d] tensor, returns [k, d] centroids
+    """
+    n = x.size(0)
+    if n < k:
+        raise ValueError("k-means needs at least k = %d training vectors, got %d" % (k, n))
+    centroids = x[torch.randperm(n, generator=generator)[:k].to(x.device)].clone()
+    for _ in range(iters):
+        assign = torch.cat([_sq_dist(x[i:i + chunk_size], centroids).argmin(1) for i in range(0, n, chunk_size)])
+        sums = torch.zeros_like(centroids).index_add_(0, assign, x)
+        counts = torch.bincount(assign, minlength=k).to(x.dtype)
+        nonempty = counts > 0
+        centroids[nonempty] = sums[nonempty] / counts[nonempty, None]  # empty clusters keep their centroid
+    return centroids
+
+
+class _Index(object):
+    r"""
+    Shared bookkeeping: growable storage, external ids, metric and save / load
+
+    metric "l2" ranks by squared euclidean distance, "cosine" normalises inputs first (so the
+    returned distances are 2 - 2 * cos).
+    """
+
+    arrays = ()
+
+    def __init__(self, dim, metric="l2"):
+        self.dim = dim
+        self.metric = metric
+        self.ntotal = 0
+        self.ids = np.zeros(0, dtype=np.int64)
+
+    def _prep(self, x):
+        x = torch.as_tensor(x, dtype=torch.float32).reshape(-1, self.dim)
+        return F.normalize(x, dim=1) if self.metric == "cosine" else x
+
+    def _add_ids(self, n, ids):
+        if ids is None:
+            ids = np.arange(self.ntotal, self.ntotal + n)
+        cap = self.ids.shape[0]
+        if self.ntotal + n > cap:
+            # geometric growth, like the index storage
+            new = max(2 * cap, self.ntotal + n, 1024)
+            self.ids = np.concatenate([self.ids[:self.ntotal], np.zeros(new - self.ntotal, dtype=np.int64)])
+        self.ids[self.ntotal:self.ntotal + n] = np.asarray(ids, dtype=np.int64).reshape(-1)
+        self.ntotal += n
+
+    def _config(self):
+        return {"dim": self.dim, "metric": self.metric}
+
+    def save(self, path):
+        os.makedirs(path, exist_ok=True)
+        state = {"type": type(self).__name__, "config": self._config(), "ntotal": self.ntotal, "extra": self._extra()}
+        with open(os.path.join(path, "index.json"), "w") as f:
+            json.dump(state, f)
+        np.save(os.path.join(path, "ids.npy"), self.ids[:self.ntotal])
+        for name in self.arrays:
+            value = self._array(name)
+            if torch.is_tensor(value):
+                value = value.cpu().numpy()
+            np.save(os.path.join(path, name + ".npy"), value)
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        r"""
+        Restore a saved index, large arrays are memory-mapped copy-on-write (pages load on demand)
+        """
+        with open(os.path.join(path, "index.json")) as f:
+            state = json.load(f)
+        index = _INDEX_TYPES[state["type"]](**state["config"])
+        index.ntotal = state["ntotal"]
+        index._load_extra(state["extra"])
+        index.ids = np.load(os.path.join(path, "ids.npy"), mmap_mode="c" if mmap else None)
+        for name in index.arrays:
+            value = np.load(os.path.join(path, name + ".npy"), mmap_mode="c" if mmap else None)
+            setattr(index, name, torch.from_numpy(value) if index._as_tensor(name) else value)
+        index._loaded()
+        return index
+
+    def _array(self, name):
+        return getattr(self, name)
+
+    def _extra(self):
+        return {}
+
+    def _load_extra(self, extra):
+        pass
+
+    def _as_tensor(self, name):
+        return True
+
+    def _loaded(self):
+        pass
+
+
+class FlatIndex(_Index):
+    r"""
+    Exact brute-force search, also the ground truth for recall measurements
+    """
+
+    arrays = ("data",)
+
+    def __init__(self, dim, metric="l2", chunk_size=262144):
+        super(FlatIndex, self).__init__(dim, metric)
+        self.chunk_size = chunk_size
+        self.data = torch.zeros(0, dim)
+
+    def _array(self, name):
+        return getattr(self, name)[:self.ntotal]  # drop the unused capacity
+
+    def _grow(self, n):
+        # geometric growth, an add copies the database only when the capacity doubles
+        cap = self.data.size(0)
+        if self.ntotal + n <= cap:
+            return
+        new = max(2 * cap, self.ntotal + n, 1024)
+        self.data = torch.cat([self.data[:self.ntotal], self.data.new_zeros(new - self.ntotal, self.dim)])
+
+    def add(self, x, ids=None):
+        x = self._prep(x)
+        self._grow(x.size(0))
+        self.data[self.ntotal:self.ntotal + x.size(0)] = x
+        self._add_ids(x.size(0), ids)
+
+    def search(self, q, k=10):
+        q = self._prep(q)
+        best_d = torch.full((q.size(0), 0), float("inf"))
+        best_i = torch.zeros((q.size(0), 0), dtype=torch.long)
+        # scan the database in chunks, keeping a running top-k
+        for start in range(0, self.ntotal, self.chunk_size):
+            d = _sq_dist(q, self.data[start:min(start + self.chunk_size, self.ntotal)])
+            kk = min(k, d.size(1))
+            d, i = d.topk(kk, dim=1, largest=False)
+            best_d, order = torch.cat([best_d, d], 1).topk(min(k, best_d.size(1) + kk), dim=1, largest=False)
+            best_i = torch.cat([best_i, i + start], 1).gather(1, order)
+        return best_d, torch.from_numpy(np.asarray(self.ids)[best_i.numpy()])
+
+
+class IVFPQIndex(_Index):
+    r"""
+    Inverted file with product quantisation of the residuals (asymmetric distance computation)
+
+    args:
+        nlist (int): number of coarse k-means cells
+        m (int): number of sub-quantisers, dim must be divisible by m
+        nbits (int): bits per sub-quantiser code (<= 8)
+        nprobe (int): cells visited per query
+    """
+
+    arrays = ("coarse", "pq", "codes", "lists")
+
+    def __init__(self, dim, metric="l2", nlist=1024, m=32, nbits=8, nprobe=16):
+        super(IVFPQIndex, self).__init__(dim, metric)
+        assert dim % m == 0, "dim must be divisible by m"
+        self.nlist, self.m, self.ksub, self.nprobe = nlist, m, 2 ** nbits, nprobe
+        self.dsub = dim // m
+        self.coarse = None
+        self.pq = None
+        self.codes = torch.zeros(0, m, dtype=torch.uint8)
+        self.lists = torch.zeros(0, dtype=torch.long)
+        self._csr = None
+
+    def _config(self):
+        config = super(IVFPQIndex, self)._config()
+        config.update(nlist=self.nlist, m=self.m, nbits=int(math.log2(self.ksub)), nprobe=self.nprobe)
+        return config
+
+    @property
+    def is_trained(self):
+        return self.coarse is not None
+
+    def train(self, x, iters=20, generator=None):
+        x = self._prep(x)
+        self.coarse = kmeans(x, self.nlist, iters, generator=generator)
+        residual = x - self.coarse[self._assign(x)]
+        r = residual.view(-1, self.m, self.dsub)
+        self.pq = torch.stack([kmeans(r[:, j], self.ksub, iters, generator=generator) for j in range(self.m)])
+        return self
+
+    def _array(self, name):
+        value = getattr(self, name)
+        return value if name in ("coarse", "pq") else value[:self.ntotal]  # drop the unused capacity
+
+    def _grow(self, n):
+        # geometric growth as in FlatIndex, streaming adds copy the codes only when the capacity doubles
+        cap = self.codes.size(0)
+        if self.ntotal + n <= cap:
+            return
+        new = max(2 * cap, self.ntotal + n, 1024)
+        self.codes = torch.cat([self.codes[:self.ntotal], self.codes.new_zeros(new - self.ntotal, self.m)])
+        self.lists = torch.cat([self.lists[:self.ntotal], self.lists.new_zeros(new - self.ntotal)])
+
+    def _assign(self, x, chunk_size=65536):
+        return torch.cat([_sq_dist(x[i:i + chunk_size], self.coarse).argmin(1) for i in range(0, x.size(0), chunk_size)])
+
+    def _encode(self, residual):
+        # one sub-quantiser at a time, the distances never exceed [n, ksub]
+        r = residual.view(-1, self.m, self.dsub)
+        codes = torch.empty(r.size(0), self.m, dtype=torch.uint8)
+        for j in range(self.m):
+            codes[:, j] = _sq_dist(r[:, j], self.pq[j]).argmin(1).to(torch.uint8)
+        return codes  # [n, m]
+
+    def add(self, x, ids=None, chunk_size=65536):
+        assert self.is_trained, "train the index before adding"
+        x = self._prep(x)
+        self._grow(x.size(0))
+        for i in range(0, x.size(0), chunk_size):
+            chunk = x[i:i + chunk_size]
+            assign = self._assign(chunk)
+            rows = slice(self.ntotal + i, self.ntotal + i + chunk.size(0))
+            self.codes[rows] = self._encode(chunk - self.coarse[assign])
+            self.lists[rows] = assign
+        self._add_ids(x.size(0), ids)
+        self._csr = None  # inverted lists are rebuilt lazily on the next search
+
+    def _loaded(self):
+        self.codes = self.codes.to(torch.uint8)
+
+    def _inverted_lists(self):
+        if self._csr is None:
+            lists = self.lists[:self.ntotal]
+            order = torch.argsort(lists, stable=True)
+            counts = torch.bincount(lists, minlength=self.nlist)
+            offsets = torch.cat([counts.new_zeros(1), counts.cumsum(0)])
+            self._csr = (order, offsets, self.codes[order].long())
+        return self._csr
+
+    def search(self, q, k=10):
+        q = self._prep(q)
+        order, offsets, codes = self._inverted_lists()
+        probes = _sq_dist(q, self.coarse).topk(min(self.nprobe, self.nlist), dim=1, largest=False).indices
+        sub = torch.arange(self.m)
+        out_d = torch.full((q.size(0), k), float("inf"))
+        out_i = torch.full((q.size(0), k), -1, dtype=torch.long)
+        for qi in range(q.size(0)):
+            cells = probes[qi]
+            # distance tables of the query residual against every sub-centroid, per probed cell
+            rq = (q[qi][None, :] - self.coarse[cells]).view(-1, self.m, 1, self.dsub)
+            lut = (rq - self.pq[None]).pow(2).sum(-1)  # [nprobe, m, ksub]
+            sizes = offsets[cells + 1] - offsets[cells]
+            if sizes.sum() == 0:
+                continue
+            pos = torch.repeat_interleave(torch.arange(cells.numel()), sizes)
+            starts = torch.repeat_interleave(offsets[cells], sizes)
+            rank = torch.arange(pos.numel()) - torch.repeat_interleave(sizes.cumsum(0) - sizes, sizes)
+            cand = starts + rank
+            d = lut[pos[:, None], sub[None, :], codes[cand]].sum(1)
+            kk = min(k, d.numel())
+            d, j = d.topk(kk, largest=False)
+            out_d[qi, :kk] = d
+            out_i[qi, :kk] = order[cand[j]]
+        ids = np.asarray(self.ids)
+        out_ids = np.where(out_i.numpy() >= 0, ids[out_i.clamp(min=0).numpy()], -1)
+        return out_d, torch.from_numpy(out_ids)
+
+
+class HNSWIndex(_Index):
+    r"""
+    Hierarchical navigable small-world graph (Malkov & Yashunin), numpy implementation
+
+    Level 0 neighbour lists are one fixed-width [n, 2M] array so they can be memory-mapped, the sparse
+    upper levels are kept as dicts.
+
+    args:
+        M (int): neighbours per node on the upper levels, 2M on level 0
+        ef_construction (int): beam width while inserting
+        ef_search (int): beam width while searching
+    """
+
+    arrays = ("vectors", "levels", "graph0")
+
+    def __init__(self, dim, metric="l2", M=16, ef_construction=100, ef_search=64, seed=0):
+        super(HNSWIndex, self).__init__(dim, metric)
+        self.M, self.M0 = M, 2 * M
+        self.ef_construction, self.ef_search = ef_construction, ef_search
+        self.mult = 1 / math.log(M)
+        self.rng = np.random.default_rng(seed)
+        self.vectors = np.zeros((0, dim), dtype=np.float32)
+        self.levels = np.zeros(0, dtype=np.int32)
+        self.graph0 = np.zeros((0, self.M0), dtype=np.int32)
+        self.upper = []  # upper[l - 1] = {node: np.array of neighbours}
+        self.entry = -1
+
+    def _config(self):
+        config = super(HNSWIndex, self)._config()
+        config.update(M=self.M, ef_construction=self.ef_construction, ef_search=self.ef_search)
+        return config
+
+    def _extra(self):
+        return {"entry": self.entry, "upper": [{str(k): v.tolist() for k, v in level.items()} for level in self.upper]}
+
+    def _load_extra(self, extra):
+        self.entry = extra["entry"]
+        self.upper = [{int(k): np.asarray(v, dtype=np.int32) for k, v in level.items()} for level in extra["upper"]]
+
+    def _as_tensor(self, name):
+        return False
+
+    def _array(self, name):
+        return getattr(self, name)[:self.ntotal]  # drop the unused capacity
+
+    def _neighbours(self, node, level):
+        if level == 0:
+            row = self.graph0[node]
+            return row[row >= 0]
+        return self.upper[level - 1].get(node, np.zeros(0, dtype=np.int32))
+
+    def _dist(self, x, nodes):
+        diff = self.vectors[nodes] - x
+        return np.einsum("ij,ij->i", diff, diff)
+
+    def _search_layer(self, x, entries, ef, level):
+        visited = set(entries)
+        d = self._dist(x, np.asarray(entries))
+        candidates = [(float(di), int(n)) for di, n in zip(d, entries)]
+        heapq.heapify(candidates)
+        best = [(-di, n) for di, n in candidates]  # max-heap of the ef closest
+        heapq.heapify(best)
+        while candidates:
+            dc, c = heapq.heappop(candidates)
+            if dc > -best[0][0] and len(best) >= ef:
+                break
+            nbrs = [n for n in self._neighbours(c, level).tolist() if n not in visited]
+            if not nbrs:
+                continue
+            visited.update(nbrs)
+            for dn, n in zip(self._dist(x, np.asarray(nbrs)).tolist(), nbrs):
+                if len(best) < ef or dn < -best[0][0]:
+                    heapq.heappush(candidates, (dn, n))
+                    heapq.heappush(best, (-dn, n))
+                    if len(best) > ef:
+                        heapq.heappop(best)
+        return sorted((-d, n) for d, n in best)
+
+    def _set_neighbours(self, node, level, nbrs):
+        if level == 0:
+            self.graph0[node] = -1
+            self.graph0[node, :len(nbrs)] = nbrs
+        else:
+            self.upper[level - 1][node] = np.asarray(nbrs, dtype=np.int32)
+
+    def _connect(self, node, level, nbrs):
+        width = self.M0 if level == 0 else self.M
+        self._set_neighbours(node, level, nbrs[:width])
+        for n in nbrs[:width]:
+            links = np.append(self._neighbours(n, level), node)
+            if links.size > width:
+                links = links[np.argsort(self._dist(self.vectors[n], links))[:width]]
+            self._set_neighbours(n, level, links)
+
+    def _grow(self, n):
+        cap = self.vectors.shape[0]
+        if self.ntotal + n <= cap:
+            return
+        new = max(2 * cap, self.ntotal + n, 1024)
+        self.vectors = np.concatenate([self.vectors[:self.ntotal], np.zeros((new - self.ntotal, self.dim), np.float32)])
+        self.levels = np.concatenate([self.levels[:self.ntotal], np.zeros(new - self.ntotal, np.int32)])
+        self.graph0 = np.concatenate([self.graph0[:self.ntotal], np.full((new - self.ntotal, self.M0), -1, np.int32)])
+
+    def add(self, x, ids=None):
+        x = self._prep(x).numpy()
+        self._grow(x.shape[0])
+        start = self.ntotal
+        self._add_ids(x.shape[0], ids)
+        for i, v in enumerate(x):
+            node = start + i
+            self.vectors[node] = v
+            level = int(-math.log(max(self.rng.random(), 1e-12)) * self.mult)
+            self.levels[node] = level
+            while len(self.upper) < level:
+                self.upper.append({})
+            if self.entry < 0:
+                self.entry = node
+                continue
+            ep = [self.entry]
+            top = int(self.levels[self.entry])
+            for l in range(top, level, -1):
+                ep = [self._search_layer(v, ep, 1, l)[0][1]]
+            for l in range(min(level, top), -1, -1):
+                found = self._search_layer(v, ep, self.ef_construction, l)
+                self._connect(node, l, [n for _, n in found])
+                ep = [n for _, n in found]
+            if level > top:
+                self.entry = node
+
+    def search(self, q, k=10):
+        q = self._prep(q).numpy()
+        out_d = np.full((q.shape[0], k), np.inf, dtype=np.float32)
+        out_i = np.full((q.shape[0], k), -1, dtype=np.int64)
+        ids = np.asarray(self.ids)
+        for qi, v in enumerate(q):
+            if self.entry < 0:
+                break
+            ep = [self.entry]
+            for l in range(int(self.levels[self.entry]), 0, -1):
+                ep = [self._search_layer(v, ep, 1, l)[0][1]]
+            found = self._search_layer(v, ep, max(self.ef_search, k), 0)[:k]
+            out_d[qi, :len(found)] = [d for d, _ in found]
+            out_i[qi, :len(found)] = ids[[n for _, n in found]]
+        return torch.from_numpy(out_d), torch.from_numpy(out_i)
+
+
+_INDEX_TYPES = {cls.__name__: cls for cls in (FlatIndex, IVFPQIndex, HNSWIndex)}
+
+
+def recall_at_k(found, truth):
+    r"""
+    Fraction of the true k nearest neighbours that were returned, averaged over queries
+    """
+    found, truth = np.asarray(found), np.asarray(truth)
+    hits = [len(set(f.tolist()) & set(t.tolist())) for f, t in zip(found, truth)]
+    return float(np.mean(hits)) / truth.shape[1]
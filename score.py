@@ -0,0 +1,335 @@
+import argparse
+import csv
+import itertools
+import os
+import queue
+import sys
+import threading
+import time
+
+import numpy as np
+import torch
+
+from utils import BINNED_MODES, FEATURE_DIMS, PA_DIMS, PA_KEYS, RA_DIM, default_args, load_camlif, presence_masks
+
+_DONE = object()
+
+# define_net fields the checkpoint's architecture depends on, with their defaults
+NET_FIELDS = {
+    "mode": "rapath",
+    "feature_dim": 256,
+    "act_type": "none",
+    "co_attention": 0,
+    "missing_modality": 0,
+    "label_dim": 1,
+    "share_transformer": "none",
+    "attention_backend": "nystrom",
+    "fused_snn": 0,
+}
+
+
+################
+# Readers
+################
+def feature_layout(ra_tokens=1):
+    r"""
+    (name, start, stop) column slices of a feature row: ra (ra_tokens x 863), then pa1..pa4
+    """
+    layout = [("ra", 0, RA_DIM * ra_tokens)]
+    start = RA_DIM * ra_tokens
+    for key, dim in zip(PA_KEYS, PA_DIMS):
+        layout.append((key, start, start + dim))
+        start += dim
+    return layout
+
+
+def read_csv(path, chunk_size, id_column=None):
+    with open(path, newline="") as f:
+        reader = csv.reader(f)
+        header = next(reader)
+        id_idx = header.index(id_column) if id_column is not None else None
+        feat_idx = [i for i in range(len(header)) if i != id_idx]
+        offset = 0
+        while True:
+            rows = list(itertools.islice(reader, chunk_size))
+            if not rows:
+                return
+            block = np.asarray(rows)
+            ids = block[:, id_idx] if id_idx is not None else np.arange(offset, offset + len(rows))
+            yield ids, block[:, feat_idx].astype(np.float32)
+            offset += len(rows)
+
+
+def read_parquet(path, chunk_size, id_column=None, columns=None):
+    import pyarrow.parquet as pq
+
+    pf = pq.ParquetFile(path)
+    names = columns or [n for n in pf.schema_arrow.names if n != id_column]
+    read = names + ([id_column] if id_column is not None else [])
+    offset = 0
+    for batch in pf.iter_batches(batch_size=chunk_size, columns=read):
+        feats = np.stack([batch.column(n).to_numpy(zero_copy_only=False) for n in names], axis=1).astype(np.float32, copy=False)
+        if id_column is not None:
+            ids = batch.column(id_column).to_numpy(zero_copy_only=False)
+        else:
+            ids = np.arange(offset, offset + batch.num_rows)
+        offset += batch.num_rows
+        yield ids, feats
+
+
+def read_numpy(path, chunk_size, id_column=None):
+    data = np.load(path, mmap_mode="r")  # only the current chunk is paged in
+    for start in range(0, data.shape[0], chunk_size):
+        block = np.ascontiguousarray(data[start:start + chunk_size], dtype=np.float32)
+        yield np.arange(start, start + block.shape[0]), block
+
+
+def open_reader(path, chunk_size, id_column=None):
+    ext = os.path.splitext(path)[1].lower()
+    if ext == ".csv":
+        return read_csv(path, chunk_size, id_column)
+    if ext in (".parquet", ".pq"):
+        return read_parquet(path, chunk_size, id_column)
+    if ext == ".npy":
+        return read_numpy(path, chunk_size, id_column)
+    raise NotImplementedError("input format [%s] is not supported" % ext)
+
+
+def to_inputs(block, layout, ra_tokens=1, device="cpu"):
+    inputs = {}
+    for name, start, stop in layout:
+        x = torch.from_numpy(block[:, start:stop])
+        if name == "ra":
+            x = x.reshape(x.size(0), ra_tokens, RA_DIM)
+        inputs[name] = x.to(device)
+    return inputs
+
+
+################
+# Writers
+################
+class CSVWriter(object):
+    def __init__(self, path):
+        self.f = open(path, "w", newline="")
+        self.writer = csv.writer(self.f)
+        self.header = False
+
+    def write(self, ids, hazards, features=None):
+        if not self.header:
+            names = ["id"] + ["hazard_%d" % i for i in range(hazards.shape[1])]
+            if features is not None:
+                names += ["feature_%d" % i for i in range(features.shape[1])]
+            self.writer.writerow(names)
+            self.header = True
+        cols = [ids[:, None].astype(str), hazards.astype(str)]
+        if features is not None:
+            cols.append(features.astype(str))
+        self.writer.writerows(np.concatenate(cols, axis=1).tolist())
+
+    def close(self):
+        self.f.close()
+
+
+class ParquetWriter(object):
+    def __init__(self, path):
+        self.path = path
+        self.writer = None
+
+    def write(self, ids, hazards, features=None):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        cols = {"id": ids}
+        cols.update({"hazard_%d" % i: hazards[:, i] for i in range(hazards.shape[1])})
+        if features is not None:
+            cols.update({"feature_%d" % i: features[:, i] for i in range(features.shape[1])})
+        table = pa.table(cols)
+        if self.writer is None:
+            self.writer = pq.ParquetWriter(self.path, table.schema)
+        self.writer.write_table(table)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+
+def open_writer(path):
+    ext = os.path.splitext(path)[1].lower()
+    if ext == ".csv":
+        return CSVWriter(path)
+    if ext in (".parquet", ".pq"):
+        return ParquetWriter(path)
+    raise NotImplementedError("output format [%s] is not supported" % ext)
+
+
+################
+# Pipeline
+################
+def _producer(reader, q_in, layout, ra_tokens, workers):
+    # parse chunks on a few threads, the bounded queue keeps memory constant
+    from concurrent.futures import ThreadPoolExecutor
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            pending = []
+            for ids, block in reader:
+                pending.append(pool.submit(lambda i, b: (i, to_inputs(b, layout, ra_tokens)), ids, block))
+                if len(pending) >= workers:
+                    q_in.put(pending.pop(0).result())
+            for fut in pending:
+                q_in.put(fut.result())
+    except BaseException as e:
+        q_in.put(e)
+    q_in.put(_DONE)
+
+
+def _consumer(writer, q_out, errors):
+    while True:
+        item = q_out.get()
+        if item is _DONE:
+            return
+        if errors:
+            continue  # keep draining so the inference loop never blocks
+        try:
+            writer.write(*item)
+        except BaseException as e:
+            errors.append(e)
+
+
+@torch.no_grad()
+def score(net, reader, writer, ra_tokens=1, device="cpu", with_features=False, prefetch=4, workers=2, log_every=10,
+          missing_modality=False):
+    r"""
+    Stream chunks from reader through net and into writer, returns (rows, seconds)
+
+    reader thread(s) -> bounded queue -> inference on this thread -> bounded queue -> writer thread
+
+    With missing_modality, all-NaN feature groups are passed to the network as absent.
+    """
+    net.eval()
+    layout = feature_layout(ra_tokens)
+    q_in = queue.Queue(maxsize=prefetch)
+    q_out = queue.Queue(maxsize=prefetch)
+    errors = []
+    producer = threading.Thread(target=_producer, args=(reader, q_in, layout, ra_tokens, workers), daemon=True)
+    consumer = threading.Thread(target=_consumer, args=(writer, q_out, errors), daemon=True)
+    producer.start()
+    consumer.start()
+
+    rows, chunks = 0, 0
+    start = time.perf_counter()
+    while True:
+        item = q_in.get()
+        if item is _DONE:
+            break
+        if isinstance(item, BaseException):
+            q_out.put(_DONE)
+            raise item
+        ids, inputs = item
+        if missing_modality:
+            inputs = presence_masks(inputs)
+        out = net(**{k: v.to(device, non_blocking=True) for k, v in inputs.items()})
+        hazards = out[1].float().reshape(len(ids), -1).cpu().numpy()
+        features = out[0].float().reshape(len(ids), -1).cpu().numpy() if with_features else None
+        q_out.put((ids, hazards, features))
+        rows += len(ids)
+        chunks += 1
+        if log_every and chunks % log_every == 0:
+            elapsed = time.perf_counter() - start
+            print("%d rows, %.1f rows/s" % (rows, rows / elapsed), file=sys.stderr)
+    q_out.put(_DONE)
+    consumer.join()
+    producer.join()
+    if errors:
+        raise errors[0]
+    return rows, time.perf_counter() - start
+
+
+def net_args(opt):
+    r"""
+    define_net args for opt: fields given on the command line win, the others come from the metadata of a
+    sharded checkpoint (see checkpoint.save_sharded) and then from NET_FIELDS
+    """
+    metadata = {}
+    if opt.checkpoint is not None and os.path.isdir(opt.checkpoint):
+        from checkpoint import ShardedCheckpoint
+
+        metadata = ShardedCheckpoint(opt.checkpoint).metadata
+    fields = {}
+    for name, default in NET_FIELDS.items():
+        value = getattr(opt, name)
+        fields[name] = type(default)(metadata.get(name, default)) if value is None else value
+    if fields["label_dim"] > 1 and fields["mode"] not in BINNED_MODES:
+        raise ValueError("label_dim [%d] needs a binned head, mode [%s] has a single output" % (fields["label_dim"], fields["mode"]))
+    args = default_args(**fields)
+    args.checkpoint = opt.checkpoint
+    return args
+
+
+def load_net(args):
+    camlif = load_camlif()
+    if args.checkpoint is None:
+        return camlif.define_net(args)
+    state_dict = args.checkpoint
+    if os.path.isdir(args.checkpoint):
+        from checkpoint import ShardedCheckpoint
+
+        state_dict = ShardedCheckpoint(args.checkpoint).state_dict()
+    try:
+        return camlif.define_net(args, state_dict=state_dict)
+    except RuntimeError as e:
+        fields = ", ".join("%s=%s" % (k, getattr(args, k)) for k in NET_FIELDS)
+        raise RuntimeError("checkpoint [%s] does not fit the network built with %s\n%s" % (args.checkpoint, fields, e))
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Score a cohort with a define_net model")
+    parser.add_argument("input", help=".csv, .parquet or .npy with ra then pa1..pa4 feature columns")
+    parser.add_argument("output", help=".csv or .parquet")
+    parser.add_argument("--checkpoint", default=None, help="torch.save'd state dict or sharded checkpoint dir")
+    # network fields default to the sharded checkpoint's metadata, then to NET_FIELDS
+    parser.add_argument("--mode", default=None)
+    parser.add_argument("--feature_dim", type=int, default=None, choices=FEATURE_DIMS)
+    parser.add_argument("--act_type", default=None)
+    parser.add_argument("--co_attention", type=int, default=None)
+    parser.add_argument("--missing_modality", type=int, default=None, help="treat all-NaN feature groups as absent")
+    parser.add_argument("--label_dim", type=int, default=None, help="time bins of a binned-loss (nll / ce) head")
+    parser.add_argument("--share_transformer", default=None, help="none, modality, stage or all")
+    parser.add_argument("--attention_backend", default=None)
+    parser.add_argument("--fused_snn", type=int, default=None)
+    parser.add_argument("--ra_tokens", type=int, default=1)
+    parser.add_argument("--id_column", default=None)
+    parser.add_argument("--chunk_size", type=int, default=4096)
+    parser.add_argument("--prefetch", type=int, default=4)
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--threads", type=int, default=None)
+    parser.add_argument("--features", action="store_true", help="also write the fused features")
+    parser.add_argument("--device", default="cpu")
+    opt = parser.parse_args(argv)
+    try:
+        opt.net_args = net_args(opt)
+    except (OSError, ValueError) as e:
+        parser.error(str(e))
+    return opt
+
+
+def main(argv=None):
+    opt = parse_args(argv)
+    if opt.threads is not None:
+        torch.set_num_threads(opt.threads)
+    args = opt.net_args
+    net = load_net(args).to(opt.device)  # a checkpoint that does not fit fails here, before any row is read
+
+    reader = open_reader(opt.input, opt.chunk_size, opt.id_column)
+    writer = open_writer(opt.output)
+    try:
+        rows, seconds = score(net, reader, writer, opt.ra_tokens, opt.device, opt.features, opt.prefetch, opt.workers,
+                             missing_modality=bool(args.missing_modality))
+    finally:
+        writer.close()
+    print("scored %d rows in %.1f s (%.1f rows/s)" % (rows, seconds, rows / max(seconds, 1e-9)))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
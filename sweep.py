@@ -0,0 +1,280 @@
+import argparse
+import json
+import os
+import random
+import sqlite3
+import sys
+import time
+
+import torch
+
+from evaluator import concordance_index, risk_from_hazards
+from utils import BINNED_MODES, FEATURE_DIMS, check_loss, default_args, load_camlif
+
+# define_bifusion / define_net / define_loss arguments; mmhid, path_dim and omic_dim follow feature_dim
+# because TrCross.classifier2 reads two fused feature_dim vectors
+SEARCH_SPACE = {
+    "feature_dim": list(FEATURE_DIMS),
+    "skip": [0, 1],
+    "use_bilinear": [0, 1],
+    "path_gate": [0, 1],
+    "omic_gate": [0, 1],
+    "path_scale": [1, 2, 4],
+    "omic_scale": [1, 2, 4],
+    "dropout_rate": [0.1, 0.25, 0.5],
+    "lr": [1e-4, 2e-4, 5e-4],
+    "loss": ["cox_surv"],
+    "share_transformer": ["none"],
+}
+# discrete-time losses, searched when the cohort has a time bin label (Y) and the mode is in BINNED_MODES
+BINNED_LOSSES = ["nll_surv", "ce_surv"]
+
+
+def sample_config(space, rng):
+    return {k: rng.choice(v) for k, v in space.items()}
+
+
+################
+# Results store
+################
+class ResultsStore(object):
+    r"""
+    All trials of a sweep in one sqlite file, one row per (trial, rung)
+    """
+
+    def __init__(self, path):
+        self.db = sqlite3.connect(path)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS results (trial INTEGER, rung INTEGER, epochs INTEGER, config TEXT, "
+            "metric REAL, seconds REAL, checkpoint TEXT, error TEXT, PRIMARY KEY (trial, rung))"
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS results_rung_metric ON results (rung, metric)")
+        self.db.commit()
+
+    def add(self, trial, rung, epochs, config, metric, seconds, checkpoint, error=None):
+        self.db.execute("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                        (trial, rung, epochs, json.dumps(config, sort_keys=True), metric, seconds, checkpoint, error))
+        self.db.commit()
+
+    def rung(self, rung):
+        return self.db.execute("SELECT trial, metric FROM results WHERE rung = ? AND error IS NULL ORDER BY metric DESC",
+                               (rung,)).fetchall()
+
+    def best(self, n=10):
+        rows = self.db.execute(
+            "SELECT trial, rung, epochs, config, metric FROM results WHERE error IS NULL "
+            "ORDER BY rung DESC, metric DESC LIMIT ?", (n,)).fetchall()
+        return [{"trial": r[0], "rung": r[1], "epochs": r[2], "config": json.loads(r[3]), "metric": r[4]} for r in rows]
+
+    def close(self):
+        self.db.close()
+
+
+################
+# Workers
+################
+_COHORT = None
+
+
+def _init_worker(cohort, threads):
+    # cohort tensors arrive as shared-memory handles, no copy per worker
+    global _COHORT
+    _COHORT = cohort
+    torch.set_num_threads(threads)
+
+
+def run_trial(trial, config, mode, start, stop, checkpoint, batch_size=32, seed=0):
+    r"""
+    Train a trial from epoch start to stop (resuming model and optimizer from checkpoint when start > 0),
+    save the checkpoint and return (trial, stop, validation C-index, seconds)
+    """
+    from ddp import surv_loss
+    from loss import define_loss
+
+    inputs, labels, train_idx, val_idx = _COHORT
+    begin = time.perf_counter()
+    torch.manual_seed(seed + trial)
+    net_config = {k: v for k, v in config.items() if k != "lr"}
+    fd = net_config["feature_dim"]
+    label_dim = 1 if net_config["loss"] == "cox_surv" else int(labels["Y"].max()) + 1
+    args = default_args(mode=mode, path_dim=fd, omic_dim=fd, mmhid=fd, label_dim=label_dim, **net_config)
+    net = load_camlif().define_net(args)
+    loss_fn = define_loss(args)
+    optimizer = torch.optim.Adam(net.parameters(), lr=config["lr"], weight_decay=1e-4)
+    if start > 0:
+        state = torch.load(checkpoint, weights_only=True)
+        net.load_state_dict(state["model"])
+        optimizer.load_state_dict(state["optimizer"])
+
+    g = torch.Generator().manual_seed(seed + trial)
+    for epoch in range(start, stop):
+        net.train()
+        order = train_idx[torch.randperm(train_idx.numel(), generator=g)]
+        for s in range(0, order.numel() - batch_size + 1, batch_size):
+            idx = order[s:s + batch_size]
+            hazards = net(**{k: v[idx] for k, v in inputs.items()})[1]
+            Y = labels["Y"][idx] if "Y" in labels else None
+            loss = surv_loss(loss_fn, hazards, labels["time"][idx], labels["c"][idx], Y)
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+
+    net.eval()
+    with torch.no_grad():
+        risk = torch.cat([risk_from_hazards(net(**{k: v[val_idx[s:s + 256]] for k, v in inputs.items()})[1])
+                          for s in range(0, val_idx.numel(), 256)])
+    metric = concordance_index(risk, labels["time"][val_idx], labels["c"][val_idx]).item()
+    torch.save({"model": net.state_dict(), "optimizer": optimizer.state_dict()}, checkpoint)
+    return trial, stop, metric, time.perf_counter() - begin
+
+
+################
+# ASHA
+################
+class ASHA(object):
+    r"""
+    Asynchronous successive halving: rung k trains for min_epochs * eta ** k epochs in total, a trial is
+    promoted to rung k + 1 once it is in the top 1 / eta of the trials finished at rung k. Free workers
+    take a promotion when there is one and start a new trial otherwise.
+    """
+
+    def __init__(self, min_epochs=1, max_epochs=27, eta=3):
+        self.eta = eta
+        self.rungs = [min_epochs]
+        while self.rungs[-1] * eta <= max_epochs:
+            self.rungs.append(self.rungs[-1] * eta)
+        self.finished = [dict() for _ in self.rungs]  # trial -> metric
+        self.promoted = [set() for _ in self.rungs]
+
+    def report(self, trial, rung, metric):
+        self.finished[rung][trial] = metric
+
+    def next_promotion(self):
+        # highest rung first, so the best trials finish early
+        for k in reversed(range(len(self.rungs) - 1)):
+            done = sorted(self.finished[k].items(), key=lambda kv: -kv[1])
+            for trial, _ in done[:len(done) // self.eta]:
+                if trial not in self.promoted[k]:
+                    self.promoted[k].add(trial)
+                    return trial, k + 1
+        return None
+
+
+def sweep(cohort, mode="rapath", n_trials=27, workers=4, threads=1, space=SEARCH_SPACE, min_epochs=1, max_epochs=27,
+          eta=3, out_dir="sweep", batch_size=32, seed=0):
+    r"""
+    ASHA sweep on a local process pool
+
+    args:
+        cohort (tuple): (inputs, labels, train_idx, val_idx), moved to shared memory once and handed to
+            every worker at pool start
+        n_trials (int): configurations sampled from space
+        workers (int), threads (int): processes and intra-op threads per process
+
+    Every finished rung goes to <out_dir>/results.db; surviving trials resume from
+    <out_dir>/trial<id>.pt instead of retraining from scratch. A trial that raises is stored with its
+    error and dropped from the search.
+    """
+    import torch.multiprocessing as mp
+
+    for loss in space["loss"]:
+        check_loss(mode, loss, "Y" in cohort[1])
+    os.makedirs(out_dir, exist_ok=True)
+    store = ResultsStore(os.path.join(out_dir, "results.db"))
+    inputs, labels, train_idx, val_idx = cohort
+    for t in list(inputs.values()) + list(labels.values()) + [train_idx, val_idx]:
+        t.share_memory_()
+
+    rng = random.Random(seed)
+    configs = [sample_config(space, rng) for _ in range(n_trials)]
+    asha = ASHA(min_epochs, max_epochs, eta)
+    next_trial, running = 0, {}
+    ctx = mp.get_context("spawn")
+    with ctx.Pool(workers, initializer=_init_worker, initargs=(cohort, threads)) as pool:
+        def submit():
+            nonlocal next_trial
+            job = asha.next_promotion()
+            if job is None and next_trial < n_trials:
+                job = (next_trial, 0)
+                next_trial += 1
+            if job is None:
+                return False
+            trial, rung = job
+            start = asha.rungs[rung - 1] if rung > 0 else 0
+            ckpt = os.path.join(out_dir, "trial%d.pt" % trial)
+            running[(trial, rung)] = pool.apply_async(
+                run_trial, (trial, configs[trial], mode, start, asha.rungs[rung], ckpt, batch_size, seed))
+            return True
+
+        while len(running) < workers and submit():
+            pass
+        while running:
+            done = [key for key, res in running.items() if res.ready()]
+            if not done:
+                time.sleep(0.05)
+                continue
+            for trial, rung in done:
+                try:
+                    _, epochs, metric, seconds = running.pop((trial, rung)).get()
+                except Exception as e:
+                    # a failed configuration is recorded and never promoted, the sweep goes on
+                    store.add(trial, rung, asha.rungs[rung], configs[trial], None, None, None, error=repr(e))
+                    print("trial %d failed at rung %d: %r" % (trial, rung, e), file=sys.stderr)
+                    continue
+                asha.report(trial, rung, metric)
+                store.add(trial, rung, epochs, configs[trial], metric, seconds, os.path.join(out_dir, "trial%d.pt" % trial))
+            while len(running) < workers and submit():
+                pass
+    best = store.best()
+    store.close()
+    return best
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="ASHA hyperparameter sweep over define_net / define_bifusion / define_loss")
+    parser.add_argument("--data", default=None, help="Parquet cohort (see ddp.py), default: synthetic")
+    parser.add_argument("--synthetic", type=int, default=2048)
+    parser.add_argument("--time_column", default="time")
+    parser.add_argument("--censor_column", default="c")
+    parser.add_argument("--label_column", default=None)
+    parser.add_argument("--cache_dir", default=None)
+    parser.add_argument("--mode", default="rapath")
+    parser.add_argument("--ra_tokens", type=int, default=1)
+    parser.add_argument("--share_transformer", nargs="*", default=["none"],
+                        help="TrCross Transformer sharing modes to search (none, modality, stage, all)")
+    parser.add_argument("--val_fraction", type=float, default=0.2)
+    parser.add_argument("--trials", type=int, default=27)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--threads", type=int, default=1)
+    parser.add_argument("--min_epochs", type=int, default=1)
+    parser.add_argument("--max_epochs", type=int, default=27)
+    parser.add_argument("--eta", type=int, default=3)
+    parser.add_argument("--batch_size", type=int, default=32)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out_dir", default="sweep")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    from ddp import load_cohort
+
+    opt = parse_args(argv)
+    inputs, labels = load_cohort(opt)
+    n = labels["c"].numel()
+    perm = torch.randperm(n, generator=torch.Generator().manual_seed(opt.seed))
+    n_val = int(n * opt.val_fraction)
+    cohort = (inputs, labels, perm[n_val:], perm[:n_val])
+    space = dict(SEARCH_SPACE)
+    if "Y" in labels and opt.mode in BINNED_MODES:
+        space["loss"] = SEARCH_SPACE["loss"] + BINNED_LOSSES
+    space["share_transformer"] = opt.share_transformer
+    best = sweep(cohort, opt.mode, opt.trials, opt.workers, opt.threads, space, min_epochs=opt.min_epochs,
+                 max_epochs=opt.max_epochs, eta=opt.eta, out_dir=opt.out_dir, batch_size=opt.batch_size, seed=opt.seed)
+    for row in best:
+        print("trial %3d  rung %d  %3d epochs  c-index %.4f  %s" % (
+            row["trial"], row["rung"], row["epochs"], row["metric"], json.dumps(row["config"], sort_keys=True)))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
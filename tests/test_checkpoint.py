@@ -0,0 +1,100 @@
+import json
+import os
+
+import pytest
+
+torch = pytest.importorskip("torch")
+from torch import nn
+
+from checkpoint import INDEX_FILE, ROOT_SHARD, ShardedCheckpoint, _Shard, save_sharded
+
+
+class Tied(nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.embed = nn.Embedding(10, 4)
+        self.bn = nn.BatchNorm1d(4)  # int64 num_batches_tracked
+        self.head = nn.Linear(4, 10, bias=False)
+        self.head.weight = self.embed.weight
+        self.register_buffer("flags", torch.rand(5) < 0.5)
+        self.register_buffer("fp16", torch.randn(3, dtype=torch.float16))
+        self.register_buffer("empty", torch.empty(0, 2))
+        self.output_range = nn.Parameter(torch.tensor([6.0]), requires_grad=False)
+
+
+def make_model(seed):
+    torch.manual_seed(seed)
+    model = Tied()
+    model.bn.running_mean.normal_()
+    model.bn.num_batches_tracked += 7
+    model.output_range.data.fill_(seed + 1.0)
+    return model
+
+
+def assert_same_state(a, b):
+    a, b = a.state_dict(), b.state_dict()
+    assert list(a) == list(b)
+    for k in a:
+        assert a[k].dtype == b[k].dtype and torch.equal(a[k], b[k]), k
+
+
+def test_round_trip_with_tied_weights(tmp_path):
+    model = make_model(0)
+    save_sharded(model, str(tmp_path), metadata={"mode": "rapath", "feature_dim": 32})
+
+    with open(os.path.join(str(tmp_path), INDEX_FILE)) as f:
+        index = json.load(f)
+    # the tied weight is written once, head has nothing else and gets no shard
+    assert index["aliases"] == {"head.weight": "embed.weight"}
+    assert "head" not in index["shards"]
+    # top-level tensors share one file
+    assert index["shards"]["output_range"] == index["shards"]["flags"] == "%s.safetensors" % ROOT_SHARD
+    assert sorted(os.listdir(str(tmp_path))) == sorted(["bn.safetensors", "embed.safetensors", INDEX_FILE,
+                                                        "%s.safetensors" % ROOT_SHARD])
+
+    ckpt = ShardedCheckpoint(str(tmp_path))
+    assert set(ckpt.keys()) == set(model.state_dict())
+    for k, t in model.state_dict().items():
+        assert torch.equal(ckpt[k], t), k
+
+    fresh = make_model(1)
+    result = ckpt.load_into(fresh)
+    assert not result.missing_keys and not result.unexpected_keys
+    assert_same_state(fresh, model)
+
+
+def test_assign_keeps_tied_storage(tmp_path):
+    model = make_model(0)
+    save_sharded(model, str(tmp_path))
+    fresh = make_model(1)
+    ShardedCheckpoint(str(tmp_path)).load_into(fresh, assign=True)
+    assert_same_state(fresh, model)
+    assert fresh.head.weight.data_ptr() == fresh.embed.weight.data_ptr()
+
+
+def test_partial_load_and_submodule(tmp_path):
+    model = make_model(0)
+    save_sharded(model.state_dict(), str(tmp_path))
+    ckpt = ShardedCheckpoint(str(tmp_path))
+
+    fresh = make_model(1)
+    result = ckpt.load_into(fresh, prefixes=["bn", "head", "output_range"])
+    assert "embed.weight" in result.missing_keys and "flags" in result.missing_keys
+    assert torch.equal(fresh.output_range, model.output_range)
+    assert torch.equal(fresh.bn.running_mean, model.bn.running_mean)
+    assert torch.equal(fresh.head.weight, model.head.weight)
+
+    bn = nn.BatchNorm1d(4)
+    bn.load_state_dict(ckpt.submodule("bn"))
+    assert torch.equal(bn.running_mean, model.bn.running_mean)
+    assert bn.num_batches_tracked.item() == 7
+
+
+def test_metadata_in_index_and_shard_headers(tmp_path):
+    save_sharded(make_model(0), str(tmp_path), metadata={"mode": "rapath", "feature_dim": 32})
+    ckpt = ShardedCheckpoint(str(tmp_path))
+    assert ckpt.metadata == {"mode": "rapath", "feature_dim": 32}
+    for filename in ckpt.shards.values():
+        shard = _Shard(os.path.join(str(tmp_path), filename))
+        assert shard.metadata == {"mode": "rapath", "feature_dim": "32", "format": "pt"}
+        assert "__metadata__" not in shard.keys()
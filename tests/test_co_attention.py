@@ -0,0 +1,69 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+from torch import nn
+
+from utils import load_camlif
+
+camlif = load_camlif()
+
+
+class Legacy(nn.Module):
+    # the two-module TrCross layout, sequence-first MultiheadAttention calls
+    def __init__(self, embed_dim, num_heads):
+        super().__init__()
+        self.R_In_P = camlif.MultiheadAttention(embed_dim=embed_dim, num_heads=num_heads)
+        self.P_In_R = camlif.MultiheadAttention(embed_dim=embed_dim, num_heads=num_heads)
+
+    def forward(self, x_ra, x_pa, ra_padding_mask=None, pa_padding_mask=None):
+        ra, pa = x_ra.transpose(1, 0), x_pa.transpose(1, 0)
+        ra_in_pa, _ = self.R_In_P(ra, pa, pa, key_padding_mask=pa_padding_mask)
+        pa_in_ra, _ = self.P_In_R(pa, ra, ra, key_padding_mask=ra_padding_mask)
+        return ra_in_pa.transpose(1, 0), pa_in_ra.transpose(1, 0)
+
+
+class Fused(nn.Module):
+    # the co-attention TrCross layout, with its pre-hook for old checkpoints
+    def __init__(self, embed_dim, num_heads):
+        super().__init__()
+        self.co_attention = camlif.CoAttention(embed_dim, num_heads=num_heads)
+        self._register_load_state_dict_pre_hook(camlif._co_attention_pre_hook)
+
+    def forward(self, *args):
+        return self.co_attention(*args)
+
+
+def padding_mask(lengths, size):
+    # True = padded, every row keeps at least one token
+    return torch.arange(size)[None, :] >= torch.tensor(lengths)[:, None]
+
+
+@pytest.mark.parametrize("num_heads", [1, 2])
+@pytest.mark.parametrize("masked", [False, True])
+@pytest.mark.parametrize("L,S", [(4, 7), (6, 6), (9, 3)])
+def test_matches_legacy_after_remap(num_heads, masked, L, S):
+    torch.manual_seed(0)
+    E, B = 16, 3
+    # nested, so the hook sees a non-empty prefix
+    legacy = nn.Sequential(Legacy(E, num_heads)).eval()
+    fused = nn.Sequential(Fused(E, num_heads)).eval()
+    result = fused.load_state_dict(legacy.state_dict())
+    assert not result.missing_keys and not result.unexpected_keys
+
+    x_ra, x_pa = torch.randn(B, L, E), torch.randn(B, S, E)
+    ra_mask = padding_mask([L, 1, L - 1], L) if masked else None
+    pa_mask = padding_mask([S - 1, S, 1], S) if masked else None
+    with torch.no_grad():
+        expected = legacy[0](x_ra, x_pa, ra_mask, pa_mask)
+        out = fused[0](x_ra, x_pa, ra_mask, pa_mask)
+    assert out[0].shape == (B, L, E) and out[1].shape == (B, S, E)
+    assert torch.allclose(out[0], expected[0], atol=1e-5)
+    assert torch.allclose(out[1], expected[1], atol=1e-5)
+
+
+def test_new_layout_loads_unchanged():
+    fused = Fused(8, 1)
+    other = Fused(8, 1)
+    other.load_state_dict(fused.state_dict())
+    for (k, a), (_, b) in zip(fused.state_dict().items(), other.state_dict().items()):
+        assert k.startswith("co_attention.") and torch.equal(a, b)
@@ -0,0 +1,71 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from evaluator import concordance_index
+
+
+def reference_cindex(risk, time, c):
+    # pairwise definition: (i, j) is comparable when time_i < time_j and i had the event
+    num = den = 0.0
+    n = len(risk)
+    for i in range(n):
+        if c[i] == 1:
+            continue
+        for j in range(n):
+            if time[i] < time[j]:
+                den += 1
+                if risk[i] > risk[j]:
+                    num += 1
+                elif risk[i] == risk[j]:
+                    num += 0.5
+    return num / max(den, 1)
+
+
+@pytest.mark.parametrize("n", [1, 2, 7, 64, 100])
+def test_continuous(n):
+    g = torch.Generator().manual_seed(n)
+    risk = torch.randn(n, generator=g)
+    time = torch.rand(n, generator=g)
+    c = (torch.rand(n, generator=g) < 0.3).long()
+    expected = reference_cindex(risk.tolist(), time.tolist(), c.tolist())
+    assert concordance_index(risk, time, c).item() == pytest.approx(expected, abs=1e-6)
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_ties_and_censoring(seed):
+    # few distinct values so time ties, risk ties and (time, risk) ties all occur
+    g = torch.Generator().manual_seed(seed)
+    n = 50
+    risk = torch.randint(0, 4, (n,), generator=g).float()
+    time = torch.randint(0, 6, (n,), generator=g).float()
+    c = torch.randint(0, 2, (n,), generator=g)
+    expected = reference_cindex(risk.tolist(), time.tolist(), c.tolist())
+    assert concordance_index(risk, time, c).item() == pytest.approx(expected, abs=1e-6)
+
+
+def test_all_censored():
+    risk = torch.randn(10)
+    time = torch.rand(10)
+    c = torch.ones(10, dtype=torch.long)
+    assert concordance_index(risk, time, c).item() == 0.0
+
+
+def test_perfect_and_reversed():
+    time = torch.arange(10).float()
+    c = torch.zeros(10, dtype=torch.long)
+    assert concordance_index(-time, time, c).item() == pytest.approx(1.0)
+    assert concordance_index(time, time, c).item() == pytest.approx(0.0)
+
+
+def test_batched_leading_dims():
+    g = torch.Generator().manual_seed(0)
+    risk = torch.randint(0, 5, (3, 4, 33), generator=g).float()
+    time = torch.randint(0, 8, (3, 4, 33), generator=g).float()
+    c = torch.randint(0, 2, (3, 4, 33), generator=g)
+    out = concordance_index(risk, time, c)
+    assert out.shape == (3, 4)
+    for i in range(3):
+        for j in range(4):
+            expected = reference_cindex(risk[i, j].tolist(), time[i, j].tolist(), c[i, j].tolist())
+            assert out[i, j].item() == pytest.approx(expected, abs=1e-6)
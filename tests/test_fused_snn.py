@@ -0,0 +1,95 @@
+import math
+
+import pytest
+
+torch = pytest.importorskip("torch")
+import torch.nn.functional as F
+
+from utils import load_camlif
+
+camlif = load_camlif()
+
+
+def alpha_dropout_with_mask(x, keep, p):
+    # torch's alpha dropout with an explicit keep mask instead of a sampled one
+    alpha = camlif._SELU_ALPHA
+    a = 1.0 / math.sqrt((alpha * alpha * p + 1) * (1 - p))
+    keep = keep.to(x.dtype)
+    return a * keep * x + alpha * a * (keep - 1 + p)
+
+
+def sampled_mask(shape, p, seed):
+    # the fused op draws its mask first thing after the matmul, from the same generator
+    torch.manual_seed(seed)
+    return torch.empty(shape, dtype=torch.bool).bernoulli_(1 - p)
+
+
+@pytest.mark.parametrize("shape", [(5, 4), (2, 3, 4)])
+def test_gradcheck(shape):
+    g = torch.Generator().manual_seed(0)
+    x = torch.randn(*shape, generator=g, dtype=torch.float64, requires_grad=True)
+    weight = torch.randn(6, 4, generator=g, dtype=torch.float64, requires_grad=True)
+    bias = torch.randn(6, generator=g, dtype=torch.float64, requires_grad=True)
+
+    def fn(x, weight, bias):
+        torch.manual_seed(1)  # same mask for every evaluation
+        return camlif._FusedSNNFunction.apply(x, weight, bias, 0.25, 1.0)
+
+    assert torch.autograd.gradcheck(fn, (x, weight, bias))
+
+
+@pytest.mark.parametrize("shape", [(8, 16), (2, 5, 16)])
+def test_matches_snn_block_under_fixed_mask(shape):
+    p = 0.25
+    torch.manual_seed(0)
+    block = camlif.SNN_Block(16, 12, dropout=p)
+    fused = camlif.SNN_Block(16, 12, dropout=p, fused=True)
+    fused.load_state_dict(block.state_dict())
+    x = torch.randn(*shape, requires_grad=True)
+    x_ref = x.detach().clone().requires_grad_(True)
+
+    torch.manual_seed(3)
+    y = fused.train()(x)
+    keep = sampled_mask((x.numel() // 16, 12), p, 3).view(*shape[:-1], 12)
+    y_ref = alpha_dropout_with_mask(block[1](block[0](x_ref)), keep, p)
+    assert torch.allclose(y, y_ref, atol=1e-6)
+
+    grad = torch.randn_like(y)
+    y.backward(grad)
+    y_ref.backward(grad)
+    assert torch.allclose(x.grad, x_ref.grad, atol=1e-5)
+    assert torch.allclose(fused[0].weight.grad, block[0].weight.grad, atol=1e-5)
+    assert torch.allclose(fused[0].bias.grad, block[0].bias.grad, atol=1e-5)
+
+
+def test_eval_matches_snn_block():
+    torch.manual_seed(0)
+    block = camlif.SNN_Block(16, 12).eval()
+    fused = camlif.SNN_Block(16, 12, fused=True).eval()
+    fused.load_state_dict(block.state_dict())
+    x = torch.randn(8, 16)
+    assert torch.equal(fused(x), block(x))
+
+
+def test_bit_packing_round_trip():
+    keep = torch.rand(37) < 0.5
+    assert torch.equal(camlif._unpack_bits(camlif._pack_bits(keep), keep.numel()), keep)
+
+
+def test_non_linear_first_child_runs_unfused():
+    class Scaled(torch.nn.Module):
+        def __init__(self, linear):
+            super().__init__()
+            self.linear = linear
+
+        def forward(self, x):
+            return 2 * self.linear(x)
+
+    torch.manual_seed(0)
+    fused = camlif.SNN_Block(16, 12, fused=True)
+    fused[0] = Scaled(fused[0])
+    x = torch.randn(8, 16)
+    torch.manual_seed(3)
+    y = fused.train()(x)
+    torch.manual_seed(3)
+    assert torch.equal(y, F.alpha_dropout(F.elu(fused[0](x)), 0.25, training=True))
@@ -0,0 +1,83 @@
+import torch
+from torch import nn
+
+DROPOUT_LAYERS = (nn.Dropout, nn.AlphaDropout, nn.FeatureAlphaDropout)
+
+
+class _mc_dropout_mode(object):
+    # eval() everywhere (BatchNorm, ...) except dropout layers, restores the previous modes on exit
+    def __init__(self, model):
+        self.model = model
+
+    def __enter__(self):
+        self.modes = {m: m.training for m in self.model.modules()}
+        self.model.eval()
+        for m in self.model.modules():
+            if isinstance(m, DROPOUT_LAYERS):
+                m.train()
+        return self.model
+
+    def __exit__(self, *exc):
+        for m, mode in self.modes.items():
+            m.training = mode
+        return False
+
+
+def _tile(inputs, t):
+    # [B, ...] -> [t * B, ...], copy j of sample i sits at j * B + i
+    return {k: v.repeat(t, *([1] * (v.dim() - 1))) for k, v in inputs.items()}
+
+
+@torch.no_grad()
+def mc_dropout(model, inputs, n_samples=30, chunk_size=None, quantiles=(0.025, 0.5, 0.975), output_index=1,
+               logits=False):
+    r"""
+    Monte Carlo dropout with all samples drawn in batched forwards
+
+    The batch is tiled so every copy gets an independent dropout mask; ``chunk_size`` bounds how many
+    copies go through a single forward (default: all n_samples at once).
+
+    args:
+        model (nn.Module): any define_net model
+        inputs (dict): forward kwargs (ra, pa1..pa4), batch first
+        n_samples (int): number of MC samples T
+        chunk_size (int): MC samples per forward
+        quantiles (tuple): quantiles reported for hazards and survival curves
+        output_index (int): position of the hazard in the model's output tuple
+        logits (bool): discrete-time outputs are raw logits rather than per-bin hazards, as in
+            predict.survival_curves
+
+    Returns a dict with the samples [T, B, K], their mean and quantiles, and for discrete-time outputs
+    (K > 1) the same statistics of S = cumprod(1 - hazards).
+    """
+    B = next(iter(inputs.values())).size(0)
+    chunk_size = chunk_size or n_samples
+    samples = []
+    with _mc_dropout_mode(model):
+        for start in range(0, n_samples, chunk_size):
+            t = min(chunk_size, n_samples - start)
+            out = model(**_tile(inputs, t))[output_index]
+            samples.append(out.reshape(t, B, -1))
+    samples = torch.cat(samples)  # [T, B, K]
+
+    q = torch.tensor(quantiles, dtype=samples.dtype, device=samples.device)
+    results = {
+        "samples": samples,
+        "mean": samples.mean(dim=0),
+        "std": samples.std(dim=0),
+        "quantiles": torch.quantile(samples, q, dim=0),  # [len(quantiles), B, K]
+    }
+    if samples.size(-1) > 1:
+        hazards = torch.sigmoid(samples) if logits else samples
+        S = torch.cumprod(1 - hazards, dim=-1)  # surival is cumulative product of 1 - hazards
+        results["hazards_mean"] = hazards.mean(dim=0)
+        results["survival_mean"] = S.mean(dim=0)
+        results["survival_quantiles"] = torch.quantile(S, q, dim=0)
+    return results
+
+
+@torch.no_grad()
+def mc_dropout_loop(model, inputs, n_samples=30, output_index=1):
+    # reference implementation, one forward per MC sample
+    with _mc_dropout_mode(model):
+        return torch.stack([model(**inputs)[output_index] for _ in range(n_samples)])
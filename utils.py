@@ -0,0 +1,123 @@
+import argparse
+import importlib.util
+import os
+import statistics
+import sys
+import time
+
+import torch
+
+################
+# Feature layout
+################
+RA_DIM = 863
+PA_DIMS = (58, 290, 290, 155)
+PA_KEYS = ("pa1", "pa2", "pa3", "pa4")
+
+NET_MODES = ("path", "ra", "path_TU", "path_PaEp", "path_PaSt", "path_PaNu", "rapath")
+LOSS_TYPES = ("ce_surv", "nll_surv", "cox_surv", "nll_surv_kl", "nll_surv_mse", "nll_surv_l1", "nll_surv_cos", "nll_surv_ol")
+# TrCross embedding MLPs end in 256 units, the only token width the Transformers accept
+FEATURE_DIMS = (256,)
+# modes whose head honours args.label_dim, the only ones the discrete-time (non-Cox) losses can train
+BINNED_MODES = ("rapath",)
+
+
+def check_loss(mode, loss, has_bins=True):
+    r"""
+    Fail early on a loss the mode's head cannot train: every loss but cox_surv needs label_dim
+    per-bin hazards and the time bin label Y
+    """
+    if loss == "cox_surv":
+        return
+    if mode not in BINNED_MODES:
+        raise ValueError("loss [%s] needs per-bin hazards, mode [%s] has a single-output head (use cox_surv)" % (loss, mode))
+    if not has_bins:
+        raise ValueError("loss [%s] needs the time bin label Y" % loss)
+
+
+def load_camlif():
+    r"""
+    Import CA-MLIF.py (not a valid module name because of the hyphen) once and cache it as ``ca_mlif``
+    """
+    if "ca_mlif" in sys.modules:
+        return sys.modules["ca_mlif"]
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "CA-MLIF.py")
+    spec = importlib.util.spec_from_file_location("ca_mlif", path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules["ca_mlif"] = module
+    try:
+        spec.loader.exec_module(module)
+    except BaseException:
+        del sys.modules["ca_mlif"]
+        raise
+    return module
+
+
+def default_args(**kwargs):
+    r"""
+    Namespace with every field define_net / define_loss read, fusion dims match feature_dim so
+    that TrCross.classifier2 sees 2 * feature_dim inputs
+    """
+    feature_dim = kwargs.get("feature_dim", 256)
+    args = dict(
+        mode="rapath",
+        loss="nll_surv",
+        feature_dim=feature_dim,
+        act_type="none",
+        fusion_type="pofusion",
+        skip=1,
+        use_bilinear=1,
+        path_gate=1,
+        omic_gate=1,
+        path_dim=feature_dim,
+        omic_dim=feature_dim,
+        path_scale=1,
+        omic_scale=1,
+        mmhid=feature_dim,
+        dropout_rate=0.25,
+        label_dim=1,
+    )
+    args.update(kwargs)
+    return argparse.Namespace(**args)
+
+
+def synthetic_inputs(batch_size, ra_tokens=1, device="cpu", generator=None):
+    r"""
+    Random forward kwargs at the real feature sizes: ra [B, ra_tokens, 863], pa1..pa4 [B, 58/290/290/155]
+    """
+    inputs = {"ra": torch.randn(batch_size, ra_tokens, RA_DIM, generator=generator)}
+    for key, dim in zip(PA_KEYS, PA_DIMS):
+        inputs[key] = torch.randn(batch_size, dim, generator=generator)
+    return {k: v.to(device) for k, v in inputs.items()}
+
+
+def presence_masks(inputs):
+    r"""
+    Mark all-NaN feature rows as absent: returns inputs with NaNs zero-filled plus the ra_mask
+    [B, ra_tokens] / pa_mask [B, 4] kwargs of TrCross (built with args.missing_modality)
+    """
+    out = {k: torch.nan_to_num(v) for k, v in inputs.items()}
+    out["ra_mask"] = ~torch.isnan(inputs["ra"]).all(dim=-1)
+    out["pa_mask"] = torch.stack([~torch.isnan(inputs[key]).all(dim=-1) for key in PA_KEYS], dim=1)
+    return out
+
+
+def _sync(device):
+    if torch.device(device).type == "cuda":
+        torch.cuda.synchronize(device)
+
+
+def timeit(fn, repeats=20, warmup=3, device="cpu"):
+    r"""
+    Median / min wall time of fn() in milliseconds
+    """
+    for _ in range(warmup):
+        fn()
+    _sync(device)
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        _sync(device)
+        times.append((time.perf_counter() - start) * 1e3)
+    return {"median_ms": statistics.median(times), "min_ms": min(times)}